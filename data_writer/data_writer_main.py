@@ -7,7 +7,6 @@ message handling for data writer
 """
 import logging
 import os
-import queue
 import sys
 from threading import Event
 
@@ -20,22 +19,20 @@ from tools.standard_logging import initialize_logging
 from tools.sub_client import SUBClient
 from tools.push_client import PUSHClient
 from tools.event_push_client import EventPushClient
-from tools.database_connection import get_central_connection
+from tools.database_connection import get_central_connection, \
+        get_node_local_connection
+from tools.file_space import load_file_space_info, file_space_sanity_check
 from tools.process_util import set_signal_handler
 
 from web_public_reader.central_database_util import get_cluster_row, \
         get_node_rows
 
 from data_writer.reply_pull_server import ReplyPULLServer
+from data_writer.output_value_file import mark_value_files_as_closed
 from data_writer.writer_thread import WriterThread
-from data_writer.sync_thread import SyncThread
-
-class AppendQueue(queue.Queue):
-    """
-    adapter to give a Queue an 'append' member.
-    """
-    def append(self, item):
-        self.put(item)
+from data_writer.writer_lanes import WriterLanes
+from data_writer.segment_verifier import SegmentVerifier
+from data_writer.write_path_stats import WritePathStats
 
 _local_node_name = os.environ["NIMBUSIO_NODE_NAME"]
 _log_path = "{0}/nimbusio_data_writer_{1}.log".format(
@@ -47,6 +44,38 @@ _data_writer_anti_entropy_address = \
 _event_aggregator_pub_address = \
         os.environ["NIMBUSIO_EVENT_AGGREGATOR_PUB_ADDRESS"]
 _writer_thread_reply_address = "inproc://writer_thread_reply"
+_repository_path = os.environ["NIMBUSIO_REPOSITORY_PATH"]
+
+# 0 means one writer lane for each journal file space
+_lane_count = int(os.environ.get("NIMBUSIO_DATA_WRITER_LANE_COUNT", "0"))
+
+# 0 means the writer threads verify their own segments
+_hash_thread_count = int(
+    os.environ.get("NIMBUSIO_DATA_WRITER_HASH_THREADS", "2"))
+
+class AntiEntropyQueue(object):
+    """
+    adapter for the anti-entropy REP server: we answer stats requests
+    here, and pass everything else on to the writer lanes
+    """
+    def __init__(self, state):
+        self._state = state
+
+    def append(self, item):
+        message, _data = item
+        if message["message-type"] != "data-writer-stats":
+            self._state["message-queue"].append(item)
+            return
+
+        reply = {
+            "message-type"  : "data-writer-stats-reply",
+            "result"        : "success",
+            "error-message" : None,
+            "lanes"         : [write_path_stats.snapshot() \
+                               for write_path_stats \
+                               in self._state["write-path-stats"]],
+        }
+        self._state["anti-entropy-server"].send_reply(reply)
 
 def _create_state():
     return {
@@ -58,12 +87,16 @@ def _create_state():
         "anti-entropy-server"   : None,
         "sub-client"            : None,
         "event-push-client"     : None,
-        "message-queue"         : AppendQueue(),
+        "message-queue"         : None,
+        "lane-space-ids"        : None,
+        "segment-verifier"      : None,
         "cluster-row"           : None,
         "node-rows"             : None,
         "node-id-dict"          : None,
-        "writer-thread"         : None,
-        "sync-thread"           : None,
+        "writer-threads"        : list(),
+        "writer-event-push-clients" : list(),
+        "reply-push-clients"    : list(),
+        "write-path-stats"      : list(),
     }
 
 def _setup(state):
@@ -76,6 +109,34 @@ def _setup(state):
         "data_writer"
     )
 
+    local_connection = get_node_local_connection()
+    file_space_info = load_file_space_info(local_connection)
+    file_space_sanity_check(file_space_info, _repository_path)
+
+    # Ticket #1646 mark output value files as closed at startup
+    # we do this before starting the writer lanes, so no lane closes
+    # another lane's file
+    mark_value_files_as_closed(local_connection)
+    local_connection.close()
+
+    journal_space_ids = sorted([row.space_id \
+                                for row in file_space_info["journal"]])
+    lane_count = _lane_count if _lane_count > 0 else len(journal_space_ids)
+    if lane_count == 1:
+        # a single writer picks the journal with the most free space
+        state["lane-space-ids"] = [None, ]
+    else:
+        state["lane-space-ids"] = [
+            journal_space_ids[lane_index % len(journal_space_ids)] \
+            for lane_index in range(lane_count)
+        ]
+    log.info("{0} writer lanes on journal spaces {1}".format(
+        lane_count, state["lane-space-ids"]))
+    if _hash_thread_count > 0:
+        state["segment-verifier"] = SegmentVerifier(_hash_thread_count)
+    state["message-queue"] = WriterLanes(lane_count, 
+                                         state["segment-verifier"])
+
     log.info("binding resilient-server to {0}".format(_data_writer_address))
     state["resilient-server"] = ResilientServer(
         state["zmq-context"],
@@ -98,7 +159,7 @@ def _setup(state):
     state["anti-entropy-server"] = REPServer(
         state["zmq-context"],
         _data_writer_anti_entropy_address,
-        state["message-queue"]
+        AntiEntropyQueue(state)
     )
     state["anti-entropy-server"].register(state["pollster"])
 
@@ -128,27 +189,40 @@ def _setup(state):
     state["event-push-client"].info("program-start", "data_writer starts")
 
 
-    state["reply-push-client"] = PUSHClient(state["zmq-context"],
-                                            _writer_thread_reply_address)
+    # each writer lane gets its own sockets, and its own database connection
+    for lane_index, space_id in enumerate(state["lane-space-ids"]):
+        reply_push_client = PUSHClient(state["zmq-context"],
+                                       _writer_thread_reply_address)
+        state["reply-push-clients"].append(reply_push_client)
+
+        writer_event_push_client = EventPushClient(state["zmq-context"],
+                                                   "data_writer")
+        state["writer-event-push-clients"].append(writer_event_push_client)
 
-    state["writer-thread"] = WriterThread(state["halt-event"],
-                                          state["node-id-dict"],
-                                          state["message-queue"],
-                                          state["reply-push-client"])
-    state["writer-thread"].start()
+        write_path_stats = WritePathStats(lane_index,
+                                          writer_event_push_client)
+        state["write-path-stats"].append(write_path_stats)
 
-    state["sync-thread"] = SyncThread(state["halt-event"],
-                                      state["message-queue"])
-    state["sync-thread"].start()
+        writer_thread = WriterThread(state["halt-event"],
+                                     state["node-id-dict"],
+                                     state["message-queue"].queues[lane_index],
+                                     reply_push_client,
+                                     write_path_stats,
+                                     lane_index=lane_index,
+                                     space_id=space_id)
+        state["writer-threads"].append(writer_thread)
+        writer_thread.start()
 
 def _tear_down(state):
     log = logging.getLogger("_tear_down")
 
-    log.debug("joining writer thread")
-    state["writer-thread"].join(timeout=3.0)
+    log.debug("joining writer threads")
+    for writer_thread in state["writer-threads"]:
+        writer_thread.join(timeout=3.0)
 
-    log.debug("joining sync thread")
-    state["sync-thread"].join(timeout=3.0)
+    if state["segment-verifier"] is not None:
+        log.debug("stopping segment verifier")
+        state["segment-verifier"].close()
 
     log.debug("stopping resilient server")
     state["resilient-server"].close()
@@ -156,7 +230,10 @@ def _tear_down(state):
     state["anti-entropy-server"].close()
     state["sub-client"].close()
     state["event-push-client"].close()
-    state["reply-push-client"].close()
+    for reply_push_client in state["reply-push-clients"]:
+        reply_push_client.close()
+    for writer_event_push_client in state["writer-event-push-clients"]:
+        writer_event_push_client.close()
 
     state["zmq-context"].term()
 
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+group_commit.py
+
+Hold the database rows produced by archives between syncs of the value
+file, and write them with multi-row statements in the sync's transaction.
+
+Segment ids are allocated from nimbusio_node.segment_id_seq in blocks, so
+a new segment gets its id (for _active_segments) before its row is
+written.
+"""
+from collections import deque
+import logging
+
+from tools.data_definitions import segment_status_final
+from tools.database_connection import PreparedStatement
+
+# the most rows we put in one statement
+_max_rows_per_statement = 500
+_segment_id_block_size = 100
+
+_segment_columns = [
+    "id",
+    "collection_id",
+    "key",
+    "status",
+    "unified_id",
+    "timestamp",
+    "segment_num",
+    "conjoined_part",
+    "source_node_id",
+    "handoff_node_id",
+]
+_segment_placeholders = \
+    "(%s, %s, %s, %s, %s, %s::timestamp, %s, %s, %s, %s)"
+
+_segment_sequence_columns = [
+    "collection_id",
+    "segment_id",
+    "zfec_padding_size",
+    "value_file_id",
+    "sequence_num",
+    "value_file_offset",
+    "size",
+    "hash",
+    "adler32",
+]
+_segment_sequence_placeholders = \
+    "(%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+_segment_final_placeholders = "(%s, %s, %s, %s)"
+
+_meta_columns = [
+    "collection_id",
+    "segment_id",
+    "meta_key",
+    "meta_value",
+    "timestamp",
+]
+_meta_placeholders = "(%s, %s, %s, %s, %s::timestamp)"
+
+_allocate_segment_ids = PreparedStatement("allocate_segment_ids", """
+    select nextval('nimbusio_node.segment_id_seq')
+    from generate_series(1, $1)""")
+
+def _chunks(rows):
+    for i in range(0, len(rows), _max_rows_per_statement):
+        yield rows[i:i+_max_rows_per_statement]
+
+def _insert_rows(connection, table_name, columns, placeholders, rows):
+    """
+    insert rows (lists of values in column order) with multi-row inserts
+    """
+    for chunk in _chunks(rows):
+        args = list()
+        for row in chunk:
+            args.extend(row)
+        connection.execute("""
+            insert into nimbusio_node.{0} ({1}) values {2}
+        """.format(table_name,
+                   ", ".join(columns),
+                   ", ".join([placeholders] * len(chunk))), args)
+
+def _finalize_segment_rows(connection, rows):
+    """
+    set segment rows to 'F'inal, many at once
+    """
+    for chunk in _chunks(rows):
+        args = list()
+        for row in chunk:
+            args.extend(row)
+        connection.execute("""
+            update nimbusio_node.segment
+            set status = %s,
+                file_size = v.file_size,
+                file_adler32 = v.file_adler32,
+                file_hash = v.file_hash
+            from (values {0}) as v(id, file_size, file_adler32, file_hash)
+            where nimbusio_node.segment.id = v.id
+        """.format(", ".join([_segment_final_placeholders] * len(chunk))),
+        [segment_status_final, ] + args)
+
+class GroupCommit(object):
+    """
+    Hold the rows for new segments, segment sequences, finalized segments
+    and meta data until the caller flushes them, in a transaction, after
+    the value file is synced.
+    """
+    def __init__(self, connection):
+        self._log = logging.getLogger("GroupCommit")
+        self._connection = connection
+        self._segment_ids = deque()
+        self._segment_rows = list()
+        self._segment_sequence_rows = list()
+        self._segment_final_rows = list()
+        self._meta_rows = list()
+
+    @property
+    def pending_row_count(self):
+        return len(self._segment_rows) + \
+               len(self._segment_sequence_rows) + \
+               len(self._segment_final_rows) + \
+               len(self._meta_rows)
+
+    def next_segment_id(self):
+        """
+        return an id for a new segment row
+        """
+        if len(self._segment_ids) == 0:
+            rows = self._connection.fetch_all_rows_prepared(
+                _allocate_segment_ids, [_segment_id_block_size, ])
+            self._segment_ids.extend([segment_id for (segment_id, ) in rows])
+        return self._segment_ids.popleft()
+
+    def add_segment_row(self, segment_row_dict):
+        self._segment_rows.append(
+            [segment_row_dict[column] for column in _segment_columns]
+        )
+
+    def add_segment_sequence_row(self, segment_sequence_row):
+        self._segment_sequence_rows.append(
+            [getattr(segment_sequence_row, column) \
+             for column in _segment_sequence_columns]
+        )
+
+    def add_segment_final_row(self,
+                              segment_id,
+                              file_size,
+                              file_adler32,
+                              file_hash):
+        self._segment_final_rows.append(
+            [segment_id, file_size, file_adler32, file_hash, ]
+        )
+
+    def add_meta_row(self, meta_row):
+        self._meta_rows.append(
+            [getattr(meta_row, column) for column in _meta_columns]
+        )
+
+    def flush(self):
+        """
+        write all pending rows. The caller is responsible for the
+        transaction.
+        """
+        if self.pending_row_count == 0:
+            return
+
+        self._log.debug("{0} segments, {1} sequences, {2} final, " \
+                        "{3} meta".format(len(self._segment_rows),
+                                          len(self._segment_sequence_rows),
+                                          len(self._segment_final_rows),
+                                          len(self._meta_rows)))
+
+        # the order matters: a segment may be started and finished in the
+        # same sync
+        _insert_rows(self._connection,
+                     "segment",
+                     _segment_columns,
+                     _segment_placeholders,
+                     self._segment_rows)
+        _insert_rows(self._connection,
+                     "segment_sequence",
+                     _segment_sequence_columns,
+                     _segment_sequence_placeholders,
+                     self._segment_sequence_rows)
+        _finalize_segment_rows(self._connection, self._segment_final_rows)
+        _insert_rows(self._connection,
+                     "meta",
+                     _meta_columns,
+                     _meta_placeholders,
+                     self._meta_rows)
+
+        self._segment_rows = list()
+        self._segment_sequence_rows = list()
+        self._segment_final_rows = list()
+        self._meta_rows = list()
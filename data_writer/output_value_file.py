@@ -3,7 +3,22 @@
 output_value_file.py
 
 manage a single value file, while it is being written
+
+By default each sequence is written to the file as it arrives. With
+NIMBUSIO_VALUE_FILE_PREALLOCATE set, the file is instead grown with
+posix_fallocate, NIMBUSIO_VALUE_FILE_PREALLOCATE_SIZE bytes at a time, so
+it gets a few large extents. Sequences are gathered into os.writev calls
+of about NIMBUSIO_VALUE_FILE_WRITE_BUFFER_SIZE bytes, and the file is
+truncated to its real size on close. NIMBUSIO_VALUE_FILE_SYNC_FILE_RANGE
+also starts writeback after each writev, so the fsync at sync time has
+less to do.
+
+os.writev and os.posix_fallocate are new in Python 3.3. Under an older
+python the buffered sequences are written with os.write, one at a time,
+and the file is not preallocated.
 """
+import ctypes
+import ctypes.util
 import hashlib
 import logging
 import os
@@ -17,6 +32,48 @@ from tools.data_definitions import compute_value_file_path, \
 
 ENABLE_FSYNC = int(os.environ.get("NIMBUSIO_ENABLE_FSYNC", "1"))
 
+_preallocate = int(os.environ.get("NIMBUSIO_VALUE_FILE_PREALLOCATE", "0"))
+_preallocate_size = int(os.environ.get(
+    "NIMBUSIO_VALUE_FILE_PREALLOCATE_SIZE", str(64 * 1024 ** 2)))
+_write_buffer_size = int(os.environ.get(
+    "NIMBUSIO_VALUE_FILE_WRITE_BUFFER_SIZE", str(1024 ** 2)))
+_enable_sync_file_range = int(os.environ.get(
+    "NIMBUSIO_VALUE_FILE_SYNC_FILE_RANGE", "0"))
+
+_have_writev = hasattr(os, "writev")
+_have_posix_fallocate = hasattr(os, "posix_fallocate")
+
+# the most buffers writev will take at once (IOV_MAX)
+try:
+    _max_writev_buffers = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError):
+    _max_writev_buffers = 1024
+
+# from <fcntl.h>
+_sync_file_range_write = 2
+
+def _load_sync_file_range():
+    """
+    return libc sync_file_range, or None if we don't have it
+    """
+    library_path = ctypes.util.find_library("c")
+    if library_path is None:
+        return None
+    try:
+        sync_file_range = ctypes.CDLL(library_path, 
+                                      use_errno=True).sync_file_range
+    except (OSError, AttributeError):
+        return None
+    sync_file_range.argtypes = [ctypes.c_int, 
+                                ctypes.c_longlong, 
+                                ctypes.c_longlong, 
+                                ctypes.c_uint]
+    sync_file_range.restype = ctypes.c_int
+    return sync_file_range
+
+_sync_file_range = \
+    _load_sync_file_range() if _enable_sync_file_range else None
+
 def _insert_value_file_default_row(connection, space_id):
     # Ticket #1646: insert a row of defaults right at open
     value_file_id = connection.execute_and_return_id("""
@@ -62,8 +119,38 @@ def mark_value_files_as_closed(connection):
         where close_time is null
         """, [])
 
+def _write_all(fd, data):
+    """
+    write all of data: write may write less than we asked
+    """
+    data = memoryview(data)
+    while len(data) > 0:
+        bytes_written = os.write(fd, data)
+        data = data[bytes_written:]
+
+def _writev_all(fd, buffers):
+    """
+    write all the buffers: writev may write less than we asked
+    """
+    if not _have_writev:
+        for data in buffers:
+            _write_all(fd, data)
+        return
+
+    while len(buffers) > 0:
+        bytes_written = os.writev(fd, buffers[:_max_writev_buffers])
+        while len(buffers) > 0 and bytes_written >= len(buffers[0]):
+            bytes_written -= len(buffers[0])
+            buffers = buffers[1:]
+        if bytes_written > 0:
+            buffers[0] = memoryview(buffers[0])[bytes_written:]
+
 class OutputValueFile(object):
-    def __init__(self, connection, space_id, repository_path):
+    def __init__(self, 
+                 connection, 
+                 space_id, 
+                 repository_path, 
+                 preallocate=_preallocate):
         self._space_id = space_id
         self._value_file_id =  _insert_value_file_default_row(connection,
                                                               space_id)
@@ -83,6 +170,12 @@ class OutputValueFile(object):
         self._collection_ids = set()
         self._synced = True # treat as synced until we write
 
+        self._preallocate = preallocate
+        self._allocated_size = 0
+        self._write_buffers = list()
+        self._write_buffer_size = 0
+        self._written_size = 0
+
     @property
     def value_file_id(self):
         return self._value_file_id
@@ -95,7 +188,13 @@ class OutputValueFile(object):
         """
         write the data for one sequence
         """
-        os.write(self._value_file_fd, data)
+        if self._preallocate:
+            self._write_buffers.append(data)
+            self._write_buffer_size += len(data)
+            if self._write_buffer_size >= _write_buffer_size:
+                self._flush_write_buffers()
+        else:
+            os.write(self._value_file_fd, data)
         self._synced = False
 
         self._size += len(data)
@@ -116,10 +215,43 @@ class OutputValueFile(object):
         sync this file to disk (if neccessary)
         """
         if not self._synced:
+            self._flush_write_buffers()
             if ENABLE_FSYNC:
                 os.fsync(self._value_file_fd)
             self._synced = True
 
+    def _flush_write_buffers(self):
+        """
+        write out the sequences we have buffered, growing the file first
+        if we need to
+        """
+        if self._write_buffer_size == 0:
+            return
+
+        end_offset = self._written_size + self._write_buffer_size
+        if _have_posix_fallocate and end_offset > self._allocated_size:
+            allocate_size = max(_preallocate_size, 
+                                end_offset - self._allocated_size)
+            os.posix_fallocate(self._value_file_fd, 
+                               self._allocated_size, 
+                               allocate_size)
+            self._allocated_size += allocate_size
+
+        _writev_all(self._value_file_fd, self._write_buffers)
+
+        if _sync_file_range is not None:
+            result = _sync_file_range(self._value_file_fd, 
+                                      self._written_size,
+                                      self._write_buffer_size,
+                                      _sync_file_range_write)
+            if result != 0:
+                self._log.warn("sync_file_range failed: {0}".format(
+                    os.strerror(ctypes.get_errno())))
+
+        self._written_size = end_offset
+        self._write_buffers = list()
+        self._write_buffer_size = 0
+
     @property
     def is_synced(self):
         return self._synced
@@ -127,6 +259,10 @@ class OutputValueFile(object):
     def close(self):
         """close the file and make it visible in the database"""
         self.sync()
+        if self._allocated_size > self._size:
+            os.ftruncate(self._value_file_fd, self._size)
+            if ENABLE_FSYNC:
+                os.fsync(self._value_file_fd)
         os.close(self._value_file_fd)
 
         if self._segment_sequence_count == 0:
@@ -11,7 +11,6 @@ import psycopg2
 
 from tools.data_definitions import parse_timestamp_repr, \
         meta_row_template, \
-        segment_status_final, \
         nimbus_meta_prefix
 
 _sizeof_nimbus_meta_prefix = len(nimbus_meta_prefix)
@@ -27,83 +26,28 @@ def _extract_meta(message):
             meta_dict[converted_key] = message[key]
     return meta_dict
 
-def _finalize_segment_row(
-    connection, segment_id, file_size, file_adler32, file_hash, meta_rows
-):
-    """
-    Update segment row, set status to 'F'inal, include
-    associated meta rows
-    """
-    connection.execute("""
-        update nimbusio_node.segment 
-        set status = %(status)s,
-            file_size = %(file_size)s,
-            file_adler32 = %(file_adler32)s,
-            file_hash = %(file_hash)s
-        where id = %(segment_id)s
-    """, {
-        "segment_id"    : segment_id,
-        "status"        : segment_status_final,
-        "file_size"     : file_size,
-        "file_adler32"  : file_adler32,
-        "file_hash"     : psycopg2.Binary(file_hash),
-    })
-
-    for meta_row in meta_rows:
-        meta_row_dict = meta_row._asdict()
-        connection.execute("""
-            insert into nimbusio_node.meta (
-                collection_id,
-                segment_id,
-                meta_key,
-                meta_value,
-                timestamp
-            ) values (
-                %(collection_id)s,
-                %(segment_id)s,
-                %(meta_key)s,
-                %(meta_value)s,
-                %(timestamp)s::timestamp
-            )
-        """, meta_row_dict)            
-
-    # 2012-03-14 dougfort -- assume all completions are run in a
-    # transaction with the caller handling the database commit
-
 class PostSyncCompletion(object):
     """
     Actions to be taken to complete an archive after the last value file
     is fsync'd
     """
     def __init__(self, 
-                 connection,
                  reply_pusher,
                  active_segments,
                  archive_message, 
                  reply_message):
         self._log = logging.getLogger("PostSyncCompletion")
 
-        self._connection = connection
         self._reply_pusher = reply_pusher
         self._active_segments = active_segments
         self._archive_message = archive_message
         self._reply_message = reply_message
 
-    def pre_commit_process(self):
+    def pre_commit_process(self, group_commit):
         """
-        finalize the segment row
+        add the rows to finalize the segment to the group commit
         """
-        self._finish_new_segment(
-            self._archive_message["collection-id"], 
-            self._archive_message["unified-id"],
-            self._archive_message["timestamp-repr"],
-            self._archive_message["conjoined-part"],
-            self._archive_message["segment-num"],
-            self._archive_message["file-size"],
-            self._archive_message["file-adler32"],
-            b64decode(self._archive_message["file-hash"].encode("utf-8")),
-            _extract_meta(self._archive_message),
-        )
+        self._finish_archive(group_commit, self._archive_message)
 
     def post_commit_process(self):
         """
@@ -113,8 +57,23 @@ class PostSyncCompletion(object):
                        self._archive_message["user-request-id"]))
         self._reply_pusher.send(self._reply_message)
 
+    def _finish_archive(self, group_commit, archive_message):
+        self._finish_new_segment(
+            group_commit,
+            archive_message["collection-id"], 
+            archive_message["unified-id"],
+            archive_message["timestamp-repr"],
+            archive_message["conjoined-part"],
+            archive_message["segment-num"],
+            archive_message["file-size"],
+            archive_message["file-adler32"],
+            b64decode(archive_message["file-hash"].encode("utf-8")),
+            _extract_meta(archive_message),
+        )
+
     def _finish_new_segment(
         self, 
+        group_commit,
         collection_id,
         unified_id,
         timestamp_repr,
@@ -137,7 +96,13 @@ class PostSyncCompletion(object):
 
         timestamp = parse_timestamp_repr(timestamp_repr)
 
-        meta_rows = list()
+        # 2012-03-14 dougfort -- assume all completions are run in a
+        # transaction with the caller handling the database commit
+        group_commit.add_segment_final_row(segment_entry["segment-id"],
+                                           file_size,
+                                           file_adler32,
+                                           psycopg2.Binary(file_hash))
+
         for meta_key, meta_value in meta_dict.items():
             meta_row = meta_row_template(
                 collection_id=collection_id,
@@ -146,14 +111,38 @@ class PostSyncCompletion(object):
                 meta_value=meta_value,
                 timestamp=timestamp
             )
-            meta_rows.append(meta_row)
-
-        _finalize_segment_row(
-            self._connection, 
-            segment_entry["segment-id"],
-            file_size, 
-            file_adler32, 
-            file_hash, 
-            meta_rows
-        )
-    
+            group_commit.add_meta_row(meta_row)
+
+class PostSyncBatchCompletion(PostSyncCompletion):
+    """
+    Complete all the archives in an archive-key-entire-batch message, with
+    a single reply to the caller
+    """
+    def __init__(self, 
+                 reply_pusher,
+                 active_segments,
+                 archive_messages, 
+                 reply_message):
+        PostSyncCompletion.__init__(self,
+                                    reply_pusher,
+                                    active_segments,
+                                    None,
+                                    reply_message)
+        self._log = logging.getLogger("PostSyncBatchCompletion")
+        self._archive_messages = archive_messages
+
+    def pre_commit_process(self, group_commit):
+        """
+        add the rows to finalize the segments to the group commit
+        """
+        for archive_message in self._archive_messages:
+            self._finish_archive(group_commit, archive_message)
+
+    def post_commit_process(self):
+        """
+        send archive_key_entire_batch_reply message to the caller
+        """
+        self._log.info("request {0}: {1} archives".format(
+                       self._reply_message["user-request-id"],
+                       len(self._archive_messages)))
+        self._reply_pusher.send(self._reply_message)
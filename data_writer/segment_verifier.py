@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+segment_verifier.py
+
+Check incoming segment data against the size and md5 digest in its
+message.
+
+The data writer hands archive messages to a SegmentVerifier as they
+arrive, so the hashing runs in a small thread pool (hashlib releases the
+GIL for large buffers) while the message waits in its writer lane's
+queue. The writer thread gets the joined, verified data back.
+"""
+from base64 import b64decode
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+import hashlib
+
+segment_verification_template = namedtuple("SegmentVerification", [
+    "result",
+    "error_message",
+    "segment_data",
+    "segment_md5_digest",
+])
+
+batch_verification_template = namedtuple("BatchVerification", [
+    "result",
+    "error_message",
+    "archive_verifications",
+])
+
+_verified_message_types = set([
+    "archive-key-entire",
+    "archive-key-start",
+    "archive-key-next",
+    "archive-key-final",
+    "archive-key-entire-batch",
+])
+
+def _join_data(data):
+    # we expect a list of blocks, but if the data is smaller than
+    # block size, we get back a string
+    if data is None:
+        return b""
+    if type(data) != list:
+        return bytes(data)
+    return b"".join(data)
+
+def _verify_segment_data(message, segment_data):
+    if len(segment_data) != message["segment-size"]:
+        return segment_verification_template(
+            "size-mismatch",
+            "segment size does not match expected value",
+            None,
+            None)
+
+    expected_segment_md5_digest = b64decode(
+        message["segment-md5-digest"].encode("utf-8"))
+    if hashlib.md5(segment_data).digest() != expected_segment_md5_digest:
+        return segment_verification_template(
+            "md5-mismatch",
+            "segment md5 does not match expected value",
+            None,
+            None)
+
+    return segment_verification_template("success",
+                                         None,
+                                         segment_data,
+                                         expected_segment_md5_digest)
+
+def verify_segment(message, data):
+    """
+    return a segment_verification_template for the data of one sequence
+    """
+    return _verify_segment_data(message, _join_data(data))
+
+def verify_batch(message, data):
+    """
+    return a batch_verification_template for an archive-key-entire-batch
+    message, with a segment_verification_template for each archive
+    """
+    batch_data = _join_data(data)
+
+    batch_size = sum([archive["segment-size"] \
+                      for archive in message["archives"]])
+    if len(batch_data) != batch_size:
+        return batch_verification_template(
+            "size-mismatch",
+            "batch size does not match expected value",
+            None)
+
+    archive_verifications = list()
+    offset = 0
+    for archive in message["archives"]:
+        segment_data = batch_data[offset:offset+archive["segment-size"]]
+        offset += archive["segment-size"]
+        archive_verifications.append(
+            _verify_segment_data(archive, segment_data))
+
+    return batch_verification_template("success", None, archive_verifications)
+
+def verify_message(message, data):
+    """
+    verify the data for a message, which may already have been verified
+    by a SegmentVerifier
+    """
+    if isinstance(data, Future):
+        return data.result()
+    if message["message-type"] == "archive-key-entire-batch":
+        return verify_batch(message, data)
+    return verify_segment(message, data)
+
+class SegmentVerifier(object):
+    """
+    thread_count
+        the number of hashing threads
+    """
+    def __init__(self, thread_count):
+        self._executor = ThreadPoolExecutor(max_workers=thread_count)
+
+    def prepare(self, item):
+        """
+        start verifying the data of a (message, data) item from the
+        queue: return the item with a Future in place of the data
+        """
+        message, data = item
+        if message["message-type"] not in _verified_message_types:
+            return item
+        return (message, self._executor.submit(verify_message, 
+                                               message, 
+                                               data), )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
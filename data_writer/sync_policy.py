@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+sync_policy.py
+
+Decide when the writer thread should sync the output value file.
+
+Archives are not acknowledged until the value file holding their data has
+been fsync'd, so we sync as soon as there are completions waiting and the
+writer has caught up with its message queue. Under load the queue may
+never drain: then we let the completions pile up into one sync, for at
+most max_sync_delay seconds. Data with no completion waiting on it (the
+middle of a large archive) is synced within max_sync_delay.
+
+The fsyncs themselves are timed by the Writer, in the lane's
+WritePathStats; we add how long the work we sync has been waiting.
+"""
+import os
+import time
+
+_max_sync_delay = float(
+    os.environ.get("NIMBUSIO_DATA_WRITER_MAX_SYNC_DELAY", "1.0"))
+
+class SyncPolicy(object):
+    """
+    max_sync_delay
+        the longest we let unsynced work wait
+
+    write_path_stats
+        optional: the lane's WritePathStats, to record the sync delay
+    """
+    def __init__(self, max_sync_delay=_max_sync_delay, write_path_stats=None):
+        self._max_sync_delay = max_sync_delay
+        self._write_path_stats = write_path_stats
+        self._pending_since = None
+
+    def queue_timeout(self, default_timeout):
+        """
+        return how long the writer may wait for its next message
+        """
+        if self._pending_since is None:
+            return default_timeout
+        deadline = self._pending_since + self._max_sync_delay
+        return max(min(deadline - time.time(), default_timeout), 0.0)
+
+    def sync_due(self, completion_count, unsynced_work, queue_empty):
+        """
+        return True if the writer should sync now
+
+        completion_count
+            the number of completions waiting for a sync
+
+        unsynced_work
+            True if the writer has data or rows that are not yet synced
+
+        queue_empty
+            True if the writer has no more messages waiting
+        """
+        if completion_count == 0 and not unsynced_work:
+            self._pending_since = None
+            return False
+
+        current_time = time.time()
+        if self._pending_since is None:
+            self._pending_since = current_time
+
+        if completion_count > 0 and queue_empty:
+            return True
+
+        return current_time - self._pending_since >= self._max_sync_delay
+
+    def synced(self):
+        """
+        record that the writer has synced everything pending
+        """
+        if self._pending_since is not None and \
+           self._write_path_stats is not None:
+            self._write_path_stats.record_sync_delay(
+                time.time() - self._pending_since)
+        self._pending_since = None
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+write_path_stats.py
+
+class WritePathStats
+
+Where the time goes on one writer lane, as histograms:
+
+  <message-type>.queue      waiting in the lane queue
+  <message-type>.verify     waiting for the segment's data to be verified
+  <message-type>.write      writing the data to the value file
+  <message-type>.handle     the whole handler
+  sync.fsync                fsync of the value file
+  sync.commit               writing the rows and committing them
+  sync.delay                how long unsynced work waited for its sync
+
+plus the depth of the lane queue at each message, and the number of
+completions per sync.
+
+The writer thread publishes them every _reporting_interval, and then
+starts over. data_writer_main answers a data-writer-stats request on the
+anti-entropy socket with a snapshot of the current interval, so the stats
+are guarded by a lock.
+"""
+from collections import defaultdict
+import logging
+import threading
+import time
+
+from tools.histogram import Histogram, latency_bounds, count_bounds
+
+_reporting_interval = 60.0
+
+class WritePathStats(object):
+    """
+    lane_index
+        the writer lane we time
+
+    event_push_client
+        optional: used to publish the stats periodically
+    """
+    def __init__(self, lane_index, event_push_client=None):
+        self._log = logging.getLogger("WritePathStats-{0}".format(lane_index))
+        self._lane_index = lane_index
+        self._event_push_client = event_push_client
+        self._lock = threading.Lock()
+        self.message_type = None
+        self._reset(time.time())
+
+    def _reset(self, current_time):
+        self._interval_start = current_time
+        self._latency = defaultdict(lambda: Histogram(latency_bounds))
+        self._queue_depth = Histogram(count_bounds)
+        self._sync_batch_size = Histogram(count_bounds)
+
+    def start_message(self, message_type, queue_seconds, queue_depth):
+        """
+        record a message coming off the lane queue: later stages are
+        recorded against its message_type
+        """
+        with self._lock:
+            self.message_type = message_type
+            self._latency[message_type + ".queue"].add(queue_seconds)
+            self._queue_depth.add(queue_depth)
+
+    def record_stage(self, stage, seconds):
+        """
+        record a stage of the current message
+        """
+        with self._lock:
+            self._latency["{0}.{1}".format(self.message_type, stage)].add(
+                seconds)
+
+    def record_sync(self, fsync_seconds, commit_seconds, completion_count):
+        with self._lock:
+            self._latency["sync.fsync"].add(fsync_seconds)
+            self._latency["sync.commit"].add(commit_seconds)
+            self._sync_batch_size.add(completion_count)
+
+    def record_sync_delay(self, seconds):
+        with self._lock:
+            self._latency["sync.delay"].add(seconds)
+
+    def snapshot(self):
+        """
+        return the stats for the current interval as a dict that can be
+        sent as JSON
+        """
+        with self._lock:
+            return {
+                "lane"              : self._lane_index,
+                "interval-start"    : self._interval_start,
+                "latency"           : dict([(key, histogram.to_dict(), ) \
+                                       for key, histogram \
+                                       in self._latency.items()]),
+                "queue-depth"       : self._queue_depth.to_dict(),
+                "sync-batch-size"   : self._sync_batch_size.to_dict(),
+            }
+
+    def report_if_due(self):
+        """
+        publish the stats if the interval is over, and start a new interval
+        """
+        current_time = time.time()
+        if current_time - self._interval_start < _reporting_interval:
+            return
+
+        stats = self.snapshot()
+        with self._lock:
+            self._reset(current_time)
+
+        self._log.info("{0} messages, {1} syncs".format(
+            stats["queue-depth"]["count"], 
+            stats["sync-batch-size"]["count"]))
+        if self._event_push_client is not None:
+            self._event_push_client.info("data-writer-write-path-stats",
+                                         "data writer write path stats",
+                                         stats=stats)
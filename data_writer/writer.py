@@ -6,6 +6,8 @@ Manage writing segment values to disk
 """
 import logging
 import os
+import time
+
 import psycopg2
 
 from tools.data_definitions import segment_sequence_template, \
@@ -14,6 +16,7 @@ from tools.data_definitions import segment_sequence_template, \
         segment_status_tombstone
 from tools.file_space import find_least_volume_space_id
 from data_writer.output_value_file import OutputValueFile
+from data_writer.group_commit import GroupCommit
 
 _max_value_file_size = int(os.environ.get(
     "NIMBUS_IO_MAX_VALUE_FILE_SIZE", str(1024 * 1024 * 1024))
@@ -71,54 +74,6 @@ def _set_conjoined_complete_timestamp(connection, conjoined_dict):
             and handoff_node_id = %(handoff_node_id)s
             """, conjoined_dict) 
 
-def _insert_new_segment_row(
-    connection,
-    collection_id, 
-    unified_id,
-    key, 
-    timestamp, 
-    conjoined_part,
-    segment_num,
-    source_node_id,
-    handoff_node_id
-):
-    """
-    Insert a new segment row in 'A'ctive status and return the id
-    """
-    return connection.execute_and_return_id("""
-        insert into nimbusio_node.segment (
-            collection_id,
-            key,
-            status,
-            unified_id,
-            timestamp,
-            segment_num,
-            conjoined_part,
-            source_node_id,
-            handoff_node_id
-        ) values (
-            %(collection_id)s,
-            %(key)s,
-            %(status)s,
-            %(unified_id)s,
-            %(timestamp)s::timestamp,
-            %(segment_num)s,
-            %(conjoined_part)s,
-            %(source_node_id)s,
-            %(handoff_node_id)s
-        ) returning id""", {
-            "collection_id"         : collection_id,
-            "key"                   : key,
-            "status"                : segment_status_active,
-            "unified_id"            : unified_id,
-            "timestamp"             : timestamp,
-            "conjoined_part"        : conjoined_part,
-            "segment_num"           : segment_num,
-            "source_node_id"        : source_node_id,
-            "handoff_node_id"       : handoff_node_id,
-        }
-    )
-
 def _insert_segment_tombstone_row(
     connection,
     collection_id, 
@@ -217,34 +172,6 @@ def _cancel_segment_row(connection, unified_id, conjoined_part, segment_num):
               "conjoined_part"   : conjoined_part,
               "segment_num"      : segment_num})
 
-def _insert_segment_sequence_row(connection, segment_sequence_row):
-    """
-    Insert one segment_sequence entry
-    """
-    connection.execute("""
-        insert into nimbusio_node.segment_sequence (
-            "collection_id",
-            "segment_id",
-            "zfec_padding_size",
-            "value_file_id",
-            "sequence_num",
-            "value_file_offset",
-            "size",
-            "hash",
-            "adler32"
-        ) values (
-            %(collection_id)s,
-            %(segment_id)s,
-            %(zfec_padding_size)s,
-            %(value_file_id)s,
-            %(sequence_num)s,
-            %(value_file_offset)s,
-            %(size)s,
-            %(hash)s,
-            %(adler32)s
-        )
-    """, segment_sequence_row._asdict())
-
 def _get_segment_id(connection, collection_id, key, timestamp, segment_num): 
     result = connection.fetch_one_row(""" 
         select id from nimbusio_node.segment
@@ -266,7 +193,9 @@ class Writer(object):
                  file_space_info, 
                  repository_path, 
                  active_segments, 
-                 completions
+                 completions,
+                 space_id=None,
+                 write_path_stats=None
     ):
         self._log = logging.getLogger("Writer")
         self._connection = connection
@@ -274,14 +203,23 @@ class Writer(object):
         self._repository_path = repository_path
         self._active_segments = active_segments
         self._completions = completions
-        
-        space_id = find_least_volume_space_id("journal", self._file_space_info)
+        # if we are one of several writer lanes, we keep to one journal
+        self._space_id = space_id
+        self._write_path_stats = write_path_stats
 
+        # segment, sequence and meta rows wait here for the next sync
+        self._group_commit = GroupCommit(connection)
+        
         # open a new value file at startup
         self._value_file = OutputValueFile(self._connection, 
-                                           space_id, 
+                                           self._journal_space_id(), 
                                            self._repository_path)
 
+    def _journal_space_id(self):
+        if self._space_id is not None:
+            return self._space_id
+        return find_least_volume_space_id("journal", self._file_space_info)
+
     @property
     def value_file_hash(self):
         """
@@ -295,24 +233,36 @@ class Writer(object):
         sync the current value file
         """
         assert self._value_file is not None
+        start_time = time.time()
         self._value_file.sync()
+        fsync_seconds = time.time() - start_time
 
         # Ticket #70 Data writer causes "already a transaction in progress" 
         # warning in the PostgreSQL log
-        if len(self._completions) == 0:
+        if len(self._completions) == 0 and \
+           self._group_commit.pending_row_count == 0:
+            if self._write_path_stats is not None:
+                self._write_path_stats.record_sync(fsync_seconds, 0.0, 0)
             return
 
-        # at this point we can complete all pending archives
+        # at this point we can write the rows for everything in the value
+        # file, and complete all pending archives, in one transaction
 
+        start_time = time.time()
         self._connection.begin_transaction()
         try:
             for completion in self._completions:
-                completion.pre_commit_process()
+                completion.pre_commit_process(self._group_commit)
+            self._group_commit.flush()
         except Exception:
             self._log.exception("sync_value_file")
             self._connection.rollback()
             raise
         self._connection.commit()
+        if self._write_path_stats is not None:
+            self._write_path_stats.record_sync(fsync_seconds,
+                                               time.time() - start_time,
+                                               len(self._completions))
 
         for completion in self._completions:
             completion.post_commit_process()
@@ -324,6 +274,14 @@ class Writer(object):
         assert self._value_file is not None
         return self._value_file.is_synced 
 
+    @property
+    def has_unsynced_work(self):
+        """
+        True if there is data or rows waiting for sync_value_file
+        """
+        return not self.value_file_is_synced or \
+               self._group_commit.pending_row_count > 0
+
     def close(self):
         assert self._value_file is not None
         self.sync_value_file()
@@ -361,16 +319,23 @@ class Writer(object):
 
         timestamp = parse_timestamp_repr(timestamp_repr)
 
+        # the row is written at the next sync, but we know its id now
+        segment_id = self._group_commit.next_segment_id()
+        self._group_commit.add_segment_row({
+            "id"                    : segment_id,
+            "collection_id"         : collection_id,
+            "key"                   : key,
+            "status"                : segment_status_active,
+            "unified_id"            : unified_id,
+            "timestamp"             : timestamp,
+            "conjoined_part"        : conjoined_part,
+            "segment_num"           : segment_num,
+            "source_node_id"        : source_node_id,
+            "handoff_node_id"       : handoff_node_id,
+        })
+
         self._active_segments[segment_key] = {
-            "segment-id" : _insert_new_segment_row(self._connection,
-                                                   collection_id, 
-                                                   unified_id,
-                                                   key, 
-                                                   timestamp, 
-                                                   conjoined_part,
-                                                   segment_num,
-                                                   source_node_id,
-                                                   handoff_node_id),
+            "segment-id" : segment_id,
         }
 
     def store_sequence(
@@ -409,10 +374,8 @@ class Writer(object):
         # start a new output value file
         if self._value_file.size + segment_size > _max_value_file_size:
             self._value_file.close()
-            space_id = find_least_volume_space_id("journal",
-                                                  self._file_space_info)
             self._value_file = OutputValueFile(self._connection, 
-                                               space_id,
+                                               self._journal_space_id(),
                                                self._repository_path)
 
         segment_sequence_row = segment_sequence_template(
@@ -427,11 +390,15 @@ class Writer(object):
             adler32=segment_adler32,
         )
 
+        start_time = time.time()
         self._value_file.write_data_for_one_sequence(
             collection_id, segment_entry["segment-id"], data
         )
+        if self._write_path_stats is not None:
+            self._write_path_stats.record_stage("write", 
+                                                time.time() - start_time)
 
-        _insert_segment_sequence_row(self._connection, segment_sequence_row)
+        self._group_commit.add_segment_sequence_row(segment_sequence_row)
 
     def set_tombstone(
         self, 
@@ -468,6 +435,8 @@ class Writer(object):
            * with a timestamp earlier than the specified time. 
         This is triggered by a web server restart
         """
+        # write any segment rows we are holding, so they get canceled too
+        self.sync_value_file()
         _cancel_segment_rows(self._connection, source_node_id, timestamp)
 
     def cancel_active_archive(self, 
@@ -490,7 +459,9 @@ class Writer(object):
             self._active_segments.pop(segment_key)
         except KeyError:
             pass
-        
+
+        # write any segment rows we are holding, so they get canceled too
+        self.sync_value_file()
         _cancel_segment_row(self._connection, 
                             unified_id, 
                             conjoined_part, 
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+writer_lanes.py
+
+class WriterLanes
+
+Spread incoming messages across several writer threads (lanes), each with
+its own value file on its own journal file space.
+
+All the messages for one segment (archive-key-start, next, final and
+cancel) go to the same lane, so its sequences are stored in order.
+web-writer-start goes to every lane, because any lane may hold active
+archives from that web writer.
+
+If we have a SegmentVerifier, archive data is verified in its pool while
+the message waits in the lane's queue.
+"""
+import queue
+import time
+
+_broadcast_message_types = set(["web-writer-start", ])
+
+def _lane_key(message):
+    """
+    return a key which is the same for every message about one segment
+    """
+    if message["message-type"] == "archive-key-entire-batch":
+        message = message["archives"][0]
+
+    if "unified-id" not in message:
+        return None
+
+    return (message["unified-id"], 
+            message.get("conjoined-part"), 
+            message.get("segment-num"), )
+
+class WriterLanes(object):
+    """
+    lane_count
+        the number of writer threads, each reading from one of our queues
+
+    segment_verifier
+        optional: a SegmentVerifier to start verifying archive data
+
+    This takes the place of the writer thread's message queue for the
+    servers, which call 'append'. Our queues hold (message, data,
+    queued_time) so the writer can time how long a message waited.
+    """
+    def __init__(self, lane_count, segment_verifier=None):
+        self.queues = [queue.Queue() for _ in range(lane_count)]
+        self._segment_verifier = segment_verifier
+
+    def lane_index(self, message):
+        """
+        return the index of the lane that handles this message
+        """
+        key = _lane_key(message)
+        if key is None:
+            return 0
+        return hash(key) % len(self.queues)
+
+    def append(self, item):
+        message, _data = item
+        queued_time = time.time()
+        if message["message-type"] in _broadcast_message_types:
+            for lane_queue in self.queues:
+                lane_queue.put(item + (queued_time, ))
+            return
+
+        if self._segment_verifier is not None:
+            item = self._segment_verifier.prepare(item)
+        self.queues[self.lane_index(message)].put(item + (queued_time, ))
@@ -12,21 +12,22 @@ sends message to the database server to record key as stored.
 ACK back to to requestor includes size (from the database server)
 of any previous key this key supersedes (for space accounting.)
 """
-from base64 import b64decode
-import hashlib
 import logging
 import os
 import queue
 from threading import Thread
 import sys
+import time
 
-from tools.file_space import load_file_space_info, file_space_sanity_check
+from tools.file_space import load_file_space_info
 from tools.database_connection import get_node_local_connection
 from tools.data_definitions import parse_timestamp_repr
 
-from data_writer.output_value_file import mark_value_files_as_closed
 from data_writer.writer import Writer
-from data_writer.post_sync_completion import PostSyncCompletion
+from data_writer.sync_policy import SyncPolicy
+from data_writer.segment_verifier import verify_message
+from data_writer.post_sync_completion import PostSyncCompletion, \
+        PostSyncBatchCompletion
 
 _repository_path = os.environ["NIMBUSIO_REPOSITORY_PATH"]
 _queue_timeout = 1.0
@@ -35,8 +36,15 @@ class WriterThread(Thread):
     """
     manage writes to filesystem
     """
-    def __init__(self, halt_event, node_id_dict, message_queue, push_client):
-        Thread.__init__(self, name="WriterThread")
+    def __init__(self, 
+                 halt_event, 
+                 node_id_dict, 
+                 message_queue, 
+                 push_client,
+                 write_path_stats,
+                 lane_index=0,
+                 space_id=None):
+        Thread.__init__(self, name="WriterThread-{0}".format(lane_index))
         self._halt_event = halt_event
         self._node_id_dict = node_id_dict
         self._message_queue = message_queue
@@ -45,10 +53,14 @@ class WriterThread(Thread):
         self._completions = list()
         self._writer = None
         self._reply_pusher = push_client
-
+        self._space_id = space_id
+        self._write_path_stats = write_path_stats
+        self._sync_policy = SyncPolicy(write_path_stats=write_path_stats)
 
         self._dispatch_table = {
             "archive-key-entire"        : self._handle_archive_key_entire,
+            "archive-key-entire-batch"  : \
+                self._handle_archive_key_entire_batch,
             "archive-key-start"         : self._handle_archive_key_start,
             "archive-key-next"          : self._handle_archive_key_next,
             "archive-key-final"         : self._handle_archive_key_final,
@@ -58,7 +70,6 @@ class WriterThread(Thread):
             "abort-conjoined-archive"   : self._handle_abort_conjoined_archive,
             "finish-conjoined-archive"  : self._handle_finish_conjoined_archive,
             "web-writer-start"          : self._handle_web_writer_start,
-            "sync-value-file"           : self._handle_sync_value_file,
         }
 
     def run(self):
@@ -78,27 +89,42 @@ class WriterThread(Thread):
 
         log.debug("thread starts")
 
+        # data_writer_main has done the sanity check, and closed any
+        # value files left open, before starting the writer lanes
         file_space_info = load_file_space_info(self._database_connection)
-        file_space_sanity_check(file_space_info, _repository_path)
-
-        # Ticket #1646 mark output value files as closed at startup
-        mark_value_files_as_closed(self._database_connection)
 
         self._writer = Writer(self._database_connection,
                              file_space_info,
                              _repository_path,
                              self._active_segments,
-                             self._completions)
+                             self._completions,
+                             space_id=self._space_id,
+                             write_path_stats=self._write_path_stats)
 
         log.debug("start halt_event loop")
         while not self._halt_event.is_set():
             try:
-                message, data = self._message_queue.get(block=True,
-                                                        timeout=_queue_timeout)
+                message, data, queued_time = self._message_queue.get(
+                    block=True,
+                    timeout=self._sync_policy.queue_timeout(_queue_timeout))
             except queue.Empty:
                 pass
             else:
+                start_time = time.time()
+                self._write_path_stats.start_message(
+                    message["message-type"], 
+                    start_time - queued_time,
+                    self._message_queue.qsize())
                 self._dispatch_table[message["message-type"]](message, data)
+                self._write_path_stats.record_stage("handle",
+                                                    time.time() - start_time)
+
+            if self._sync_policy.sync_due(len(self._completions),
+                                          self._writer.has_unsynced_work,
+                                          self._message_queue.empty()):
+                self._sync_value_file()
+
+            self._write_path_stats.report_if_due()
         log.debug("end halt_event loop")
 
         # 2012-03-27 dougfort -- we stop the data writer first because it is
@@ -139,45 +165,22 @@ class WriterThread(Thread):
             "error-message"     : None,
         }
 
-        # we expect a list of blocks, but if the data is smaller than
-        # block size, we get back a string
-        if type(data) != list:
-            data = [data, ]
-
-        segment_data = b"".join(data)
-
-        if len(segment_data) != message["segment-size"]:
-            error_message = "size mismatch ({0} != {1}) {2} {3} {4} {5}".format(
-                len(segment_data),
-                message["segment-size"],
+        verification = self._verify(message, data)
+        if verification.result != "success":
+            log.error("request {0}: {1} {2} {3} {4} {5}".format(
+                message["user-request-id"],
+                verification.result,
                 message["collection-id"],
                 message["key"],
                 message["timestamp-repr"],
-                message["segment-num"])
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "size-mismatch"
-            reply["error-message"] = \
-                "segment size does not match expected value"
+                message["segment-num"]))
+            reply["result"] = verification.result
+            reply["error-message"] = verification.error_message
             self._reply_pusher.send(reply)
             return
 
-        expected_segment_md5_digest = b64decode(
-            message["segment-md5-digest"].encode("utf-8"))
-        segment_md5 = hashlib.md5()
-        segment_md5.update(segment_data)
-        if segment_md5.digest() != expected_segment_md5_digest:
-            error_message = "md5 mismatch {0} {1} {2} {3}".format(
-                message["collection-id"],
-                message["key"],
-                message["timestamp-repr"],
-                message["segment-num"])
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "md5-mismatch"
-            reply["error-message"] = "segment md5 does not match expected value"
-            self._reply_pusher.send(reply)
-            return
+        segment_data = verification.segment_data
+        expected_segment_md5_digest = verification.segment_md5_digest
 
         source_node_id = self._node_id_dict[message["source-node-name"]]
         if message["handoff-node-name"] is None:
@@ -217,13 +220,133 @@ class WriterThread(Thread):
         # we don't send the reply until all value file dependencies have
         # been synced
         self._completions.append(
-            PostSyncCompletion(self._database_connection,
-                               self._reply_pusher,
+            PostSyncCompletion(self._reply_pusher,
                                self._active_segments,
                                message,
                                reply)
         )
 
+    def _handle_archive_key_entire_batch(self, message, data):
+        """
+        store many small archives, each as if it were an archive-key-entire
+        message, in one database transaction. The reply carries a result
+        for each archive.
+        """
+        log = logging.getLogger("_handle_archive_key_entire_batch")
+        log.info("request {0}: {1} archives".format(
+            message["user-request-id"],
+            len(message["archives"])))
+
+        reply = {
+            "message-type"      : "archive-key-entire-batch-reply",
+            "client-tag"        : message["client-tag"],
+            "client-address"    : message["client-address"],
+            "user-request-id"   : message["user-request-id"],
+            "message-id"        : message["message-id"],
+            "result"            : None,
+            "error-message"     : None,
+            "results"           : list(),
+        }
+
+        # the segments of all the archives, one after the other
+        batch_verification = self._verify(message, data)
+        if batch_verification.result != "success":
+            log.error("request {0}: {1}".format(message["user-request-id"],
+                                                batch_verification.result))
+            reply["result"] = batch_verification.result
+            reply["error-message"] = batch_verification.error_message
+            self._reply_pusher.send(reply)
+            return
+
+        valid_archives = list()
+        for archive, verification in zip(
+            message["archives"], batch_verification.archive_verifications
+        ):
+            archive_reply = {
+                "message-type"      : "archive-key-final-reply",
+                "user-request-id"   : archive["user-request-id"],
+                "result"            : None,
+                "error-message"     : None,
+            }
+            reply["results"].append(archive_reply)
+
+            if verification.result != "success":
+                log.error("request {0}: {1} {2} {3} {4} {5}".format(
+                    archive["user-request-id"],
+                    verification.result,
+                    archive["collection-id"],
+                    archive["key"],
+                    archive["timestamp-repr"],
+                    archive["segment-num"]))
+                archive_reply["result"] = verification.result
+                archive_reply["error-message"] = verification.error_message
+                continue
+
+            segment_data = verification.segment_data
+            expected_segment_md5_digest = verification.segment_md5_digest
+
+            valid_archives.append(
+                (archive, segment_data, expected_segment_md5_digest, 
+                 archive_reply, )
+            )
+
+        reply["result"] = "success"
+
+        if len(valid_archives) == 0:
+            self._reply_pusher.send(reply)
+            return
+
+        # the rows are written with the next value file sync
+        for archive, segment_data, segment_md5_digest, _ in \
+            valid_archives:
+            source_node_id = self._node_id_dict[archive["source-node-name"]]
+            if archive["handoff-node-name"] is None:
+                handoff_node_id = None
+            else:
+                handoff_node_id = \
+                    self._node_id_dict[archive["handoff-node-name"]]
+
+            self._writer.start_new_segment(
+                archive["collection-id"],
+                archive["key"],
+                archive["unified-id"],
+                archive["timestamp-repr"],
+                archive["conjoined-part"],
+                archive["segment-num"],
+                source_node_id,
+                handoff_node_id,
+                archive["user-request-id"]
+            )
+
+            self._writer.store_sequence(
+                archive["collection-id"],
+                archive["key"],
+                archive["unified-id"],
+                archive["timestamp-repr"],
+                archive["conjoined-part"],
+                archive["segment-num"],
+                archive["segment-size"],
+                archive["zfec-padding-size"],
+                segment_md5_digest,
+                archive["segment-adler32"],
+                0,
+                segment_data,
+                archive["user-request-id"]
+            )
+
+        for _, _, _, archive_reply in valid_archives:
+            archive_reply["result"] = "success"
+
+        # we don't send the reply until all value file dependencies have
+        # been synced
+        self._completions.append(
+            PostSyncBatchCompletion(self._reply_pusher,
+                                    self._active_segments,
+                                    [archive for archive, _, _, _ \
+                                     in valid_archives],
+                                    reply)
+        )
+
     def _handle_archive_key_start(self, message, data):
         log = logging.getLogger("_handle_archive_key_start")
         log.info("request {0}: {1} {2} {3} {4}".format(
@@ -243,45 +366,22 @@ class WriterThread(Thread):
             "error-message"     : None,
         }
 
-        # we expect a list of blocks, but if the data is smaller than
-        # block size, we get back a string
-        if type(data) != list:
-            data = [data, ]
-
-        segment_data = b"".join(data)
-
-        if len(segment_data) != message["segment-size"]:
-            error_message = "size mismatch ({0} != {1}) {2} {3} {4} {5}".format(
-                len(segment_data),
-                message["segment-size"],
+        verification = self._verify(message, data)
+        if verification.result != "success":
+            log.error("request {0}: {1} {2} {3} {4} {5}".format(
+                message["user-request-id"],
+                verification.result,
                 message["collection-id"],
                 message["key"],
                 message["timestamp-repr"],
-                message["segment-num"])
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "size-mismatch"
-            reply["error-message"] = \
-                "segment size does not match expected value"
+                message["segment-num"]))
+            reply["result"] = verification.result
+            reply["error-message"] = verification.error_message
             self._reply_pusher.send(reply)
             return
 
-        expected_segment_md5_digest = b64decode(
-            message["segment-md5-digest"].encode("utf-8"))
-        segment_md5 = hashlib.md5()
-        segment_md5.update(segment_data)
-        if segment_md5.digest() != expected_segment_md5_digest:
-            error_message = "md5 mismatch {0} {1} {2} {3}".format(
-                message["collection-id"],
-                message["key"],
-                message["timestamp-repr"],
-                message["segment-num"])
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "md5-mismatch"
-            reply["error-message"] = "segment md5 does not match expected value"
-            self._reply_pusher.send(reply)
-            return
+        segment_data = verification.segment_data
+        expected_segment_md5_digest = verification.segment_md5_digest
 
         source_node_id = self._node_id_dict[message["source-node-name"]]
         if message["handoff-node-name"] is None:
@@ -339,47 +439,22 @@ class WriterThread(Thread):
             "error-message"     : None,
         }
 
-        # we expect a list of blocks, but if the data is smaller than
-        # block size, we get back a string
-        if type(data) != list:
-            data = [data, ]
-
-        segment_data = b"".join(data)
-
-        if len(segment_data) != message["segment-size"]:
-            error_message = "size mismatch ({0} != {1}) {2} {3} {4} {5}".format(
-                len(segment_data),
-                message["segment-size"],
+        verification = self._verify(message, data)
+        if verification.result != "success":
+            log.error("request {0}: {1} {2} {3} {4} {5}".format(
+                message["user-request-id"],
+                verification.result,
                 message["collection-id"],
                 message["key"],
                 message["timestamp-repr"],
-                message["segment-num"]
-            )
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "size-mismatch"
-            reply["error-message"] = \
-                "segment size does not match expected value"
+                message["segment-num"]))
+            reply["result"] = verification.result
+            reply["error-message"] = verification.error_message
             self._reply_pusher.send(reply)
             return
 
-        expected_segment_md5_digest = b64decode(
-            message["segment-md5-digest"].encode("utf-8"))
-        segment_md5 = hashlib.md5()
-        segment_md5.update(segment_data)
-        if segment_md5.digest() != expected_segment_md5_digest:
-            error_message = "md5 mismatch {0} {1} {2} {3}".format(
-                message["collection-id"],
-                message["key"],
-                message["timestamp-repr"],
-                message["segment-num"]
-            )
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "md5-mismatch"
-            reply["error-message"] = "segment md5 does not match expected value"
-            self._reply_pusher.send(reply)
-            return
+        segment_data = verification.segment_data
+        expected_segment_md5_digest = verification.segment_md5_digest
 
         self._writer.store_sequence(
             message["collection-id"],
@@ -420,45 +495,22 @@ class WriterThread(Thread):
             "error-message"     : None,
         }
 
-        # we expect a list of blocks, but if the data is smaller than
-        # block size, we get back a string
-        if type(data) != list:
-            data = [data, ]
-
-        segment_data = b"".join(data)
-
-        if len(segment_data) != message["segment-size"]:
-            error_message = "size mismatch ({0} != {1}) {2} {3} {4} {4}".format(
-                len(segment_data),
-                message["segment-size"],
+        verification = self._verify(message, data)
+        if verification.result != "success":
+            log.error("request {0}: {1} {2} {3} {4} {5}".format(
+                message["user-request-id"],
+                verification.result,
                 message["collection-id"],
                 message["key"],
                 message["timestamp-repr"],
-                message["segment-num"])
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "size-mismatch"
-            reply["error-message"] = \
-                "segment size does not match expected value"
+                message["segment-num"]))
+            reply["result"] = verification.result
+            reply["error-message"] = verification.error_message
             self._reply_pusher.send(reply)
             return
 
-        expected_segment_md5_digest = b64decode(
-            message["segment-md5-digest"].encode("utf-8"))
-        segment_md5 = hashlib.md5()
-        segment_md5.update(segment_data)
-        if segment_md5.digest() != expected_segment_md5_digest:
-            error_message = "md5 mismatch {0} {1} {2} {3}".format(
-                message["collection-id"],
-                message["key"],
-                message["timestamp-repr"],
-                message["segment-num"])
-            log.error("request {0}: {1}".format(message["user-request-id"],
-                                                error_message))
-            reply["result"] = "md5-mismatch"
-            reply["error-message"] = "segment md5 does not match expected value"
-            self._reply_pusher.send(reply)
-            return
+        segment_data = verification.segment_data
+        expected_segment_md5_digest = verification.segment_md5_digest
 
         self._writer.store_sequence(
             message["collection-id"],
@@ -480,8 +532,7 @@ class WriterThread(Thread):
         # we don't send the reply until all value file dependencies have
         # been synced
         self._completions.append(
-            PostSyncCompletion(self._database_connection,
-                               self._reply_pusher,
+            PostSyncCompletion(self._reply_pusher,
                                self._active_segments,
                                message,
                                reply)
@@ -662,5 +713,12 @@ class WriterThread(Thread):
             source_node_id, timestamp
         )
 
-    def _handle_sync_value_file(self, _message, _data):
+    def _verify(self, message, data):
+        start_time = time.time()
+        verification = verify_message(message, data)
+        self._write_path_stats.record_stage("verify", time.time() - start_time)
+        return verification
+
+    def _sync_value_file(self):
         self._writer.sync_value_file()
+        self._sync_policy.synced()
@@ -14,13 +14,15 @@ from threading import Event
 import zmq
 
 from tools.standard_logging import initialize_logging
-from tools.database_connection import get_node_local_connection
+from tools.database_connection import get_node_local_connection, \
+        PreparedStatement
 from tools.event_push_client import EventPushClient, unhandled_exception_topic
 from tools.data_definitions import value_file_template
 from tools.file_space import load_file_space_info, \
         file_space_sanity_check, \
         find_least_volume_space_id
 from tools.output_value_file import OutputValueFile
+from tools.sequence_row_invalidation import invalidate_value_files
 from tools.process_util import set_signal_handler
 
 from defragger.input_value_file import InputValueFile
@@ -42,6 +44,13 @@ _max_value_file_size = int(os.environ.get(
     "NIMBUS_IO_MAX_VALUE_FILE_SIZE", str(1024 * 1024 * 1024))
 )
 
+_update_segment_sequence_location = PreparedStatement(
+    "update_segment_sequence_location", """
+    update nimbusio_node.segment_sequence
+    set value_file_id = $1, value_file_offset = $2
+    where collection_id = $3 and segment_id = $4
+    and sequence_num = $5""")
+
 _reference_template = namedtuple("Reference", [
     "segment_id",
     "handoff_node_id",
@@ -305,16 +314,15 @@ def _defrag_pass(connection, file_space_info, event_push_client):
         bytes_defragged += reference.sequence_size
 
         # adjust segment_sequence row
-        connection.execute("""
-            update nimbusio_node.segment_sequence
-            set value_file_id = %s, value_file_offset = %s
-            where collection_id = %s and segment_id = %s
-            and sequence_num = %s
-        """, [output_value_file.value_file_id, 
-              new_value_file_offset,
-              reference.collection_id,
-              reference.segment_id,
-              reference.sequence_num])
+        connection.execute_prepared(_update_segment_sequence_location,
+                                    [output_value_file.value_file_id, 
+                                     new_value_file_offset,
+                                     reference.collection_id,
+                                     reference.segment_id,
+                                     reference.sequence_num])
+
+    # tell the retrieve source to forget where these sequences were
+    invalidate_value_files(connection, input_value_files.keys())
 
     # close (and remove) the old value files
     for input_value_file in input_value_files.values():
@@ -2,6 +2,7 @@
 """
 archiver
 """
+from tools.sequence_row_invalidation import invalidate_all
 
 _create_temp_table = """
 drop table if exists nimbusio_collectable_segments;
@@ -76,6 +77,7 @@ def _archive_collectable_segment_rows(
 
     # now delete from segment_sequences (they are not archived)
     connection.execute(_delete_segment_sequences, [])
+    invalidate_all(connection)
 
     # finally clean out old tombstones
     connection.execute(_archive_old_tombstones, 
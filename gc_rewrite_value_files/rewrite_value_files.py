@@ -13,6 +13,7 @@ from tools.file_space import load_file_space_info, \
                              file_space_sanity_check, \
                              find_least_volume_space_id
 from tools.output_value_file import OutputValueFile
+from tools.sequence_row_invalidation import invalidate_value_files
 
 _max_value_file_size = int(os.environ.get(
     "NIMBUS_IO_MAX_VALUE_FILE_SIZE", str(1024 ** 3))
@@ -119,6 +120,11 @@ def _process_batch(connection, repository_path, refs, value_file_data):
               ref.segment_id,
               ref.sequence_num])
 
+    # tell the retrieve source to forget where these sequences were
+    invalidate_value_files(connection, 
+                           [value_file_id \
+                            for value_file_id, _ in value_file_data.keys()])
+
     # heave all the old value files from the database
     for value_file_id, _space_id in value_file_data.keys():
         connection.execute("""
@@ -21,23 +21,34 @@ from tools.process_util import identify_program_dir, \
         poll_subprocess, \
         terminate_subprocess
 from tools.event_push_client import EventPushClient, unhandled_exception_topic
+from tools.database_connection import get_node_local_connection
+from tools.sequence_row_invalidation import sequence_row_channel, \
+        parse_invalidation
 from tools.data_definitions import encoded_block_slice_size
 from tools.zeromq_util import PollError, \
         is_interrupted_system_call
 
 from retrieve_source.internal_sockets import db_controller_pull_socket_uri, \
         db_controller_router_socket_uri, \
+        db_controller_read_ahead_pull_socket_uri, \
         io_controller_pull_socket_uri
+from retrieve_source.read_ahead import ReadAhead
+from retrieve_source.sequence_row_cache import SequenceRowCache, \
+        sequence_row_cache_key
 
 _resources_tuple = namedtuple("Resources", 
                               ["halt_event",
                                "zeromq_context",
                                "reply_push_sockets",
                                "pull_socket",
+                               "read_ahead_pull_socket",
                                "io_controller_push_socket",
                                "router_socket",
                                "event_push_client",
                                "active_retrieves",
+                               "cancelled_retrieves",
+                               "read_ahead",
+                               "sequence_row_cache",
                                "pending_work_queue",
                                "available_ident_queue",])
 
@@ -47,6 +58,8 @@ _retrieve_state_tuple = namedtuple("RetrieveState",
                                     "sequence_end",
                                     "left_offset",
                                     "right_offset",
+                                    "read_ahead_credit",
+                                    "read_ahead_index",
                                     "timestamp", ])
 
 _local_node_name = os.environ["NIMBUSIO_NODE_NAME"]
@@ -54,6 +67,10 @@ _log_path_template = "{0}/nimbusio_rs_db_pool_controller_{1}.log"
 _worker_count = int(os.environ.get("NIMBUSIO_RETRIEVE_DB_POOL_COUNT", "2"))
 _poll_timeout = 3000 # milliseconds
 _reporting_interval = 60.0
+# we drop the state of a retrieve that the client hasn't touched for this
+# long: it has given up, or moved on without telling us
+_retrieve_state_ttl = float(
+    os.environ.get("NIMBUSIO_RETRIEVE_STATE_TTL", "300.0"))
 
 def _launch_database_pool_worker(worker_number):
     log = logging.getLogger("launch_database_pool_worker")
@@ -88,6 +105,17 @@ def _handle_retrieve_key_start(resources, message, control):
                   message["user-request-id"], retrieve_id))
         del resources.active_retrieves[retrieve_id]
 
+    if resources.sequence_row_cache.enabled:
+        sequence_rows = resources.sequence_row_cache.get(
+            sequence_row_cache_key(message))
+        if sequence_rows is not None:
+            log.debug("user_request_id = {0}, sequence rows cached".format(
+                      message["user-request-id"]))
+            _start_retrieve(resources, message, control, sequence_rows)
+            return
+        control["sequence-row-cache-generation"] = \
+            resources.sequence_row_cache.generation
+
     log.debug("user_request_id = {0}, adding to pending work queue".format(
               message["user-request-id"]))
 
@@ -101,15 +129,100 @@ def _handle_retrieve_key_next(resources, message, control):
         log.error("user_request_id = {0}, " \
                   "unknown retrieve-id {1} in retrieve-key-next".format(
                   message["user-request-id"], retrieve_id))
+        # the state may have expired: don't leave the client waiting
+        control["result"] = "unknown-retrieve-id"
+        control["error-message"] = "unknown retrieve-id {0}".format(
+            retrieve_id)
+        _send_error_reply(resources, message, control)
         return
 
     retrieve_state = resources.active_retrieves.pop(retrieve_id)
-    log.debug("user_request_id = {0}, sending to io-controller".format(
-              message["user-request-id"]))
-    _send_request_to_io_controller(resources, message, control, retrieve_state)
+    retrieve_state = retrieve_state._replace(timestamp=time.time())
+    sequence_index = retrieve_state.sequence_index
+
+    if sequence_index < retrieve_state.read_ahead_index and \
+       resources.read_ahead.has_entry(retrieve_id, sequence_index):
+        log.debug("user_request_id = {0}, row[{1}] was read ahead".format(
+                  message["user-request-id"], sequence_index))
+        next_sequence_index = sequence_index + 1
+        if next_sequence_index < retrieve_state.sequence_end:
+            resources.active_retrieves[retrieve_id] = \
+                retrieve_state._replace(sequence_index=next_sequence_index)
+        read_ahead_result = resources.read_ahead.request(retrieve_id, 
+                                                         sequence_index, 
+                                                         message)
+        if read_ahead_result is not None:
+            reply, data = read_ahead_result
+            _send_read_ahead_reply(resources, message, reply, data)
+    else:
+        log.debug("user_request_id = {0}, sending to io-controller".format(
+                  message["user-request-id"]))
+        _send_request_to_io_controller(resources, 
+                                       message, 
+                                       control, 
+                                       retrieve_state)
+
+    _send_read_ahead_requests(resources, message)
+
+def _handle_retrieve_key_cancel(resources, message, control):
+    """
+    the client has what it needs from other nodes: drop everything we
+    have, or have queued, for this retrieve and tell the io controller to
+    do the same
+    """
+    log = logging.getLogger("_handle_retrieve_key_cancel")
+    retrieve_id = message["retrieve-id"]
+    log.debug("user_request_id = {0}, cancel {1}".format(
+              message["user-request-id"], retrieve_id))
+
+    resources.cancelled_retrieves[retrieve_id] = time.time()
+    resources.active_retrieves.pop(retrieve_id, None)
+    _send_dropped_read_ahead_replies(resources,
+                                     resources.read_ahead.cancel(retrieve_id),
+                                     "retrieve-cancelled")
+
+    pending_work_count = len(resources.pending_work_queue)
+    kept_work = [(pending_message, pending_control, ) \
+                 for pending_message, pending_control \
+                 in resources.pending_work_queue \
+                 if pending_message["retrieve-id"] != retrieve_id]
+    resources.pending_work_queue.clear()
+    resources.pending_work_queue.extend(kept_work)
+    if len(kept_work) != pending_work_count:
+        log.debug("user_request_id = {0}, " \
+                  "dropped queued retrieve-key-start".format(
+                  message["user-request-id"]))
+
+    resources.io_controller_push_socket.send_pyobj(message, zmq.SNDMORE)
+    resources.io_controller_push_socket.send_pyobj(control, zmq.SNDMORE)
+    resources.io_controller_push_socket.send_pyobj(None)
+
+def _expire_retrieves(resources, current_time):
+    """
+    drop the state of retrieves that have been idle longer than the ttl
+    return the number dropped
+    """
+    log = logging.getLogger("_expire_retrieves")
+    expired_retrieve_ids = \
+        [retrieve_id \
+         for retrieve_id, retrieve_state in resources.active_retrieves.items() \
+         if current_time - retrieve_state.timestamp > _retrieve_state_ttl]
+    for retrieve_id in expired_retrieve_ids:
+        log.info("expiring retrieve {0}".format(retrieve_id))
+        del resources.active_retrieves[retrieve_id]
+        _send_dropped_read_ahead_replies(
+            resources, resources.read_ahead.cancel(retrieve_id), "expired")
 
-_dispatch_table = { "retrieve-key-start" : _handle_retrieve_key_start,
-                    "retrieve-key-next"  : _handle_retrieve_key_next, }
+    for retrieve_id, cancel_time in list(
+        resources.cancelled_retrieves.items()):
+        if current_time - cancel_time > _retrieve_state_ttl:
+            del resources.cancelled_retrieves[retrieve_id]
+
+    return len(expired_retrieve_ids)
+
+_dispatch_table = { "retrieve-key-start"    : _handle_retrieve_key_start,
+                    "retrieve-key-next"     : _handle_retrieve_key_next,
+                    "retrieve-key-cancel"   : _handle_retrieve_key_cancel, }
 
 def _read_pull_socket(resources):
     """
@@ -220,19 +333,22 @@ def _analyze_slice_offsets(sequence_rows, block_offset, total_block_count):
         skip_count, keep_count, left_offset, right_offset))
     return (skip_count, keep_count, left_offset, right_offset)
 
+def _get_reply_push_socket(resources, client_address):
+    log = logging.getLogger("_get_reply_push_socket")
+    if not client_address in resources.reply_push_sockets:
+        push_socket = resources.zeromq_context.socket(zmq.PUSH)
+        push_socket.setsockopt(zmq.LINGER, 5000)
+        log.info("connecting to {0}".format(client_address))
+        push_socket.connect(client_address)
+        resources.reply_push_sockets[client_address] = push_socket
+    return resources.reply_push_sockets[client_address]
+
 def _send_error_reply(resources, message, control):
     """
     if we failed to get sequence data, there's no point in going on
     so send the error reply here.
     """
-    log = logging.getLogger("_send_error_reply")
-    if not message["client-address"] in resources.reply_push_sockets:
-        push_socket = resources.zeromq_context.socket(zmq.PUSH)
-        push_socket.setsockopt(zmq.LINGER, 5000)
-        log.info("connecting to {0}".format(message["client-address"]))
-        push_socket.connect(message["client-address"])
-        resources.reply_push_sockets[message["client-address"]] = push_socket
-    push_socket = resources.reply_push_sockets[message["client-address"]]
+    push_socket = _get_reply_push_socket(resources, message["client-address"])
     reply = {"message-type"          : "retrieve-key-reply",
              "client-tag"            : message["client-tag"],
              "message-id"            : message["message-id"],
@@ -243,6 +359,22 @@ def _send_error_reply(resources, message, control):
               "error-message"        : control["error-message"],}
     push_socket.send_json(reply)
 
+def _send_dropped_read_ahead_replies(resources, requests, reason):
+    """
+    the client is waiting on read aheads we have dropped: don't leave it
+    waiting
+    """
+    log = logging.getLogger("_send_dropped_read_ahead_replies")
+    for request in requests:
+        log.warn("user_request_id = {0}, " \
+                 "read ahead for retrieve-id {1} {2}".format(
+                 request["user-request-id"], request["retrieve-id"], reason))
+        control = {"result"         : "read-ahead-dropped",
+                   "error-message"  : "read ahead for retrieve-id {0} " \
+                                      "{1}".format(request["retrieve-id"],
+                                                   reason)}
+        _send_error_reply(resources, request, control)
+
 def _read_router_socket(resources):
     """
     read a message from the router socket (from one of our worker processes)
@@ -267,6 +399,13 @@ def _read_router_socket(resources):
     assert resources.router_socket.rcvmore
     control = resources.router_socket.recv_pyobj()
 
+    if message["retrieve-id"] in resources.cancelled_retrieves:
+        log.debug("user_request_id = {0}, {1} was cancelled".format(
+                  message["user-request-id"], message["retrieve-id"]))
+        if resources.router_socket.rcvmore:
+            resources.router_socket.recv_pyobj()
+        return
+
     if control["result"] != "success":
         log.error("user_request_id = {0}, " \
                   "{1} {2} {3}".format(message["user-request-id"],
@@ -282,6 +421,21 @@ def _read_router_socket(resources):
     assert  message["message-type"] == "retrieve-key-start", message
     assert sequence_rows is not None
 
+    if resources.sequence_row_cache.enabled:
+        resources.sequence_row_cache.put(
+            sequence_row_cache_key(message),
+            sequence_rows,
+            control["sequence-row-cache-generation"])
+
+    _start_retrieve(resources, message, control, sequence_rows)
+
+def _start_retrieve(resources, message, control, sequence_rows):
+    """
+    set up an active retrieve from the segment's sequence rows and send
+    the first sequence read to the io controller
+    """
+    log = logging.getLogger("_start_retrieve")
+
     row_skip_count, row_keep_count, left_offset, right_offset = \
         _analyze_slice_offsets(sequence_rows, 
                                message["block-offset"],
@@ -303,9 +457,145 @@ def _read_router_socket(resources):
                                                 row_skip_count+row_keep_count,
                                            left_offset=left_offset,
                                            right_offset=right_offset,
+                                           read_ahead_credit=\
+                                            resources.read_ahead.credit(
+                                                message),
+                                           read_ahead_index=0,
                                            timestamp=time.time())
 
     _send_request_to_io_controller(resources, message, control, retrieve_state)
+    _send_read_ahead_requests(resources, message)
+
+def _read_sequence_row_notifications(resources, listen_connection):
+    """
+    invalidate cached sequence rows for the notifications that have
+    arrived from the database
+    """
+    for _, payload in listen_connection.get_notifications():
+        resources.sequence_row_cache.invalidate(parse_invalidation(payload))
+
+def _read_read_ahead_pull_socket(resources):
+    """
+    read replies for sequences we have read ahead, until we would block
+    if the client has already asked for the sequence, pass the reply on
+    otherwise hold it until the client asks
+    """
+    while True: # read until we would block
+        try:
+            reply = resources.read_ahead_pull_socket.recv_json(zmq.NOBLOCK)
+        except zmq.ZMQError as instance:
+            if instance.errno == zmq.EAGAIN:
+                break
+            raise
+
+        # we hold the blocks as zeromq frames and pass them on as they are
+        data = list()
+        while resources.read_ahead_pull_socket.rcvmore:
+            data.append(resources.read_ahead_pull_socket.recv(copy=False))
+
+        read_ahead_result = resources.read_ahead.arrived(reply, data)
+        if read_ahead_result is not None:
+            request, reply, data = read_ahead_result
+            _send_read_ahead_reply(resources, request, reply, data)
+
+def _send_read_ahead_reply(resources, request, reply, data):
+    """
+    send a reply we got by reading ahead to the client, as the reply
+    to its retrieve-key-next request
+    """
+    reply = dict(reply)
+    reply["message-id"] = request["message-id"]
+    reply["client-tag"] = request["client-tag"]
+    reply["user-request-id"] = request["user-request-id"]
+
+    push_socket = _get_reply_push_socket(resources, request["client-address"])
+    if len(data) == 0:
+        push_socket.send_json(reply)
+        return
+
+    push_socket.send_json(reply, zmq.SNDMORE)
+    for block in data[:-1]:
+        push_socket.send(block, zmq.SNDMORE, copy=False)
+    push_socket.send(data[-1], copy=False)
+
+def _send_read_ahead_requests(resources, message):
+    """
+    keep up to the retrieve's read-ahead credit of sequence reads queued 
+    beyond the one the client has asked for.
+
+    The io worker sends its reply to the address in the message, so we
+    give it our read ahead pull socket.
+    """
+    log = logging.getLogger("_send_read_ahead_requests")
+    retrieve_id = message["retrieve-id"]
+    if retrieve_id not in resources.active_retrieves:
+        return
+    retrieve_state = resources.active_retrieves[retrieve_id]
+
+    sequence_index = max(retrieve_state.read_ahead_index, 
+                         retrieve_state.sequence_index)
+    while sequence_index < retrieve_state.sequence_end and \
+          sequence_index - retrieve_state.sequence_index < \
+            retrieve_state.read_ahead_credit:
+        sequence_row = retrieve_state.sequence_rows[sequence_index]
+        if not resources.read_ahead.has_room(sequence_row["size"]):
+            log.debug("user_request_id = {0}, no room to read ahead".format(
+                      message["user-request-id"]))
+            break
+
+        read_ahead_message = dict(message)
+        read_ahead_message["message-type"] = "retrieve-key-next"
+        read_ahead_message["client-address"] = \
+            db_controller_read_ahead_pull_socket_uri
+        read_ahead_message["message-id"] = \
+            resources.read_ahead.issue(retrieve_id, 
+                                       sequence_index, 
+                                       sequence_row["size"])
+        control = {"result"              : None,
+                   "error-message"       : None, } 
+        _compute_sequence_control(control, 
+                                  retrieve_state, 
+                                  sequence_index, 
+                                  is_start=False)
+
+        log.debug("user_request_id = {0}, " \
+                  "{1} reading ahead row[{2}] of {3}".format(
+                  message["user-request-id"],
+                  retrieve_id,
+                  sequence_index,
+                  len(retrieve_state.sequence_rows)))
+
+        resources.io_controller_push_socket.send_pyobj(read_ahead_message, 
+                                                       zmq.SNDMORE)
+        resources.io_controller_push_socket.send_pyobj(control, zmq.SNDMORE)
+        resources.io_controller_push_socket.send_pyobj(sequence_row)
+
+        sequence_index += 1
+
+    resources.active_retrieves[retrieve_id] = \
+        retrieve_state._replace(read_ahead_index=sequence_index)
+
+def _compute_sequence_control(control, 
+                              retrieve_state, 
+                              sequence_index, 
+                              is_start):
+    """
+    set the block offsets and the completed flag for reading one sequence
+    """
+    if is_start:
+        control["left-offset"] = retrieve_state.left_offset
+    else:
+        control["left-offset"] = 0
+
+    next_sequence_index = sequence_index + 1
+    assert next_sequence_index <= len(retrieve_state.sequence_rows)
+    assert next_sequence_index <= retrieve_state.sequence_end
+    control["completed"] = next_sequence_index == retrieve_state.sequence_end
+
+    if control["completed"]:
+        control["right-offset"] = retrieve_state.right_offset
+    else:
+        control["right-offset"] = 0
 
 def _send_request_to_io_controller(resources, 
                                    message, 
@@ -319,24 +609,17 @@ def _send_request_to_io_controller(resources,
               retrieve_state.sequence_index,
               len(retrieve_state.sequence_rows)))
 
-    if message["message-type"] == "retrieve-key-start":
-        control["left-offset"] = retrieve_state.left_offset
-    else:
-        control["left-offset"] = 0
+    _compute_sequence_control(control, 
+                              retrieve_state, 
+                              retrieve_state.sequence_index, 
+                              message["message-type"] == "retrieve-key-start")
 
     sequence_row = retrieve_state.sequence_rows[retrieve_state.sequence_index]
 
-    next_sequence_index = retrieve_state.sequence_index + 1
-    assert next_sequence_index <= len(retrieve_state.sequence_rows)
-    assert next_sequence_index <= retrieve_state.sequence_end
-    control["completed"] = next_sequence_index == retrieve_state.sequence_end
-
-    if control["completed"]:
-        control["right-offset"] = retrieve_state.right_offset
-    else:
-        control["right-offset"] = 0
+    if not control["completed"]:
         resources.active_retrieves[message["retrieve-id"]] = \
-            retrieve_state._replace(sequence_index=next_sequence_index)
+            retrieve_state._replace(
+                sequence_index=retrieve_state.sequence_index+1)
 
     resources.io_controller_push_socket.send_pyobj(message, zmq.SNDMORE)
     resources.io_controller_push_socket.send_pyobj(control, zmq.SNDMORE)
@@ -365,6 +648,8 @@ def main():
                          zeromq_context=zeromq_context,
                          reply_push_sockets=dict(),
                          pull_socket=zeromq_context.socket(zmq.PULL),
+                         read_ahead_pull_socket=\
+                            zeromq_context.socket(zmq.PULL),
                          io_controller_push_socket=\
                             zeromq_context.socket(zmq.PUSH),
                          router_socket=zeromq_context.socket(zmq.ROUTER),
@@ -372,12 +657,20 @@ def main():
                             EventPushClient(zeromq_context, 
                                             "rs_db_pool_controller"),
                          active_retrieves=dict(),
+                         cancelled_retrieves=dict(),
+                         read_ahead=ReadAhead(),
+                         sequence_row_cache=SequenceRowCache(),
                          pending_work_queue=deque(),
                          available_ident_queue=deque())
 
     log.debug("binding to {0}".format(db_controller_pull_socket_uri))
     resources.pull_socket.bind(db_controller_pull_socket_uri)
 
+    log.debug("binding to {0}".format(
+              db_controller_read_ahead_pull_socket_uri))
+    resources.read_ahead_pull_socket.bind(
+        db_controller_read_ahead_pull_socket_uri)
+
     log.debug("connecting to {0}".format(io_controller_pull_socket_uri))
     resources.io_controller_push_socket.connect(io_controller_pull_socket_uri)
 
@@ -390,6 +683,16 @@ def main():
     poller = zmq.Poller()
     poller.register(resources.pull_socket, zmq.POLLIN | zmq.POLLERR)
     poller.register(resources.router_socket, zmq.POLLIN| zmq.POLLERR)
+    poller.register(resources.read_ahead_pull_socket, 
+                    zmq.POLLIN | zmq.POLLERR)
+
+    # the defragger and the garbage collectors tell us when they change
+    # the sequence rows we may have cached
+    listen_connection = None
+    if resources.sequence_row_cache.enabled:
+        listen_connection = get_node_local_connection()
+        listen_connection.listen(sequence_row_channel)
+        poller.register(listen_connection.fileno(), zmq.POLLIN | zmq.POLLERR)
 
     worker_processes = list()
     for index in range(_worker_count):
@@ -410,25 +713,60 @@ def main():
                     _read_pull_socket(resources)
                 elif active_socket is resources.router_socket:
                     _read_router_socket(resources)
+                elif active_socket is resources.read_ahead_pull_socket:
+                    _read_read_ahead_pull_socket(resources)
+                elif listen_connection is not None and \
+                active_socket == listen_connection.fileno():
+                    _read_sequence_row_notifications(resources, 
+                                                     listen_connection)
                 else:
                     log.error("unknown socket {0}".format(active_socket))
             current_time = time.time()
             elapsed_time = current_time - last_report_time
             if elapsed_time > _reporting_interval:
+                expired_retrieves = _expire_retrieves(resources, current_time)
+                sequence_row_cache_stats = resources.sequence_row_cache.stats
                 report_message = \
                     "{0:,} active_retrives, " \
                     "{1:,} pending_work_queue entries, " \
-                    "{2:,} available_ident_queue entries" \
+                    "{2:,} available_ident_queue entries, " \
+                    "sequence row cache {3:,} hits {4:,} misses" \
                     "".format(len(resources.active_retrieves),
                               len(resources.pending_work_queue),
-                              len(resources.available_ident_queue))
+                              len(resources.available_ident_queue),
+                              sequence_row_cache_stats["hits"],
+                              sequence_row_cache_stats["misses"])
                 log.info(report_message)
                 resources.event_push_client.info(
                     "queue_sizes", 
                     report_message,
                     active_retrieves=len(resources.active_retrieves),
                     pending_work_queue=len(resources.pending_work_queue),
-                    available_ident_queue=len(resources.available_ident_queue))
+                    available_ident_queue=len(resources.available_ident_queue),
+                    expired_retrieves=expired_retrieves,
+                    sequence_row_cache_hits=sequence_row_cache_stats["hits"],
+                    sequence_row_cache_misses=\
+                        sequence_row_cache_stats["misses"],
+                    sequence_row_cache_invalidations=\
+                        sequence_row_cache_stats["invalidations"],
+                    sequence_row_cache_entries=\
+                        len(resources.sequence_row_cache),
+                    sequence_row_cache_bytes=resources.sequence_row_cache.size)
+                for key in sequence_row_cache_stats.keys():
+                    sequence_row_cache_stats[key] = 0
+
+                _send_dropped_read_ahead_replies(
+                    resources, 
+                    resources.read_ahead.expire(current_time),
+                    "expired")
+                log.info("read ahead: {hits} hits, {waits} waits, " \
+                         "{discarded} discarded, {entries} entries, " \
+                         "{buffered-bytes} bytes".format(
+                         **resources.read_ahead.stats))
+                resources.event_push_client.info(
+                    "read_ahead_stats", 
+                    "read ahead stats",
+                    stats=dict(resources.read_ahead.stats))
 
                 last_report_time = current_time
 
@@ -453,10 +791,13 @@ def main():
         for worker_process in worker_processes:
             terminate_subprocess(worker_process)
         resources.pull_socket.close()
+        resources.read_ahead_pull_socket.close()
         resources.io_controller_push_socket.close()
         resources.router_socket.close()
         for push_socket in resources.reply_push_sockets.values():
             push_socket.close()
+        if listen_connection is not None:
+            listen_connection.close()
         resources.event_push_client.close()
         zeromq_context.term()
 
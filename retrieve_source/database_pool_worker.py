@@ -18,7 +18,8 @@ from tools.zeromq_util import is_interrupted_system_call, \
         InterruptedSystemCall
 from tools.process_util import set_signal_handler
 from tools.event_push_client import EventPushClient, unhandled_exception_topic
-from tools.database_connection import get_node_local_connection
+from tools.database_connection import get_node_local_connection, \
+        PreparedStatement
 from tools.data_definitions import segment_sequence_template
 
 from retrieve_source.internal_sockets import db_controller_router_socket_uri
@@ -32,11 +33,11 @@ inner join nimbusio_node.value_file val
 on seq.value_file_id = val.id
 where seq.segment_id = (
     select id from nimbusio_node.segment 
-    where collection_id = %(collection-id)s
-    and key = %(key)s
-    and unified_id = %(segment-unified-id)s
-    and conjoined_part = %(segment-conjoined-part)s
-    and segment_num = %(segment-num)s
+    where collection_id = $1
+    and key = $2
+    and unified_id = $3
+    and conjoined_part = $4
+    and segment_num = $5
     and handoff_node_id is null
     and status = 'F'
     limit 1
@@ -49,16 +50,29 @@ inner join nimbusio_node.value_file val
 on seq.value_file_id = val.id
 where seq.segment_id = (
     select id from nimbusio_node.segment 
-    where collection_id = %(collection-id)s
-    and key = %(key)s
-    and unified_id = %(segment-unified-id)s
-    and conjoined_part = %(segment-conjoined-part)s
-    and segment_num = %(segment-num)s
-    and handoff_node_id = %(handoff-node-id)s
+    where collection_id = $1
+    and key = $2
+    and unified_id = $3
+    and conjoined_part = $4
+    and segment_num = $5
+    and handoff_node_id = $6
     and status = 'F'
 )
 order by seq.sequence_num asc"""
 
+def _define_seq_val_fields():
+    fields = ",".join(
+        ["seq.{0}".format(f) for f in segment_sequence_template._fields])
+    fields = ",".join([fields, "val.space_id"])
+    return fields
+
+_all_sequence_rows_for_segment = PreparedStatement(
+    "all_sequence_rows_for_segment",
+    _all_sequence_rows_for_segment_query.format(_define_seq_val_fields()))
+_all_sequence_rows_for_handoff = PreparedStatement(
+    "all_sequence_rows_for_handoff",
+    _all_sequence_rows_for_handoff_query.format(_define_seq_val_fields()))
+
 def _send_initial_work_request(dealer_socket):
     """
     start the work cycle by notifying the controller that we are available
@@ -68,12 +82,6 @@ def _send_initial_work_request(dealer_socket):
     message = {"message-type" : "ready-for-work"}
     dealer_socket.send_pyobj(message)
 
-def _define_seq_val_fields():
-    fields = ",".join(
-        ["seq.{0}".format(f) for f in segment_sequence_template._fields])
-    fields = ",".join([fields, "val.space_id"])
-    return fields
-
 def _process_one_transaction(dealer_socket, 
                              database_connection, 
                              event_push_client):
@@ -94,16 +102,22 @@ def _process_one_transaction(dealer_socket,
     assert dealer_socket.rcvmore
     control = dealer_socket.recv_pyobj()
 
-    fields = _define_seq_val_fields()
+    args = [request["collection-id"], 
+            request["key"], 
+            request["segment-unified-id"], 
+            request["segment-conjoined-part"], 
+            request["segment-num"], ]
     if request["handoff-node-id"] is None:
-        query = _all_sequence_rows_for_segment_query.format(fields)
+        prepared_statement = _all_sequence_rows_for_segment
     else:
-        query = _all_sequence_rows_for_handoff_query.format(fields)
+        prepared_statement = _all_sequence_rows_for_handoff
+        args.append(request["handoff-node-id"])
 
     control["result"] = "success"
     control["error-message"] = ""
     try:
-        result = database_connection.fetch_all_rows(query, request)    
+        result = database_connection.fetch_all_rows_prepared(
+            prepared_statement, args)
     except psycopg2.OperationalError as instance:
         error_message = "database error {0}".format(instance)
         event_push_client.error("database_error", error_message)
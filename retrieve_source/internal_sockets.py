@@ -20,6 +20,9 @@ db_controller_router_socket_uri = ipc_socket_uri(_socket_dir,
                                                _local_node_name,
                                                "db_controller_router")
 
+db_controller_read_ahead_pull_socket_uri = \
+    ipc_socket_uri(_socket_dir, _local_node_name, "db_controller_read_ahead")
+
 io_controller_pull_socket_uri = ipc_socket_uri(_socket_dir,
                                                _local_node_name,
                                                "io_controller_pull")
@@ -30,6 +33,7 @@ io_controller_router_socket_uri = ipc_socket_uri(_socket_dir,
 
 internal_socket_uri_list = [db_controller_pull_socket_uri, 
                             db_controller_router_socket_uri,
+                            db_controller_read_ahead_pull_socket_uri,
                             io_controller_router_socket_uri,
                             io_controller_router_socket_uri, ]
 
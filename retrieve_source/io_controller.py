@@ -28,6 +28,7 @@ from tools.zeromq_util import PollError, \
 
 from retrieve_source.internal_sockets import io_controller_pull_socket_uri, \
         io_controller_router_socket_uri
+from retrieve_source.io_scheduler import create_scheduler
 
 _resources_tuple = namedtuple("Resources", 
                               ["halt_event",
@@ -57,7 +58,7 @@ def _launch_io_worker(volume_name, worker_number):
 
 def _send_pending_work_to_available_workers(resources):
     """
-    send messages from the pending_work_queue 
+    send batches of work, in the order chosen by each volume's scheduler,
     to workers in the available_ident_queue
     """
     log = logging.getLogger("_send_pending_work_to_available_workers")
@@ -67,13 +68,13 @@ def _send_pending_work_to_available_workers(resources):
         log.debug("work_count {0} for volume {1}".format(work_count, 
                                                          volume_name))
         for _ in range(work_count):
-            message, control, sequence_row = \
-                resources.pending_work_by_volume[volume_name].popleft()
+            scheduler = resources.pending_work_by_volume[volume_name]
+            if len(scheduler) == 0:
+                break
+            work_batch = scheduler.next_batch()
             ident = resources.available_ident_by_volume[volume_name].popleft()
             resources.router_socket.send(ident, zmq.SNDMORE)
-            resources.router_socket.send_pyobj(message, zmq.SNDMORE)
-            resources.router_socket.send_pyobj(control, zmq.SNDMORE)
-            resources.router_socket.send_pyobj(sequence_row)
+            resources.router_socket.send_pyobj(work_batch)
 
 def _read_pull_socket(resources):
     """
@@ -95,6 +96,10 @@ def _read_pull_socket(resources):
         assert resources.pull_socket.rcvmore
         sequence_row = resources.pull_socket.recv_pyobj()
 
+        if message["message-type"] == "retrieve-key-cancel":
+            _cancel_retrieve(resources, message)
+            continue
+
         space_id = sequence_row["space_id"]
         try:
             volume_name = resources.volume_by_space_id[space_id]
@@ -113,6 +118,20 @@ def _read_pull_socket(resources):
 
     _send_pending_work_to_available_workers(resources)
 
+def _cancel_retrieve(resources, message):
+    """
+    drop the reads we have queued for a retrieve the client has given up on
+    """
+    log = logging.getLogger("_cancel_retrieve")
+    cancelled_count = 0
+    for scheduler in resources.pending_work_by_volume.values():
+        cancelled_count += scheduler.cancel(message["retrieve-id"])
+    log.debug("user_request_id = {0}, " \
+              "{1} cancelled {2} queued reads".format(
+              message["user-request-id"],
+              message["retrieve-id"],
+              cancelled_count))
+
 def _read_router_socket(resources):
     """
     read a message from the router socket (from one of our worker processes)
@@ -190,7 +209,8 @@ def main():
                          event_push_client=\
                             EventPushClient(zeromq_context, 
                                             "rs_io_controller"),
-                         pending_work_by_volume=defaultdict(deque),
+                         pending_work_by_volume=\
+                            defaultdict(create_scheduler),
                          available_ident_by_volume=defaultdict(deque))
 
     log.debug("binding to {0}".format(io_controller_pull_socket_uri))
@@ -233,8 +253,8 @@ def main():
             elapsed_time = current_time - last_report_time
             if elapsed_time > _reporting_interval:
                 pending_work = 0
-                for volume_queue in resources.pending_work_by_volume.values():
-                    pending_work += len(volume_queue)
+                for scheduler in resources.pending_work_by_volume.values():
+                    pending_work += len(scheduler)
                 report_message = \
                     "{0:,} pending_work entries".format(pending_work)
                 log.info(report_message)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+io_scheduler.py
+
+The order in which the io controller hands the pending reads for a volume
+to its io workers.
+
+FIFOScheduler
+    reads go out in the order they arrive, one at a time
+
+DeadlineScheduler
+    reads go out in elevator order, sweeping up through
+    (space_id, value_file_id, offset) and wrapping around at the top.
+    A read that has waited longer than max_wait goes next, and the sweep
+    carries on from there. Reads of adjacent ranges in the same value file
+    go out together, as one batch for a single worker to read with one
+    seek, up to max_read_size bytes.
+
+A scheduler holds work tuples (message, control, sequence_row). next_batch
+returns a list of them for one worker; cancel drops the queued work for a
+retrieve.
+"""
+from bisect import bisect_left, insort
+from collections import deque
+import os
+import time
+
+from tools.data_definitions import encoded_block_slice_size
+
+_scheduler_name = os.environ.get("NIMBUSIO_RETRIEVE_IO_SCHEDULER",
+                                 "deadline")
+_max_wait = float(os.environ.get("NIMBUSIO_RETRIEVE_IO_MAX_WAIT", "0.5"))
+_max_read_size = int(os.environ.get("NIMBUSIO_RETRIEVE_IO_MAX_READ_SIZE",
+                                    str(8 * 1024 * 1024)))
+
+def compute_read_range(control, sequence_row):
+    """
+    return (offset, size) in the value file for reading one sequence,
+    less the blocks skipped by the left and right offsets
+    """
+    read_offset = \
+        sequence_row["value_file_offset"] + \
+        (control["left-offset"] * encoded_block_slice_size)
+
+    read_size = \
+        sequence_row["size"] - \
+        (control["left-offset"] * encoded_block_slice_size) - \
+        (control["right-offset"] * encoded_block_slice_size)
+
+    # Ticket #84 handle a short block
+    # the last block in the file may be smaller than encoded_block_slice_size
+    # so we might have subtracted too much for the right offset
+    if control["right-offset"] > 0:
+        block_modulus = sequence_row["size"] % encoded_block_slice_size
+        last_block_size = (encoded_block_slice_size if block_modulus == 0 else \
+                           block_modulus)
+        last_block_delta = encoded_block_slice_size - last_block_size
+        read_size += last_block_delta
+
+    return read_offset, read_size
+
+def _position(work):
+    _, control, sequence_row = work
+    read_offset, read_size = compute_read_range(control, sequence_row)
+    return (sequence_row["space_id"],
+            sequence_row["value_file_id"],
+            read_offset,
+            read_size, )
+
+class FIFOScheduler(object):
+    """
+    hand out reads in the order they arrive
+    """
+    def __init__(self):
+        self._queue = deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def append(self, work):
+        self._queue.append(work)
+
+    def next_batch(self):
+        return [self._queue.popleft(), ]
+
+    def cancel(self, retrieve_id):
+        """
+        drop the queued work for retrieve_id, return the number dropped
+        """
+        queue_size = len(self._queue)
+        self._queue = deque([work for work in self._queue \
+                             if work[0]["retrieve-id"] != retrieve_id])
+        return queue_size - len(self._queue)
+
+class DeadlineScheduler(object):
+    """
+    hand out reads in elevator order, with a deadline, merging adjacent
+    reads
+    """
+    def __init__(self, max_wait=_max_wait, max_read_size=_max_read_size):
+        self._max_wait = max_wait
+        self._max_read_size = max_read_size
+        # (position, serial, work) in position order
+        self._sorted = list()
+        # (arrival time, position, serial) in arrival order; entries that
+        # have been handed out are skipped lazily
+        self._arrivals = deque()
+        self._pending_serials = set()
+        self._serial = 0
+        self._head = None
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def append(self, work):
+        self._serial += 1
+        position = _position(work)
+        insort(self._sorted, (position, self._serial, work, ))
+        self._arrivals.append((time.time(), position, self._serial, ))
+        self._pending_serials.add(self._serial)
+
+    def next_batch(self):
+        index = self._first_index()
+        batch = [self._pop(index), ]
+        batch_size = batch[0][0][3]
+
+        # index now points to the read after the one we took
+        while index < len(self._sorted):
+            prev_position = batch[-1][0]
+            position = self._sorted[index][0]
+            if position[:2] != prev_position[:2]:
+                break
+            if position[2] != prev_position[2] + prev_position[3]:
+                break
+            if batch_size + position[3] > self._max_read_size:
+                break
+            batch.append(self._pop(index))
+            batch_size += position[3]
+
+        last_position = batch[-1][0]
+        self._head = (last_position[0],
+                      last_position[1],
+                      last_position[2] + last_position[3], )
+
+        return [work for _, work in batch]
+
+    def cancel(self, retrieve_id):
+        """
+        drop the queued work for retrieve_id, return the number dropped
+        """
+        kept = list()
+        for position, serial, work in self._sorted:
+            if work[0]["retrieve-id"] == retrieve_id:
+                self._pending_serials.remove(serial)
+            else:
+                kept.append((position, serial, work, ))
+        cancelled_count = len(self._sorted) - len(kept)
+        self._sorted = kept
+        return cancelled_count
+
+    def _first_index(self):
+        while self._arrivals[0][2] not in self._pending_serials:
+            self._arrivals.popleft()
+
+        arrival_time, position, serial = self._arrivals[0]
+        if time.time() - arrival_time > self._max_wait:
+            return bisect_left(self._sorted, (position, serial, ))
+
+        if self._head is None:
+            return 0
+        index = bisect_left(self._sorted, (self._head, ))
+        if index == len(self._sorted):
+            return 0
+        return index
+
+    def _pop(self, index):
+        position, serial, work = self._sorted.pop(index)
+        self._pending_serials.remove(serial)
+        return position, work
+
+def create_scheduler(scheduler_name=_scheduler_name):
+    """
+    return a new scheduler for one volume
+    """
+    if scheduler_name == "fifo":
+        return FIFOScheduler()
+    if scheduler_name == "deadline":
+        return DeadlineScheduler()
+    raise ValueError("unknown io scheduler '{0}'".format(scheduler_name))
@@ -10,6 +10,7 @@ import hashlib
 import logging
 import os
 import os.path
+import random
 import sys
 from threading import Event
 import time
@@ -19,8 +20,8 @@ import zmq
 
 from tools.standard_logging import initialize_logging
 from tools.data_definitions import compute_value_file_path, \
-        encoded_block_slice_size, \
-        encoded_block_generator
+        encoded_block_generator, \
+        data_view
 from tools.LRUCache import LRUCache
 from tools.zeromq_util import is_interrupted_system_call, \
         InterruptedSystemCall
@@ -28,6 +29,7 @@ from tools.process_util import set_signal_handler
 from tools.event_push_client import EventPushClient, unhandled_exception_topic
 
 from retrieve_source.internal_sockets import io_controller_router_socket_uri
+from retrieve_source.io_scheduler import compute_read_range
 
 _local_node_name = os.environ["NIMBUSIO_NODE_NAME"]
 _log_path_template = "{0}/nimbusio_rs_io_worker_{1}_{2}_{3}.log"
@@ -35,6 +37,16 @@ _repository_path = os.environ["NIMBUSIO_REPOSITORY_PATH"]
 _max_file_cache_size = 1000
 _unused_file_close_interval = 120.0
 
+# a read of a whole sequence is the data the writer stored, so we can reply
+# with the digests from the segment_sequence row instead of hashing it
+# again. The client checks the md5 digest against the data in either case.
+# We still hash a random sample of whole sequence reads, to catch bit rot
+# here rather than at the client.
+_use_stored_digests = \
+    os.environ.get("NIMBUSIO_RETRIEVE_USE_STORED_DIGESTS", "1") == "1"
+_verify_sample_rate = \
+    float(os.environ.get("NIMBUSIO_RETRIEVE_VERIFY_SAMPLE_RATE", "0.01"))
+
 _resources_tuple = namedtuple("Resources", 
                               ["halt_event",
                                "zeromq_context",
@@ -81,34 +93,77 @@ def _send_error_reply(resources, message, control):
               "error-message"        : control["error-message"],}
     push_socket.send_json(reply)
 
+def _compute_digests(encoded_block_list):
+    """
+    return (size, adler32, md5 digest) over the blocks
+    """
+    segment_size = 0
+    segment_adler32 = 0
+    segment_md5 = hashlib.md5()
+    for encoded_block in encoded_block_list:
+        segment_size += len(encoded_block)
+        segment_adler32 = zlib.adler32(encoded_block, segment_adler32) 
+        segment_md5.update(encoded_block)
+    return segment_size, segment_adler32, segment_md5.digest()
+
+def _sequence_digests(control, sequence_row, encoded_block_list, read_size):
+    """
+    return (size, adler32, md5 digest, mismatch) for the blocks of one read.
+
+    A whole sequence read takes its digests from the sequence row, unless
+    it is picked for verification. Anything else is hashed, and mismatch
+    is True if a whole sequence we hashed is not what the writer stored.
+    """
+    full_sequence_read = \
+        control["left-offset"] == 0 and control["right-offset"] == 0
+
+    if full_sequence_read and _use_stored_digests \
+    and random.random() >= _verify_sample_rate:
+        return read_size, sequence_row["adler32"], sequence_row["hash"], False
+
+    segment_size, segment_adler32, segment_md5_digest = \
+        _compute_digests(encoded_block_list)
+    mismatch = full_sequence_read and \
+        segment_md5_digest != sequence_row["hash"]
+    return segment_size, segment_adler32, segment_md5_digest, mismatch
+
 def _process_request(resources):
     """
-    Wait for a reply to our last message from the controller.
+    Wait for a batch of work from the controller.
+
+    The reads in a batch are for adjacent ranges of one value file, so we
+    read them with a single seek and reply to each request separately.
     """
     log = logging.getLogger("_process_one_transaction")
     log.debug("waiting work request")
     try:
-        request = resources.dealer_socket.recv_pyobj()
+        work_batch = resources.dealer_socket.recv_pyobj()
     except zmq.ZMQError as zmq_error:
         if is_interrupted_system_call(zmq_error):
             raise InterruptedSystemCall()
         raise
 
-    assert resources.dealer_socket.rcvmore
-    control = resources.dealer_socket.recv_pyobj()
+    assert not resources.dealer_socket.rcvmore
 
-    log.debug("user_request_id = {0}; control = {1}".format(
-              request["user-request-id"], control))
+    for request, control, _ in work_batch:
+        log.debug("user_request_id = {0}; control = {1}".format(
+                  request["user-request-id"], control))
+        control["result"] = "success"
+        control["error-message"] = ""
 
-    assert resources.dealer_socket.rcvmore
-    sequence_row = resources.dealer_socket.recv_pyobj()
+    first_request, _, first_sequence_row = work_batch[0]
+    value_file_path = \
+        compute_value_file_path(_repository_path, 
+                                first_sequence_row["space_id"], 
+                                first_sequence_row["value_file_id"]) 
 
-    value_file_path = compute_value_file_path(_repository_path, 
-                                              sequence_row["space_id"], 
-                                              sequence_row["value_file_id"]) 
+    read_ranges = [compute_read_range(control, sequence_row) \
+                   for _, control, sequence_row in work_batch]
+    read_offset = read_ranges[0][0]
+    read_size = sum([size for _, size in read_ranges])
 
-    control["result"] = "success"
-    control["error-message"] = ""
+    result = "success"
+    error_message = ""
 
     if value_file_path in resources.file_cache:
         value_file, _ = resources.file_cache[value_file_path]
@@ -118,56 +173,78 @@ def _process_request(resources):
             value_file = open(value_file_path, "rb")
         except Exception as instance:
             log.exception("user_request_id = {0}, " \
-                          "read {1}".format(request["user-request-id"],
+                          "read {1}".format(first_request["user-request-id"],
                                             value_file_path))
             resources.event_push_client.exception("error_opening_value_file", 
                                                   str(instance))
-            control["result"] = "error_opening_value_file"
-            control["error-message"] = str(instance)
+            result = "error_opening_value_file"
+            error_message = str(instance)
             
-        if control["result"] != "success":
-            _send_error_reply(resources, request, control)
+        if result != "success":
+            _send_batch_error_reply(resources, work_batch, result, error_message)
             return
 
-    read_offset = \
-        sequence_row["value_file_offset"] + \
-        (control["left-offset"] * encoded_block_slice_size)
-
-
-    read_size = \
-        sequence_row["size"] - \
-        (control["left-offset"] * encoded_block_slice_size) - \
-        (control["right-offset"] * encoded_block_slice_size) 
-
-    # Ticket #84 handle a short block
-    # the last block in the file may be smaller than encoded_block_slice_size
-    # so we might have subtracted too much for the right offset
-    if control["right-offset"] > 0:
-        block_modulus = sequence_row["size"] % encoded_block_slice_size
-        last_block_size = (encoded_block_slice_size if block_modulus == 0 else \
-                           block_modulus)
-        last_block_delta = encoded_block_slice_size - last_block_size
-        read_size += last_block_delta 
-
+    # we read into a new buffer for each batch, and send views of it
+    # with copy=False: zeromq holds on to the buffer until the blocks have
+    # gone out, so we can't reuse it for the next read
+    read_buffer = bytearray(read_size)
     try:
         value_file.seek(read_offset)
-        encoded_data = value_file.read(read_size)
+        bytes_read = value_file.readinto(read_buffer)
     except Exception as instance:
         log.exception("user_request_id = {0}, " \
-                      "read {1}".format(request["user-request-id"],
+                      "read {1}".format(first_request["user-request-id"],
                                         value_file_path))
         resources.event_push_client.exception("error_reading_value_file", 
                                               str(instance))
-        control["result"] = "error_reading_vqalue_file"
-        control["error-message"] = str(instance)
+        result = "error_reading_vqalue_file"
+        error_message = str(instance)
 
-    if control["result"] != "success":
+    if result != "success":
         value_file.close()
-        _send_error_reply(resources, request, control)
+        _send_batch_error_reply(resources, work_batch, result, error_message)
         return
 
     resources.file_cache[value_file_path] = value_file, time.time()
 
+    encoded_data = data_view(read_buffer, 0, bytes_read)
+
+    if len(work_batch) == 1:
+        _send_sequence_reply(resources, 
+                             work_batch[0], 
+                             value_file_path, 
+                             encoded_data,
+                             read_size)
+        return
+
+    log.debug("{0} reads in one of {1} bytes".format(len(work_batch), 
+                                                     read_size))
+    data_offset = 0
+    for work, (_, size) in zip(work_batch, read_ranges):
+        _send_sequence_reply(resources, 
+                             work, 
+                             value_file_path, 
+                             data_view(encoded_data, data_offset, size),
+                             size)
+        data_offset += size
+
+def _send_batch_error_reply(resources, work_batch, result, error_message):
+    for request, control, _ in work_batch:
+        control["result"] = result
+        control["error-message"] = error_message
+        _send_error_reply(resources, request, control)
+
+def _send_sequence_reply(resources, 
+                         work, 
+                         value_file_path, 
+                         encoded_data, 
+                         read_size):
+    """
+    send the data we read for one request
+    """
+    log = logging.getLogger("_send_sequence_reply")
+    request, control, sequence_row = work
+
     if len(encoded_data) != read_size:
         error_message = "{0} size mismatch {1} {2}".format(
             request["retrieve-id"],
@@ -185,14 +262,21 @@ def _process_request(resources):
 
     encoded_block_list = list(encoded_block_generator(encoded_data))
 
-    segment_size = 0
-    segment_adler32 = 0
-    segment_md5 = hashlib.md5()
-    for encoded_block in encoded_block_list:
-        segment_size += len(encoded_block)
-        segment_adler32 = zlib.adler32(encoded_block, segment_adler32) 
-        segment_md5.update(encoded_block)
-    segment_md5_digest = segment_md5.digest()
+    segment_size, segment_adler32, segment_md5_digest, mismatch = \
+        _sequence_digests(control, sequence_row, encoded_block_list, read_size)
+
+    if mismatch:
+        error_message = "{0} md5 digest mismatch {1} {2}".format(
+            request["retrieve-id"],
+            value_file_path,
+            sequence_row["value_file_offset"])
+        log.error("user_request_id = {0}, {1}".format(
+                  request["user-request-id"], error_message))
+        resources.event_push_client.error("digest_mismatch", error_message)
+        control["result"] = "digest_mismatch"
+        control["error-message"] = error_message
+        _send_error_reply(resources, request, control)
+        return
 
     reply = {
         "message-type"          : "retrieve-key-reply",
@@ -215,8 +299,8 @@ def _process_request(resources):
     push_socket = _get_reply_push_socket(resources, request["client-address"])
     push_socket.send_json(reply, zmq.SNDMORE)
     for encoded_block in encoded_block_list[:-1]:
-        push_socket.send(encoded_block, zmq.SNDMORE)
-    push_socket.send(encoded_block_list[-1])
+        push_socket.send(encoded_block, zmq.SNDMORE, copy=False)
+    push_socket.send(encoded_block_list[-1], copy=False)
         
 def _make_close_pass(resources, current_time):
     log = logging.getLogger("_make_close_pass")
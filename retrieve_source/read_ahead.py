@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+read_ahead.py
+
+class ReadAhead
+
+Bookkeeping for sequences the database pool controller reads ahead of the
+client.
+
+A client may grant a read-ahead credit in retrieve-key-start. We then keep
+up to that many sequence reads queued at the io controller beyond the one
+the client has asked for, so the disk read of sequence n+1 overlaps the
+network transfer (and decoding) of sequence n. The io workers send the
+replies for those reads back to us; we hold them until the client's
+retrieve-key-next arrives, or hand them on at once if it is already
+waiting.
+
+Each read ahead is tracked by the message-id we give it. Entries that the
+client never asks for (abandoned retrieves) are dropped after max_age
+seconds. If the client is waiting on an entry we drop, we give its
+request back to the caller, which owes the client an error reply.
+Buffered bytes, counting reads still in flight at their sequence size,
+are held under max_bytes: past that we stop reading ahead and the client
+falls back to one read per request.
+"""
+import logging
+import os
+import time
+
+_max_credit = int(os.environ.get("NIMBUSIO_RETRIEVE_MAX_READ_AHEAD", "4"))
+_max_bytes = int(os.environ.get("NIMBUSIO_RETRIEVE_READ_AHEAD_MAX_BYTES",
+                                str(256 * 1024 * 1024)))
+_max_age = float(os.environ.get("NIMBUSIO_RETRIEVE_READ_AHEAD_MAX_AGE",
+                                "60.0"))
+
+def _data_size(data):
+    return sum([len(block) for block in data])
+
+class ReadAhead(object):
+    """
+    max_credit
+        the most sequences we will read ahead for one retrieve, whatever
+        the client grants
+
+    max_bytes
+        the most bytes we will hold (or have in flight) for all retrieves
+
+    max_age
+        seconds we hold an entry before we give up on the client
+    """
+    def __init__(self,
+                 max_credit=_max_credit,
+                 max_bytes=_max_bytes,
+                 max_age=_max_age):
+        self._log = logging.getLogger("ReadAhead")
+        self._max_credit = max_credit
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._entries = dict()
+        self.stats = {
+            "issued"            : 0,
+            "hits"              : 0,
+            "waits"             : 0,
+            "discarded"         : 0,
+            "entries"           : 0,
+            "buffered-bytes"    : 0,
+        }
+
+    @staticmethod
+    def message_id(retrieve_id, sequence_index):
+        """
+        the message-id we give the read of one sequence of a retrieve
+        """
+        return "{0}-read-ahead-{1}".format(retrieve_id, sequence_index)
+
+    def credit(self, message):
+        """
+        the number of sequences we will read ahead for this
+        retrieve-key-start message
+        """
+        return max(0, min(int(message.get("read-ahead-credit", 0)),
+                          self._max_credit))
+
+    def has_room(self, size):
+        return self.stats["buffered-bytes"] + size <= self._max_bytes
+
+    def has_entry(self, retrieve_id, sequence_index):
+        return self.message_id(retrieve_id, sequence_index) in self._entries
+
+    def issue(self, retrieve_id, sequence_index, size):
+        """
+        record a read sent to the io controller
+
+        return the message-id for it
+        """
+        message_id = self.message_id(retrieve_id, sequence_index)
+        self._entries[message_id] = {"retrieve-id"  : retrieve_id,
+                                     "request"      : None,
+                                     "reply"        : None,
+                                     "data"         : None,
+                                     "size"         : size,
+                                     "timestamp"    : time.time()}
+        self.stats["buffered-bytes"] += size
+        self.stats["issued"] += 1
+        self.stats["entries"] = len(self._entries)
+        return message_id
+
+    def request(self, retrieve_id, sequence_index, message):
+        """
+        the client asks for a sequence we have read ahead
+
+        return (reply, data) if we have it, otherwise None: we hold
+        the client's message until the reply arrives
+        """
+        message_id = self.message_id(retrieve_id, sequence_index)
+        entry = self._entries[message_id]
+        if entry["reply"] is None:
+            entry["request"] = message
+            self.stats["waits"] += 1
+            return None
+
+        self._remove(message_id)
+        self.stats["hits"] += 1
+        return entry["reply"], entry["data"]
+
+    def arrived(self, reply, data):
+        """
+        an io worker has sent the reply for a read ahead
+
+        return (request, reply, data) if the client is waiting for it,
+        otherwise None: we hold the reply until the client asks
+        """
+        message_id = reply["message-id"]
+        entry = self._entries.get(message_id)
+        if entry is None:
+            self._log.warn("discarding reply for unknown {0}".format(
+                           message_id))
+            self.stats["discarded"] += 1
+            return None
+
+        if entry["request"] is not None:
+            self._remove(message_id)
+            return entry["request"], reply, data
+
+        size = _data_size(data)
+        self.stats["buffered-bytes"] += size - entry["size"]
+        entry["size"] = size
+        entry["reply"] = reply
+        entry["data"] = data
+        return None
+
+    def cancel(self, retrieve_id):
+        """
+        drop the entries for a retrieve the client has given up on
+
+        return the client requests that were waiting on them
+        """
+        cancelled = [message_id \
+                     for message_id, entry in self._entries.items() \
+                     if entry["retrieve-id"] == retrieve_id]
+        self.stats["discarded"] += len(cancelled)
+        return self._drop(cancelled)
+
+    def expire(self, current_time):
+        """
+        drop the entries that have waited longer than max_age
+
+        return the client requests that were waiting on them
+        """
+        expired = [message_id \
+                   for message_id, entry in self._entries.items() \
+                   if current_time - entry["timestamp"] > self._max_age]
+        for message_id in expired:
+            self._log.info("expiring {0}".format(message_id))
+        self.stats["discarded"] += len(expired)
+        return self._drop(expired)
+
+    def _drop(self, message_ids):
+        requests = list()
+        for message_id in message_ids:
+            entry = self._remove(message_id)
+            if entry["request"] is not None:
+                requests.append(entry["request"])
+        return requests
+
+    def _remove(self, message_id):
+        entry = self._entries.pop(message_id)
+        self.stats["buffered-bytes"] -= entry["size"]
+        self.stats["entries"] = len(self._entries)
+        return entry
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+sequence_row_cache.py
+
+class SequenceRowCache
+
+The sequence rows the database pool workers find for a segment, kept by
+the database pool controller so repeated retrieves of the same segment
+(hot keys, range requests) skip the database.
+
+Entries are keyed by (collection_id, unified_id, conjoined_part,
+segment_num, handoff_node_id), discarded least recently used first to stay
+within a byte bound, and invalidated by the value files they refer to when
+the defragger, gc_rewrite_value_files or the garbage collector change
+segment_sequence (see tools/sequence_row_invalidation.py).
+
+A database query that was started before an invalidation may return the
+old rows after it, so the caller takes the cache generation when it starts
+a query and only stores the rows if the generation has not changed.
+"""
+from collections import defaultdict, OrderedDict
+import logging
+import os
+
+_max_bytes = int(os.environ.get("NIMBUSIO_RETRIEVE_SEQUENCE_ROW_CACHE_BYTES",
+                                str(64 * 1024 * 1024)))
+
+# a rough size of one cached row dict, with its keys and values
+_row_size = 1024
+
+def sequence_row_cache_key(message):
+    """
+    the cache key for a retrieve-key-start message
+    """
+    return (message["collection-id"],
+            message["segment-unified-id"],
+            message["segment-conjoined-part"],
+            message["segment-num"],
+            message["handoff-node-id"], )
+
+class SequenceRowCache(object):
+    """
+    max_bytes
+        the (estimated) size we hold the cache to; 0 disables it
+    """
+    def __init__(self, max_bytes=_max_bytes):
+        self._log = logging.getLogger("SequenceRowCache")
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._keys_by_value_file_id = defaultdict(set)
+        self._size = 0
+        self.generation = 0
+        self.stats = {
+            "hits"          : 0,
+            "misses"        : 0,
+            "invalidations" : 0,
+        }
+
+    @property
+    def enabled(self):
+        return self._max_bytes > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key):
+        """
+        return the cached sequence rows for key, or None
+        """
+        sequence_rows = self._entries.pop(key, None)
+        if sequence_rows is None:
+            self.stats["misses"] += 1
+            return None
+
+        # put it back at the most recently used end
+        self._entries[key] = sequence_rows
+        self.stats["hits"] += 1
+        return sequence_rows
+
+    def put(self, key, sequence_rows, generation):
+        """
+        store the sequence rows from a query started at generation
+        """
+        if not self.enabled or generation != self.generation:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = sequence_rows
+        self._size += len(sequence_rows) * _row_size
+        for sequence_row in sequence_rows:
+            self._keys_by_value_file_id[sequence_row["value_file_id"]].add(key)
+
+        while self._size > self._max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def invalidate(self, value_file_ids):
+        """
+        drop the entries that refer to any of value_file_ids, or every
+        entry if value_file_ids is None
+        """
+        self.generation += 1
+        self.stats["invalidations"] += 1
+
+        if value_file_ids is None:
+            self._log.info("invalidating all {0} entries".format(
+                           len(self._entries)))
+            self._entries.clear()
+            self._keys_by_value_file_id.clear()
+            self._size = 0
+            return
+
+        keys = set()
+        for value_file_id in value_file_ids:
+            keys.update(self._keys_by_value_file_id.get(value_file_id, []))
+        self._log.debug("invalidating {0} entries for {1} value files".format(
+                        len(keys), len(value_file_ids)))
+        for key in keys:
+            self._remove(key)
+
+    def _remove(self, key):
+        sequence_rows = self._entries.pop(key)
+        self._size -= len(sequence_rows) * _row_size
+        for sequence_row in sequence_rows:
+            value_file_id = sequence_row["value_file_id"]
+            keys = self._keys_by_value_file_id.get(value_file_id)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._keys_by_value_file_id[value_file_id]
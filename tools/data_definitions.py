@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 import os
 import os.path
 import re
+import sys
 import time
 
 memcached_central_key_template = "nimbusio_central_{0}_by_{1}_{2}" 
@@ -48,13 +49,21 @@ def compute_expected_slice_count(file_size, slice_size=incoming_slice_size):
         expected_slice_count += 1
     return expected_slice_count
 
+def data_view(data, offset, size):
+    """
+    return a read-only slice of data that refers to, rather than copies,
+    the underlying memory: a buffer in Python 2, a memoryview in Python 3.
+    zfec, hashlib, zlib and zeromq accept either.
+    """
+    if sys.version_info[0] < 3:
+        return buffer(data, offset, size)
+    return memoryview(data)[offset:offset+size]
+
 def _slice_generator(data, slice_size):
     start_pos = 0
-    end_pos = slice_size
     while start_pos < len(data):
-        yield data[start_pos:end_pos]
-        start_pos = end_pos
-        end_pos += slice_size
+        yield data_view(data, start_pos, slice_size)
+        start_pos += slice_size
 
 def block_generator(data):
     return _slice_generator(data, block_size)
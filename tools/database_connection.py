@@ -23,6 +23,26 @@ local_database_user = os.environ.get("NIMBUSIO_LOCAL_USER", None)
 node_database_name_prefix = "nimbusio_node"
 node_database_user_prefix = "nimbusio_node_user"
 
+# the server doesn't know the prepared statement we asked for: we have
+# a new server session
+_invalid_sql_statement_name = "26000"
+
+class PreparedStatement(object):
+    """
+    A statement that is PREPAREd once on each connection that runs it,
+    and then executed by name, to save the server parsing and planning it
+    on every call.
+
+    name
+        an SQL identifier, unique within the program
+
+    query
+        the statement, with its parameters as $1, $2, ...
+    """
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+
 class DatabaseConnection(object):
     """A connection to the nimbus.io databases"""
     def __init__(
@@ -44,6 +64,7 @@ class DatabaseConnection(object):
         self._connection.set_isolation_level(
             psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
         self._in_transaction = False
+        self._prepared_statement_names = set()
         cursor = self._connection.cursor()
         cursor.execute("set time zone 'UTC'")
         cursor.close()
@@ -113,6 +134,85 @@ class DatabaseConnection(object):
 
         return returned_id
 
+    def _execute_prepared(self, cursor, prepared_statement, args):
+        if prepared_statement.name not in self._prepared_statement_names:
+            cursor.execute("prepare {0} as {1}".format(
+                prepared_statement.name, prepared_statement.query))
+            self._prepared_statement_names.add(prepared_statement.name)
+
+        if len(args) == 0:
+            cursor.execute("execute {0}".format(prepared_statement.name))
+        else:
+            cursor.execute("execute {0} ({1})".format(
+                prepared_statement.name, ", ".join(["%s"] * len(args))),
+                args)
+
+    def _run_prepared(self, prepared_statement, args, result_function):
+        """
+        run a prepared statement, preparing it if this connection hasn't.
+        If the server has lost our prepared statements (a new session
+        behind a reconnect or a pooler) prepare it again.
+        """
+        cursor = self._connection.cursor()
+        try:
+            try:
+                self._execute_prepared(cursor, prepared_statement, args)
+            except psycopg2.ProgrammingError as instance:
+                if instance.pgcode != _invalid_sql_statement_name or \
+                   self._in_transaction:
+                    raise
+                self._prepared_statement_names.clear()
+                self._execute_prepared(cursor, prepared_statement, args)
+            return result_function(cursor)
+        finally:
+            cursor.close()
+
+    def fetch_one_row_prepared(self, prepared_statement, args):
+        """run a prepared query and return the contents of one row"""
+        return self._run_prepared(prepared_statement, 
+                                  args, 
+                                  lambda cursor: cursor.fetchone())
+
+    def fetch_all_rows_prepared(self, prepared_statement, args):
+        """run a prepared query and return the contents of all rows"""
+        return self._run_prepared(prepared_statement, 
+                                  args, 
+                                  lambda cursor: cursor.fetchall())
+
+    def execute_prepared(self, prepared_statement, args):
+        """run a prepared statement"""
+        return self._run_prepared(prepared_statement, 
+                                  args, 
+                                  lambda cursor: cursor.rowcount)
+
+    def listen(self, channel):
+        """
+        start listening for NOTIFY on channel
+        the connection must not be in a transaction
+        """
+        assert not self._in_transaction
+        cursor = self._connection.cursor()
+        cursor.execute("listen {0}".format(channel))
+        cursor.close()
+
+    def fileno(self):
+        """
+        the connection's socket, for select or poll, to wait for
+        notifications
+        """
+        return self._connection.fileno()
+
+    def get_notifications(self):
+        """
+        return a list of (channel, payload) for the notifications that
+        have arrived since the last call
+        """
+        self._connection.poll()
+        notifications = [(notify.channel, notify.payload, ) \
+                         for notify in self._connection.notifies]
+        del self._connection.notifies[:]
+        return notifications
+
     def begin_transaction(self):
         """
         start a transaction
@@ -7,6 +7,7 @@ to a resilient server
 """
 import logging
 import os
+import time
 import uuid
 
 from  gevent.greenlet import Greenlet
@@ -25,6 +26,10 @@ _handshake_retry_interval = 60.0
 _max_idle_time = 10 * 60.0
 _reporting_interval = 60.0
 _connect_delay = 60.0
+# body frames at least this big are sent without copying; for smaller
+# ones (a single zfec share is about 4KB) zeromq's tracking of the frame
+# costs more than the copy
+_zero_copy_threshold = 64 * 1024
 
 class GreenletResilientClient(Greenlet):
     """
@@ -47,6 +52,11 @@ class GreenletResilientClient(Greenlet):
     deliverator
         handle to the deliverator object
 
+    ack_callback
+        if not None, called with (server_node_name, seconds) for each
+        message the server acks, and with (server_node_name, None) for
+        an ack timeout
+
     GreenletResilientClient uses two zeromq patterns to maintain a connection
     to a resilient server.
 
@@ -82,7 +92,8 @@ class GreenletResilientClient(Greenlet):
         client_tag, 
         client_address,
         deliverator,
-        connect_messages=list()
+        connect_messages=list(),
+        ack_callback=None
     ):
         Greenlet.__init__(self)
 
@@ -97,6 +108,7 @@ class GreenletResilientClient(Greenlet):
         self._client_tag = client_tag
         self._client_address = client_address
         self._deliverator = deliverator
+        self._ack_callback = ack_callback
 
         self._send_queue = gevent.queue.Queue()
 
@@ -215,6 +227,7 @@ class GreenletResilientClient(Greenlet):
                 # block until we get a message to send
                 message_to_send = self._send_queue.get()
 
+                send_time = time.time()
                 self._send_message(message_to_send)
 
                 # wait for  an ack
@@ -232,11 +245,18 @@ class GreenletResilientClient(Greenlet):
 
                     self.connected = False
 
+                    if self._ack_callback is not None:
+                        self._ack_callback(self._server_node_name, None)
+
                     self._deliver_failure_reply(message_to_send)
 
                     gevent.sleep(_handshake_retry_interval)
                     break
 
+                if self._ack_callback is not None:
+                    self._ack_callback(self._server_node_name,
+                                       time.time() - send_time)
+
     def _send_message(self, message):
         self._log.debug("sending message: %s" % (message.control, ))
         message.control["client-tag"] = self._client_tag
@@ -249,13 +269,20 @@ class GreenletResilientClient(Greenlet):
             else:
                 message = message._replace(body=[message.body, ])
 
+        # the body segments may be views of a larger buffer (zfec shares):
+        # let zeromq reference the big ones rather than copy them
         if message.body is None:
             self._req_socket.send_json(message.control)
         else:
             self._req_socket.send_json(message.control, zmq.SNDMORE)
             for segment in message.body[:-1]:
-                self._req_socket.send(segment, zmq.SNDMORE)
-            self._req_socket.send(message.body[-1])
+                self._req_socket.send(
+                    segment, 
+                    zmq.SNDMORE, 
+                    copy=(len(segment) < _zero_copy_threshold))
+            self._req_socket.send(
+                message.body[-1], 
+                copy=(len(message.body[-1]) < _zero_copy_threshold))
 
     def _deliver_failure_reply(self, message_to_send):
         """
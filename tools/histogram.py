@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+histogram.py
+
+class Histogram
+
+Count values in fixed buckets, for stats that are published as JSON.
+"""
+import bisect
+
+# upper bounds, in seconds
+latency_bounds = [
+    0.0001, 0.00025, 0.0005, 
+    0.001, 0.0025, 0.005, 
+    0.01, 0.025, 0.05, 
+    0.1, 0.25, 0.5, 
+    1.0, 2.5, 5.0, 10.0,
+]
+
+# upper bounds for counts of things: queue depth, batch size
+count_bounds = [0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, ]
+
+class Histogram(object):
+    """
+    bounds
+        sorted upper bounds of the buckets: a value goes in the first
+        bucket whose bound it does not exceed. There is one more bucket,
+        for values above the last bound.
+    """
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._count = 0
+        self._total = 0
+        self._max = None
+
+    @property
+    def count(self):
+        return self._count
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        self._total += value
+        if self._max is None or value > self._max:
+            self._max = value
+
+    def to_dict(self):
+        """
+        return a dict that can be sent as JSON. 'counts' has one more
+        entry than 'bounds'
+        """
+        return {
+            "bounds"    : list(self._bounds),
+            "counts"    : list(self._counts),
+            "count"     : self._count,
+            "total"     : self._total,
+            "max"       : self._max,
+        }
@@ -2,37 +2,135 @@
 """
 operational_stats_redis_sink.py
 
-A Greenlet that acts as a sink: 
+A Greenlet that acts as a sink:
 reading status entries a queue and passing them to redis
 
+Entries are added up in memory per (redis key, collection_id) and flushed
+to redis every flush_interval seconds, as one pipeline of HINCRBY commands.
+If a flush fails, the counts are kept and retried at the next interval, for
+up to max_staleness seconds. Anything left is flushed when the sink stops.
+
 See Ticket #64 Implement Operational Stats Accumulation
 """
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+import os
+import time
+
+import gevent.queue
 
+from tools.redis_connection import create_redis_connection
 from tools.redis_sink import RedisSink
 from tools.operational_stats_redis_key import compute_key
 
 redis_queue_entry_tuple = namedtuple("RedisQueueEntry", ["timestamp",
                                                          "collection_id",
                                                          "value"])
+
+_flush_interval = float(
+    os.environ.get("NIMBUSIO_REDIS_SINK_FLUSH_INTERVAL", "0.5"))
+_max_staleness = float(
+    os.environ.get("NIMBUSIO_REDIS_SINK_MAX_STALENESS", "60.0"))
+
 class OperationalStatsRedisSink(RedisSink):
     """
-    A Greenlet that acts as a sink: 
+    A Greenlet that acts as a sink:
     reading status entries a queue and passing them to redis
 
     See Ticket #64 Implement Operational Stats Accumulation
     """
-    def __init__(self, halt_event, redis_queue, node_name):
+    def __init__(self,
+                 halt_event,
+                 redis_queue,
+                 node_name,
+                 flush_interval=_flush_interval,
+                 max_staleness=_max_staleness):
         RedisSink.__init__(self, halt_event, redis_queue)
         self._node_name = node_name
+        self._flush_interval = flush_interval
+        self._max_staleness = max_staleness
+        self._counters = defaultdict(int)
+        self._oldest_count_time = None
+
+    def _run(self):
+        try:
+            self._run_aggregated()
+        finally:
+            # we get here from halt_event or from kill()
+            self._final_flush()
+
+    def _run_aggregated(self):
+        self._redis_connection = create_redis_connection()
+        next_flush_time = time.time() + self._flush_interval
+
+        self._log.debug("start halt_event loop")
+        while not self._halt_event.is_set():
+            timeout = max(next_flush_time - time.time(), 0.0)
+            try:
+                key, entry = self._redis_queue.get(block=True,
+                                                   timeout=min(timeout, 1.0))
+            except gevent.queue.Empty:
+                pass
+            else:
+                self.store(key, entry)
+
+            if time.time() >= next_flush_time:
+                self.flush()
+                next_flush_time = time.time() + self._flush_interval
+
+        self._log.debug("end halt_event loop")
 
     def store(self, partial_key, entry):
         """
-        store one entry from the queue in redis
+        add one entry from the queue to the counts waiting for a flush
         """
         key = compute_key(self._node_name, entry.timestamp, partial_key)
-        self._log.debug("hincrby({0}, {1}, {2})".format(key, 
-                                                        entry.collection_id, 
-                                                        entry.value))
-        self._redis_connection.hincrby(key, entry.collection_id, entry.value)
+        if self._oldest_count_time is None:
+            self._oldest_count_time = time.time()
+        self._counters[(key, entry.collection_id, )] += entry.value
+
+    def flush(self):
+        """
+        send the counts we have accumulated to redis in a single pipeline
+        """
+        if len(self._counters) == 0:
+            return
+
+        pipeline = self._redis_connection.pipeline(transaction=False)
+        for (key, collection_id, ), value in self._counters.items():
+            pipeline.hincrby(key, collection_id, value)
+
+        try:
+            pipeline.execute()
+            self._log.debug("flushed {0} counters".format(
+                            len(self._counters)))
+        except Exception:
+            staleness = time.time() - self._oldest_count_time
+            if staleness < self._max_staleness:
+                self._log.exception("flush failed, will retry: " \
+                                    "{0} counters {1:.1f} seconds old".format(
+                                    len(self._counters), staleness))
+                return
+            self._log.exception("flush failed, discarding: " \
+                                "{0} counters {1:.1f} seconds old".format(
+                                len(self._counters), staleness))
+
+        self._counters.clear()
+        self._oldest_count_time = None
+
+    def _final_flush(self):
+        while True:
+            try:
+                key, entry = self._redis_queue.get_nowait()
+            except gevent.queue.Empty:
+                break
+            self.store(key, entry)
+
+        if len(self._counters) == 0 or self._redis_connection is None:
+            return
 
+        self._log.info("final flush of {0} counters".format(
+                       len(self._counters)))
+        try:
+            self.flush()
+        except Exception:
+            self._log.exception("final flush")
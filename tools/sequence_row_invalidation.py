@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+sequence_row_invalidation.py
+
+Tell the retrieve_source sequence row cache that segment_sequence rows
+have changed, with a NOTIFY on the node local database.
+
+Programs that move sequences between value files (the defragger and
+gc_rewrite_value_files) name the value files they moved them out of; the
+garbage collector, which deletes rows wholesale, invalidates everything.
+
+The NOTIFY goes out in the caller's transaction, so the listener hears
+about it when, and only if, the transaction commits.
+"""
+sequence_row_channel = "nimbusio_sequence_rows"
+
+_invalidate_all_payload = "*"
+
+# postgres limits a notification payload to 8000 bytes
+_max_ids_per_notification = 500
+
+def invalidate_value_files(connection, value_file_ids):
+    """
+    notify that rows referring to any of value_file_ids have changed
+    """
+    value_file_ids = sorted(value_file_ids)
+    for i in range(0, len(value_file_ids), _max_ids_per_notification):
+        payload = ",".join(
+            [str(value_file_id) for value_file_id in \
+             value_file_ids[i:i+_max_ids_per_notification]])
+        connection.execute("select pg_notify(%s, %s)",
+                           [sequence_row_channel, payload, ])
+
+def invalidate_all(connection):
+    """
+    notify that any row may have changed
+    """
+    connection.execute("select pg_notify(%s, %s)",
+                       [sequence_row_channel, _invalidate_all_payload, ])
+
+def parse_invalidation(payload):
+    """
+    return the set of value file ids named in a notification payload,
+    or None if the notification invalidates everything
+    """
+    if payload == _invalidate_all_payload:
+        return None
+    return set([int(value_file_id) for value_file_id in payload.split(",")])
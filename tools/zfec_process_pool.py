@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+zfec_process_pool.py
+
+A pool of worker processes that run zfec, so that the gevent hub in a
+web server is not blocked while a large slice is being encoded or decoded.
+
+Each worker owns a pair of shared memory buffers, created before the worker
+is forked: a data buffer, big enough for one slice, and a share buffer, big
+enough for all the zfec shares of one slice.
+
+To encode, the caller copies a slice into the worker's data buffer, sends
+the worker the size of the data over a pipe, and waits cooperatively for the
+reply. The worker leaves the zfec shares in its share buffer, which the
+caller copies out in one piece.
+
+To decode, the caller copies min_segments shares of each block into the
+share buffer, and the worker leaves the data blocks in the data buffer.
+
+Only small control tuples are pickled.
+"""
+import ctypes
+import logging
+import multiprocessing
+import os
+import signal
+from multiprocessing.sharedctypes import RawArray
+from collections import namedtuple
+import time
+
+import gevent.queue
+import gevent.socket
+
+from tools.data_definitions import block_size, \
+        encoded_block_slice_size, \
+        data_view
+
+_worker_tuple = namedtuple("Worker", ["process",
+                                      "connection",
+                                      "data_buffer",
+                                      "share_buffer", ])
+
+_reporting_interval = 60.0
+_join_timeout = 3.0
+# how long we wait for an idle worker before we give up on the request
+_acquire_timeout = 60.0
+# how long a worker may take over one slice before we decide it is wedged
+_reply_timeout = 60.0
+
+class ZfecProcessPoolError(Exception):
+    pass
+
+def _max_block_count(max_data_size):
+    block_count = max_data_size // block_size
+    if max_data_size % block_size != 0:
+        block_count += 1
+    return block_count
+
+def _share_offset(block_index, segment_index, num_segments):
+    """
+    the share buffer is laid out block by block, with the shares of each
+    block stored in segment order: num_segments shares per block for an
+    encode, min_segments for a decode
+    """
+    return ((block_index * num_segments) + segment_index) * \
+            encoded_block_slice_size
+
+def _encode(encoder, num_segments, data_address, share_address, data_size):
+    block_count = 0
+    share_size = 0
+    for offset in range(0, data_size, block_size):
+        data_block = ctypes.string_at(data_address + offset,
+                                      min(block_size, data_size - offset))
+        for segment_index, zfec_share in \
+            enumerate(encoder.encode(data_block)):
+            ctypes.memmove(share_address + _share_offset(block_count,
+                                                         segment_index,
+                                                         num_segments),
+                           zfec_share,
+                           len(zfec_share))
+            share_size = len(zfec_share)
+        block_count += 1
+
+    return block_count, share_size
+
+def _decode(decoder,
+            min_segments,
+            data_address,
+            share_address,
+            block_count,
+            share_size,
+            share_numbers,
+            padding_size):
+    data_size = 0
+    for block_index in range(block_count):
+        last_block = block_index == block_count-1
+        size = (share_size if last_block else encoded_block_slice_size)
+        shares = [ctypes.string_at(share_address + \
+                                   _share_offset(block_index,
+                                                 segment_index,
+                                                 min_segments),
+                                   size) \
+                  for segment_index in range(min_segments)]
+        data_block = decoder.decode(shares,
+                                    share_numbers,
+                                    (padding_size if last_block else 0))
+        ctypes.memmove(data_address + data_size, data_block, len(data_block))
+        data_size += len(data_block)
+
+    return data_size
+
+def _zfec_worker(min_segments,
+                 num_segments,
+                 data_buffer,
+                 share_buffer,
+                 connection):
+    """
+    run in the worker process: encode or decode slices until we
+    get None (or our parent goes away)
+
+    we get ("encode", data_size) and reply (block_count, share_size, None)
+
+    we get ("decode", block_count, share_size, share_numbers, padding_size)
+    and reply (data_size, None, None)
+
+    if anything goes wrong we reply (None, None, error_message)
+    """
+    from zfec.easyfec import Encoder, Decoder
+
+    encoder = Encoder(min_segments, num_segments)
+    decoder = Decoder(min_segments, num_segments)
+    data_address = ctypes.addressof(data_buffer)
+    share_address = ctypes.addressof(share_buffer)
+
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+
+        try:
+            if request[0] == "encode":
+                _, data_size = request
+                block_count, share_size = _encode(encoder,
+                                                  num_segments,
+                                                  data_address,
+                                                  share_address,
+                                                  data_size)
+                reply = (block_count, share_size, None, )
+            else:
+                _, block_count, share_size, share_numbers, padding_size = \
+                        request
+                data_size = _decode(decoder,
+                                    min_segments,
+                                    data_address,
+                                    share_address,
+                                    block_count,
+                                    share_size,
+                                    share_numbers,
+                                    padding_size)
+                reply = (data_size, None, None, )
+        except Exception as instance:
+            connection.send((None, None, str(instance), ))
+            continue
+
+        connection.send(reply)
+
+    connection.close()
+
+class ZfecProcessPool(object):
+    """
+    min_segments
+        the number of segments needed to reconstruct the data
+
+    num_segments
+        the number of segments to encode
+
+    worker_count
+        the number of worker processes
+
+    max_data_size
+        the largest slice we will be asked to encode or decode
+        (i.e. incoming_slice_size)
+
+    event_push_client
+        optional: used to publish queue depth stats periodically
+    """
+    def __init__(self,
+                 min_segments,
+                 num_segments,
+                 worker_count,
+                 max_data_size,
+                 event_push_client=None):
+        self._log = logging.getLogger("ZfecProcessPool")
+        self._min_segments = min_segments
+        self._num_segments = num_segments
+        self._max_data_size = max_data_size
+        self._event_push_client = event_push_client
+
+        self._max_block_count = _max_block_count(max_data_size)
+        share_buffer_size = self._max_block_count * \
+                            num_segments * \
+                            encoded_block_slice_size
+
+        self._workers = list()
+        self._idle_workers = gevent.queue.Queue()
+        for worker_number in range(worker_count):
+            worker = self._start_worker(
+                "zfec-worker-{0}".format(worker_number+1),
+                RawArray(ctypes.c_char, max_data_size),
+                RawArray(ctypes.c_char, share_buffer_size)
+            )
+            self._workers.append(worker)
+            self._idle_workers.put(worker)
+
+        self._queue_depth = 0
+        self.stats = {
+            "worker-count"      : worker_count,
+            "queue-depth"       : 0,
+            "max-queue-depth"   : 0,
+            "busy-workers"      : 0,
+            "encodes"           : 0,
+            "encoded-bytes"     : 0,
+            "encode-seconds"    : 0.0,
+            "decodes"           : 0,
+            "decoded-bytes"     : 0,
+            "decode-seconds"    : 0.0,
+            "wait-seconds"      : 0.0,
+            "replaced-workers"  : 0,
+        }
+        self._last_report_time = time.time()
+
+    def _start_worker(self, name, data_buffer, share_buffer):
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(
+            target=_zfec_worker,
+            name=name,
+            args=(self._min_segments,
+                  self._num_segments,
+                  data_buffer,
+                  share_buffer,
+                  child_connection, )
+        )
+        process.daemon = True
+        process.start()
+        child_connection.close()
+        self._log.info("started {0} pid={1}".format(process.name,
+                                                    process.pid))
+        return _worker_tuple(process=process,
+                             connection=parent_connection,
+                             data_buffer=data_buffer,
+                             share_buffer=share_buffer)
+
+    def _replace_worker(self, worker):
+        """
+        we don't know what state a worker is in: stop its process and
+        start a new one, with the same buffers, in its place
+        """
+        self._log.warn("replacing {0}".format(worker.process.name))
+        self._workers.remove(worker)
+        worker.connection.close()
+        worker.process.terminate()
+        worker.process.join(_join_timeout)
+        if worker.process.is_alive():
+            # a stopped process does not act on SIGTERM
+            self._log.warn("killing {0}".format(worker.process.name))
+            os.kill(worker.process.pid, signal.SIGKILL)
+            worker.process.join(_join_timeout)
+        new_worker = self._start_worker(worker.process.name,
+                                        worker.data_buffer,
+                                        worker.share_buffer)
+        self._workers.append(new_worker)
+        self._release_worker(new_worker)
+        self.stats["replaced-workers"] += 1
+
+    def encode(self, data):
+        """
+        data
+            a slice of at most max_data_size bytes
+
+        return
+            a list size=num_segments of lists of encoded blocks (zfec shares)
+            the same as ZfecSegmenter.encode(block_generator(data))
+        """
+        assert len(data) <= self._max_data_size, len(data)
+
+        worker = self._acquire_worker()
+        encode_start_time = time.time()
+        ctypes.memmove(ctypes.addressof(worker.data_buffer), data, len(data))
+        block_count, share_size = self._call_worker(worker,
+                                                    ("encode", len(data), ))
+
+        # copy all the shares out of the worker's buffer at once, so it can
+        # take another slice, and hand back views into the copy
+        encoded_data = ctypes.string_at(
+            ctypes.addressof(worker.share_buffer),
+            _share_offset(block_count, 0, self._num_segments)
+        )
+        self._release_worker(worker)
+
+        segments = list()
+        for segment_index in range(self._num_segments):
+            segment = list()
+            for block_index in range(block_count):
+                size = (share_size if block_index == block_count-1 \
+                        else encoded_block_slice_size)
+                segment.append(
+                    data_view(encoded_data,
+                              _share_offset(block_index,
+                                            segment_index,
+                                            self._num_segments),
+                              size)
+                )
+            segments.append(segment)
+
+        self.stats["encodes"] += 1
+        self.stats["encoded-bytes"] += len(data)
+        self.stats["encode-seconds"] += time.time() - encode_start_time
+        self._report_stats()
+
+        return segments
+
+    def decode(self, segments, segment_numbers, padding_size):
+        """
+        segments
+            a list of at least min_segments lists of encoded blocks
+            (zfec shares), as received from the data readers
+        segment_numbers
+            a list of ints giving the segment numbers of the segments (1..n)
+        padding_size
+            the zfec padding size of the last block (earlier blocks are 0)
+
+        return
+            a list of data blocks
+            the same as ZfecSegmenter.decode(segments,
+                                             segment_numbers,
+                                             padding_size)
+        """
+        segments = segments[:self._min_segments]
+        share_numbers = [n-1 for n in segment_numbers[:self._min_segments]]
+        block_count = len(segments[0])
+        assert block_count <= self._max_block_count, block_count
+        share_size = len(segments[0][-1])
+
+        worker = self._acquire_worker()
+        decode_start_time = time.time()
+        share_address = ctypes.addressof(worker.share_buffer)
+        for segment_index, segment in enumerate(segments):
+            for block_index, share in enumerate(segment):
+                # bytes() does not copy a share that is already a string
+                ctypes.memmove(share_address + \
+                               _share_offset(block_index,
+                                             segment_index,
+                                             self._min_segments),
+                               bytes(share),
+                               len(share))
+        data_size, _ = self._call_worker(worker,
+                                         ("decode",
+                                          block_count,
+                                          share_size,
+                                          share_numbers,
+                                          padding_size, ))
+
+        # copy each block out of the worker's buffer before we give the
+        # worker back
+        data_address = ctypes.addressof(worker.data_buffer)
+        data_list = [ctypes.string_at(data_address + offset,
+                                      min(block_size, data_size - offset)) \
+                     for offset in range(0, data_size, block_size)]
+        self._release_worker(worker)
+
+        self.stats["decodes"] += 1
+        self.stats["decoded-bytes"] += data_size
+        self.stats["decode-seconds"] += time.time() - decode_start_time
+        self._report_stats()
+
+        return data_list
+
+    def _acquire_worker(self):
+        """
+        wait cooperatively for an idle worker
+        """
+        wait_start_time = time.time()
+        self._queue_depth += 1
+        self.stats["queue-depth"] = self._queue_depth
+        self.stats["max-queue-depth"] = max(self.stats["max-queue-depth"],
+                                            self._queue_depth)
+        try:
+            worker = self._idle_workers.get(timeout=_acquire_timeout)
+        except gevent.queue.Empty:
+            raise ZfecProcessPoolError(
+                "no idle worker after {0} seconds".format(_acquire_timeout))
+        finally:
+            self._queue_depth -= 1
+            self.stats["queue-depth"] = self._queue_depth
+
+        self.stats["wait-seconds"] += time.time() - wait_start_time
+        self.stats["busy-workers"] += 1
+        return worker
+
+    def _release_worker(self, worker):
+        self.stats["busy-workers"] -= 1
+        self._idle_workers.put(worker)
+
+    def _call_worker(self, worker, request):
+        """
+        send a request to a worker and wait cooperatively for the reply
+
+        return the reply, less its error message
+        """
+        reply = None
+        try:
+            try:
+                worker.connection.send(request)
+                # let other greenlets run while the worker runs zfec
+                gevent.socket.wait_read(
+                    worker.connection.fileno(),
+                    timeout=_reply_timeout,
+                    timeout_exc=ZfecProcessPoolError(
+                        "no reply after {0} seconds".format(_reply_timeout)))
+                reply = worker.connection.recv()
+            except Exception:
+                self._log.exception("worker {0}".format(worker.process.name))
+                raise ZfecProcessPoolError("worker {0} failed".format(
+                                           worker.process.name))
+        finally:
+            # this also catches our greenlet being killed while it waits
+            if reply is None:
+                self._replace_worker(worker)
+
+        first, second, error_message = reply
+
+        if error_message is not None:
+            self._release_worker(worker)
+            raise ZfecProcessPoolError(error_message)
+
+        return first, second
+
+    def _report_stats(self):
+        current_time = time.time()
+        if current_time - self._last_report_time < _reporting_interval:
+            return
+        self._last_report_time = current_time
+
+        self._log.info("{encodes} encodes, {encoded-bytes} bytes, "
+                       "{decodes} decodes, {decoded-bytes} bytes, "
+                       "max queue depth {max-queue-depth}".format(
+                       **self.stats))
+        if self._event_push_client is not None:
+            self._event_push_client.info("zfec-process-pool-stats",
+                                         "zfec process pool stats",
+                                         stats=dict(self.stats))
+        self.stats["max-queue-depth"] = self._queue_depth
+
+    def close(self):
+        """
+        stop all worker processes
+        """
+        for worker in self._workers:
+            try:
+                worker.connection.send(None)
+            except Exception:
+                self._log.exception("worker {0}".format(worker.process.name))
+            worker.connection.close()
+        for worker in self._workers:
+            worker.process.join(_join_timeout)
+            if worker.process.is_alive():
+                self._log.warn("terminating {0}".format(worker.process.name))
+                worker.process.terminate()
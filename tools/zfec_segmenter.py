@@ -3,8 +3,17 @@
 zfec_segmenter.py
 
 Encodes/decodes segments using zfec.
+
+zfec's code is systematic: the first min_segments shares of a block are
+the block itself, cut into min_segments pieces. When we have all of them
+we join them back together, without running the decoder.
 """
-from zfec.easyfec import Encoder, Decoder
+from zfec import Encoder, Decoder
+
+from tools.data_definitions import data_view
+
+def _div_ceil(n, d):
+    return (n // d) + (1 if n % d else 0)
 
 class ZfecSegmenter(object):
     def __init__(self, min_segments, num_segments):
@@ -15,6 +24,21 @@ class ZfecSegmenter(object):
         modulus = len(data) % self.min_segments
         return (0 if modulus == 0 else self.min_segments - modulus)
 
+    def _primary_shares(self, data_block):
+        """
+        split a data block into min_segments views of the block.
+        Only a share that runs past the end of the block is copied, to
+        pad it with zeros.
+        """
+        share_size = _div_ceil(len(data_block), self.min_segments)
+        shares = list()
+        for i in range(self.min_segments):
+            share = data_view(data_block, i * share_size, share_size)
+            if len(share) < share_size:
+                share = bytes(share) + b"\x00" * (share_size - len(share))
+            shares.append(share)
+        return shares
+
     def encode(self, data_blocks):
         """
         data_blocks
@@ -22,16 +46,62 @@ class ZfecSegmenter(object):
 
         return
             a list size=num_segments of lists of encoded blocks (zfec shares)
+
+        zfec hands back the primary shares we give it, so the first
+        min_segments shares of each block are views of data_block, not copies
         """
         return_list = [list() for _ in range(self.num_segments)]
         encoder = Encoder(self.min_segments, self.num_segments)
         for data_block in data_blocks:
-            for segment_list, zfec_share in  zip(return_list, 
-                                                 encoder.encode(data_block)):
+            primary_shares = self._primary_shares(data_block)
+            for segment_list, zfec_share in zip(return_list,
+                                                encoder.encode(primary_shares)):
                 segment_list.append(zfec_share)
-                
+
         return return_list
 
+    def _decode_block(self, decoder, encoded_blocks, segment_numbers, padding):
+        # zfec hands back any primary shares we give it as-is, so they may
+        # be views; bytes() does not copy a block that is already a string
+        data = b"".join([bytes(block) for block in \
+                         decoder.decode(encoded_blocks, segment_numbers)])
+        if padding:
+            return data[:-padding]
+        return data
+
+    def _primary_share_indexes(self, segment_numbers):
+        """
+        return the index into segment_numbers of each primary share, in
+        order, or None if any primary share is missing
+        """
+        positions = dict([(segment_number, i, ) \
+                          for i, segment_number in enumerate(segment_numbers)])
+        try:
+            return [positions[segment_number] \
+                    for segment_number in range(1, self.min_segments+1)]
+        except KeyError:
+            return None
+
+    def can_join(self, segment_numbers):
+        """
+        True if segment_numbers include all the primary shares, so decode
+        only has to join them
+        """
+        return self._primary_share_indexes(segment_numbers) is not None
+
+    def _join_block(self, primary_shares, padding):
+        # drop the padding from the end of the shares before joining them,
+        # so the block is copied once; the padding can be longer than the
+        # last share if the block is tiny
+        primary_shares = list(primary_shares)
+        while padding:
+            share = primary_shares.pop()
+            if len(share) > padding:
+                primary_shares.append(share[:len(share)-padding])
+                break
+            padding -= len(share)
+        return b"".join([bytes(share) for share in primary_shares])
+
     def decode(self, segments, segment_numbers, padding_size):
         """
         segments
@@ -44,6 +114,20 @@ class ZfecSegmenter(object):
         return
             a list of data blocks
         """
+        primary_share_indexes = self._primary_share_indexes(segment_numbers)
+        if primary_share_indexes is not None:
+            primary_segments = [segments[i] for i in primary_share_indexes]
+            data_list = list()
+            for i in range(len(primary_segments[0])):
+                padding = (padding_size if i == len(primary_segments[0])-1 \
+                           else 0)
+                data_list.append(
+                    self._join_block([segment[i] \
+                                      for segment in primary_segments],
+                                     padding)
+                )
+            return data_list
+
         data_list = list()
         decoder = Decoder(self.min_segments, self.num_segments)
         zfec_segment_numbers = [n-1 for n in segment_numbers]
@@ -52,14 +136,19 @@ class ZfecSegmenter(object):
         for i in range(len(segments[0])-1):
             encoded_blocks = [segment[i] for segment in segments]
             data_list.append(
-                decoder.decode(encoded_blocks, zfec_segment_numbers, 0)
+                self._decode_block(decoder,
+                                   encoded_blocks,
+                                   zfec_segment_numbers,
+                                   0)
             )
-        
+
         # accumulate the last slice using the padding size
         encoded_blocks = [segment[-1] for segment in segments]
         data_list.append(
-            decoder.decode(encoded_blocks, zfec_segment_numbers, padding_size)
+            self._decode_block(decoder,
+                               encoded_blocks,
+                               zfec_segment_numbers,
+                               padding_size)
         )
 
         return data_list
-
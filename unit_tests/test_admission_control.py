@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+test_admission_control.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+
+from tools.data_definitions import block_size
+from web_writer.admission_control import AdmissionControl
+
+_slice_size = 10 * 1024 * 1024
+_slice_window = 2
+_num_segments = 10
+_min_segments = 8
+
+class TestAdmissionControl(unittest.TestCase):
+    """test the web writer memory budget"""
+
+    def _admission_control(self, budget):
+        return AdmissionControl(budget,
+                                _slice_size,
+                                _slice_window,
+                                _num_segments,
+                                _min_segments)
+
+    def test_small_archive_reserves_little(self):
+        """a small upload reserves memory for its size, not a full slice"""
+        admission_control = self._admission_control(1024 * _slice_size)
+        _, small_reservation = admission_control.plan_archive(1)
+        _, large_reservation = admission_control.plan_archive(_slice_size)
+        self.assertTrue(small_reservation < 10 * block_size)
+        self.assertTrue(large_reservation > _slice_size)
+
+    def test_window_shrinks_under_pressure(self):
+        """past half the budget, archives get a single slice in flight"""
+        admission_control = self._admission_control(20 * _slice_size)
+        slice_window, reservation = admission_control.plan_archive(
+            _slice_size)
+        self.assertEqual(slice_window, _slice_window)
+        self.assertTrue(admission_control.acquire(reservation, 0.0))
+        self.assertTrue(admission_control.acquire(reservation, 0.0))
+        slice_window, _ = admission_control.plan_archive(_slice_size)
+        self.assertEqual(slice_window, 1)
+
+    def test_reject_when_exhausted(self):
+        """when the budget is used up, acquire waits and then gives up"""
+        admission_control = self._admission_control(_slice_size)
+        self.assertTrue(admission_control.acquire(_slice_size, 0.0))
+        self.assertFalse(admission_control.acquire(1, 0.01))
+        self.assertEqual(admission_control.stats["rejected"], 1)
+        self.assertEqual(admission_control.stats["waiting"], 0)
+
+    def test_release_admits_waiter(self):
+        """a release hands the budget to the first waiter"""
+        admission_control = self._admission_control(_slice_size)
+        self.assertTrue(admission_control.acquire(_slice_size, 0.0))
+        waiter = gevent.spawn(admission_control.acquire, _slice_size, 1.0)
+        gevent.sleep(0)
+        self.assertEqual(admission_control.stats["waiting"], 1)
+        admission_control.release(_slice_size)
+        self.assertTrue(waiter.get())
+        self.assertEqual(admission_control.stats["in-use"], _slice_size)
+        self.assertEqual(admission_control.stats["archives"], 1)
+
+    def test_killed_waiter(self):
+        """a waiter that is killed leaves the queue"""
+        admission_control = self._admission_control(_slice_size)
+        self.assertTrue(admission_control.acquire(_slice_size, 0.0))
+        waiter = gevent.spawn(admission_control.acquire, _slice_size, 1.0)
+        gevent.sleep(0)
+        self.assertEqual(admission_control.stats["waiting"], 1)
+        waiter.kill()
+        self.assertEqual(admission_control.stats["waiting"], 0)
+        admission_control.release(_slice_size)
+        self.assertEqual(admission_control.stats["in-use"], 0)
+        self.assertEqual(admission_control.stats["archives"], 0)
+
+    def test_killed_admitted_waiter(self):
+        """a waiter killed after it was handed the budget gives it back"""
+        admission_control = self._admission_control(_slice_size)
+        self.assertTrue(admission_control.acquire(_slice_size, 0.0))
+        waiter = gevent.spawn(admission_control.acquire, _slice_size, 1.0)
+        gevent.sleep(0)
+        # the waiter is handed the budget before the kill reaches it
+        waiter.kill(block=False)
+        admission_control.release(_slice_size)
+        self.assertEqual(admission_control.stats["in-use"], _slice_size)
+        waiter.join()
+        self.assertTrue(isinstance(waiter.value, gevent.GreenletExit))
+        self.assertEqual(admission_control.stats["in-use"], 0)
+        self.assertEqual(admission_control.stats["archives"], 0)
+
+    def test_charge(self):
+        """charged bytes hold up waiters until they are discharged"""
+        admission_control = self._admission_control(_slice_size)
+        admission_control.charge(_slice_size)
+        self.assertFalse(admission_control.acquire(1, 0.0))
+        waiter = gevent.spawn(admission_control.acquire, 1, 1.0)
+        gevent.sleep(0)
+        admission_control.discharge(_slice_size)
+        self.assertTrue(waiter.get())
+        self.assertEqual(admission_control.stats["in-use"], 1)
+        self.assertEqual(admission_control.stats["charged"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
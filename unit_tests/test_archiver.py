@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+test_archiver.py
+"""
+import os
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+import gevent.event
+
+os.environ.setdefault("NIMBUSIO_NODE_NAME", "test-node")
+
+import web_writer.archiver
+from web_writer.admission_control import AdmissionControl
+from web_writer.archiver import Archiver
+from web_writer.exceptions import ArchiveFailedError
+
+_num_segments = 10
+_write_quorum = 8
+_timeout = 10.0
+
+class _FakeDataWriter(object):
+    """
+    stands in for web_writer.data_writer.DataWriter: records the calls made
+    to it and replies when its gate is open
+    """
+    def __init__(self, node_name, result="success"):
+        self.node_name = node_name
+        self.result = result
+        self.gate = gevent.event.Event()
+        self.gate.set()
+        self.calls = list()
+        self.cancels = list()
+
+    def _reply(self, method_name):
+        self.calls.append(method_name)
+        self.gate.wait()
+        return {"result"        : self.result,
+                "error-message" : "{0} failed".format(self.node_name)}
+
+    def archive_key_start(self, *args):
+        return self._reply("archive_key_start")
+
+    def archive_key_next(self, *args):
+        return self._reply("archive_key_next")
+
+    def archive_key_final(self, *args):
+        return self._reply("archive_key_final")
+
+    def archive_key_entire(self, *args):
+        return self._reply("archive_key_entire")
+
+    def archive_key_cancel(self, unified_id, conjoined_part, segment_num,
+                           user_request_id):
+        self.cancels.append(segment_num)
+
+def _segments():
+    return [[b"x"] for _ in range(_num_segments)]
+
+class TestArchiver(unittest.TestCase):
+    """test the archiver's write quorum"""
+
+    def setUp(self):
+        self._data_writers = [_FakeDataWriter("node-{0}".format(i+1)) \
+                              for i in range(_num_segments)]
+        self._handoff_writers = dict()
+
+    def _handoff_factory(self, node_name):
+        handoff_writer = _FakeDataWriter(node_name)
+        self._handoff_writers[node_name] = handoff_writer
+        return handoff_writer
+
+    def _archiver(self, write_quorum):
+        return Archiver(self._data_writers,
+                        1,
+                        "test-key",
+                        1,
+                        0.0,
+                        dict(),
+                        0,
+                        "test-request",
+                        write_quorum=write_quorum,
+                        handoff_data_writer_factory=self._handoff_factory)
+
+    def _archive(self, archiver):
+        archiver.archive_slice(_segments(), 0, _timeout)
+        archiver.archive_final(1, 0, b"", _segments(), 0, _timeout)
+
+    def test_strict_mode_fails_on_error(self):
+        """without a quorum, any data writer error fails the archive"""
+        self._data_writers[0].result = "error"
+        archiver = self._archiver(None)
+        self.assertRaises(ArchiveFailedError, self._archive, archiver)
+        self.assertEqual(len(self._handoff_writers), 0)
+
+    def test_quorum_does_not_wait_for_stragglers(self):
+        """the archive completes while two data writers are still busy"""
+        for data_writer in self._data_writers[:2]:
+            data_writer.gate.clear()
+        archiver = self._archiver(_write_quorum)
+        with gevent.Timeout(_timeout):
+            self._archive(archiver)
+        self.assertFalse(archiver._straggler_greenlet.ready())
+
+        for data_writer in self._data_writers[:2]:
+            data_writer.gate.set()
+        archiver._straggler_greenlet.join(_timeout)
+        self.assertEqual(len(self._handoff_writers), 0)
+
+    def test_failed_straggler_is_handed_off(self):
+        """a data writer that fails is replaced by a handoff writer"""
+        failing_writer = self._data_writers[3]
+        failing_writer.result = "error"
+        failing_writer.gate.clear()
+        archiver = self._archiver(_write_quorum)
+        self._archive(archiver)
+
+        failing_writer.gate.set()
+        archiver._straggler_greenlet.join(_timeout)
+        self.assertEqual(list(self._handoff_writers.keys()),
+                         [failing_writer.node_name])
+        handoff_writer = self._handoff_writers[failing_writer.node_name]
+        self.assertEqual(handoff_writer.calls,
+                         ["archive_key_start", "archive_key_final"])
+        # the failed data writer is told to drop its part of the segment
+        self.assertEqual(failing_writer.cancels, [4])
+        self.assertEqual(handoff_writer.cancels, [])
+        self.assertTrue(archiver._all_settled())
+        self.assertEqual(sum([len(l) for l in archiver._lost.values()]), 0)
+
+    def test_timed_out_straggler_is_handed_off(self):
+        """a data writer that never replies is replaced by a handoff writer"""
+        stalled_writer = self._data_writers[5]
+        stalled_writer.gate.clear()
+        archiver = self._archiver(_write_quorum)
+        task_timeout = web_writer.archiver._task_timeout
+        web_writer.archiver._task_timeout = 0.01
+        try:
+            archiver.archive_slice(_segments(), 0, _timeout)
+            archiver.archive_final(1, 0, b"", _segments(), 0, 0.05)
+            archiver._straggler_greenlet.join(_timeout)
+        finally:
+            web_writer.archiver._task_timeout = task_timeout
+        self.assertEqual(list(self._handoff_writers.keys()),
+                         [stalled_writer.node_name])
+        handoff_writer = self._handoff_writers[stalled_writer.node_name]
+        self.assertEqual(handoff_writer.calls,
+                         ["archive_key_start", "archive_key_final"])
+        # the stalled data writer is told to drop its part of the segment
+        self.assertEqual(stalled_writer.cancels, [6])
+        self.assertEqual(handoff_writer.cancels, [])
+        self.assertTrue(archiver._all_settled())
+        self.assertEqual(sum([len(l) for l in archiver._lost.values()]), 0)
+
+    def test_history_charged_to_budget(self):
+        """the history kept for stragglers counts against the budget"""
+        admission_control = AdmissionControl(1024, 1024, 1, 10, 8)
+        for data_writer in self._data_writers[:2]:
+            data_writer.gate.clear()
+        archiver = self._archiver(_write_quorum)
+        archiver._admission_control = admission_control
+        self._archive(archiver)
+        self.assertEqual(admission_control.stats["charged"],
+                         2 * _num_segments)
+        self.assertEqual(admission_control.stats["in-use"],
+                         2 * _num_segments)
+
+        for data_writer in self._data_writers[:2]:
+            data_writer.gate.set()
+        archiver._straggler_greenlet.join(_timeout)
+        gevent.sleep(0)
+        self.assertEqual(admission_control.stats["charged"], 0)
+        self.assertEqual(admission_control.stats["in-use"], 0)
+
+    def test_quorum_lost(self):
+        """too many failures still fail the archive"""
+        def _no_handoff(node_name):
+            raise ValueError("no backup clients")
+        for data_writer in self._data_writers[:3]:
+            data_writer.result = "error"
+        archiver = self._archiver(_write_quorum)
+        archiver._handoff_data_writer_factory = _no_handoff
+        self.assertRaises(ArchiveFailedError, self._archive, archiver)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+test_block_cache.py
+"""
+import os
+import shutil
+import tempfile
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+
+from tools.data_definitions import block_size
+from web_internal_reader.block_cache import BlockCache
+
+_unified_id = 1001
+_conjoined_part = 0
+
+def _block(n):
+    return (str(n).encode("utf-8") * block_size)[:block_size]
+
+class TestBlockCache(unittest.TestCase):
+    """test caching decoded blocks in the internal reader"""
+
+    def setUp(self):
+        self._test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._test_dir)
+
+    def _check_hit_and_miss(self, cache):
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 0, 2), None)
+        cache.put(_unified_id, _conjoined_part, 0, _block(0))
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 0, 2), None)
+        cache.put(_unified_id, _conjoined_part, 1, b"short")
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 0, 2),
+            [_block(0), b"short"])
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 1, 1), [b"short"])
+        self.assertEqual(cache.stats["hits"], 2)
+        self.assertEqual(cache.stats["misses"], 2)
+
+    def test_hit_and_miss(self):
+        """a read is answered only if we hold all of its blocks"""
+        self._check_hit_and_miss(BlockCache(10 * block_size))
+
+    def test_cache_file(self):
+        """blocks kept in a cache file read back the same"""
+        cache = BlockCache(10 * block_size,
+                           os.path.join(self._test_dir, "block_cache"))
+        self._check_hit_and_miss(cache)
+        cache.close()
+
+    def test_block_count(self):
+        """a read to the end needs the number of blocks"""
+        cache = BlockCache(10 * block_size)
+        cache.put(_unified_id, _conjoined_part, 0, _block(0))
+        cache.put(_unified_id, _conjoined_part, 1, _block(1))
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 0, None), None)
+        cache.set_block_count(_unified_id, _conjoined_part, 2)
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 1, None),
+            [_block(1)])
+
+    def test_scan_resistance(self):
+        """a scan of cold blocks does not flush out a hot one"""
+        cache = BlockCache(4 * block_size)
+        for _ in range(3):
+            cache.put(_unified_id, _conjoined_part, 0, _block(0))
+        for block_index in range(1, 100):
+            cache.put(_unified_id+1, _conjoined_part, block_index, _block(1))
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 0, 1), [_block(0)])
+        self.assertTrue(cache.stats["rejected"] > 0)
+        self.assertTrue(cache.stats["bytes"] <= 4 * block_size)
+
+    def test_eviction(self):
+        """blocks used more often replace the least recently used"""
+        cache = BlockCache(2 * block_size)
+        cache.put(_unified_id, _conjoined_part, 0, _block(0))
+        cache.put(_unified_id, _conjoined_part, 1, _block(1))
+        for _ in range(3):
+            cache.put(_unified_id, _conjoined_part, 2, _block(2))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 2, 1), [_block(2)])
+
+    def test_slot_read_in_progress(self):
+        """a slot is not reused while a read of it is in progress"""
+        cache = BlockCache(block_size,
+                           os.path.join(self._test_dir, "block_cache"))
+        cache.put(_unified_id, _conjoined_part, 0, _block(0))
+        reader = gevent.spawn(cache.get_blocks,
+                              _unified_id, _conjoined_part, 0, 1)
+        gevent.sleep(0)
+        # the read has started: a more popular block evicts the one being
+        # read, but cannot have its slot yet
+        for _ in range(3):
+            cache.put(_unified_id, _conjoined_part, 1, _block(1))
+        self.assertEqual(cache.stats["evictions"], 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(reader.get(timeout=1.0), [_block(0)])
+
+        cache.put(_unified_id, _conjoined_part, 1, _block(1))
+        self.assertEqual(
+            cache.get_blocks(_unified_id, _conjoined_part, 1, 1), [_block(1)])
+        cache.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+test_data_writer_batch_client.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+from gevent.queue import Queue
+
+from web_writer.data_writer_batch_client import DataWriterBatchClient
+
+_max_archive_size = 1024
+_max_batch_count = 4
+_max_batch_size = 64 * 1024
+_linger_interval = 0.01
+
+class _FakeResilientClient(object):
+    """
+    stands in for GreenletResilientClient: records the messages sent and
+    replies to a batch with a result for each archive
+    """
+    connected = True
+    server_node_name = "test-node"
+
+    def __init__(self):
+        self.messages = list()
+
+    def queue_message_for_send(self, message, data=None):
+        self.messages.append((message, data, ))
+        channel = Queue(maxsize=1)
+        reply = {"message-type" : message["message-type"] + "-reply",
+                 "result"       : "success",
+                 "error-message": None}
+        if message["message-type"] == "archive-key-entire-batch":
+            reply["results"] = [
+                {"result"           : "success",
+                 "error-message"    : None,
+                 "user-request-id"  : archive["user-request-id"]} \
+                for archive in message["archives"]
+            ]
+        channel.put((reply, None, ))
+        return channel
+
+def _archive_message(n, segment_size=10):
+    return {"message-type"      : "archive-key-entire",
+            "priority"          : n,
+            "user-request-id"   : "request-{0}".format(n),
+            "segment-size"      : segment_size}
+
+class TestDataWriterBatchClient(unittest.TestCase):
+    """test batching small archives"""
+
+    def setUp(self):
+        self._client = _FakeResilientClient()
+        self._batch_client = DataWriterBatchClient(self._client,
+                                                   _max_archive_size,
+                                                   _max_batch_count,
+                                                   _max_batch_size,
+                                                   _linger_interval)
+
+    def test_full_batch(self):
+        """a full batch is sent at once, with a reply for each archive"""
+        channels = [
+            self._batch_client.queue_message_for_send(_archive_message(n),
+                                                      [b"x" * 10])
+            for n in range(_max_batch_count)
+        ]
+        replies = [channel.get(timeout=1.0)[0] for channel in channels]
+        self.assertEqual(len(self._client.messages), 1)
+        message, data = self._client.messages[0]
+        self.assertEqual(message["message-type"], "archive-key-entire-batch")
+        self.assertEqual(len(message["archives"]), _max_batch_count)
+        self.assertEqual(b"".join(data), b"x" * 10 * _max_batch_count)
+        self.assertEqual([r["user-request-id"] for r in replies],
+                         ["request-{0}".format(n) \
+                          for n in range(_max_batch_count)])
+
+    def test_linger(self):
+        """a partial batch is sent after the linger interval"""
+        channel = self._batch_client.queue_message_for_send(
+            _archive_message(1), b"x" * 10)
+        self.assertEqual(len(self._client.messages), 0)
+        reply, _ = channel.get(timeout=1.0)
+        self.assertEqual(reply["result"], "success")
+        self.assertEqual(len(self._client.messages), 1)
+
+    def test_passthrough(self):
+        """large archives and other messages are not batched"""
+        self._batch_client.queue_message_for_send(
+            _archive_message(1, _max_archive_size + 1), [b"x"])
+        self._batch_client.queue_message_for_send(
+            {"message-type" : "archive-key-start"}, [b"x"])
+        self.assertEqual([m["message-type"] for m, _ in self._client.messages],
+                         ["archive-key-entire", "archive-key-start"])
+
+    def test_close(self):
+        """close sends a partial batch at once, and waits for its reply"""
+        channel = self._batch_client.queue_message_for_send(
+            _archive_message(1), b"x" * 10)
+        self._batch_client.close(timeout=1.0)
+        self.assertEqual(len(self._client.messages), 1)
+        self.assertEqual(len(self._batch_client._senders), 0)
+        reply, _ = channel.get(block=False)
+        self.assertEqual(reply["result"], "success")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+test_database_connection.py
+
+test running PreparedStatements on a DatabaseConnection
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import psycopg2
+
+from tools.database_connection import DatabaseConnection, \
+        PreparedStatement, \
+        _invalid_sql_statement_name
+
+_statement = PreparedStatement("test_statement",
+                               "select * from test_table where id = $1")
+
+class _ProgrammingError(psycopg2.ProgrammingError):
+    """a ProgrammingError as the server would raise it, with its pgcode"""
+    def __init__(self, pgcode):
+        super(_ProgrammingError, self).__init__(pgcode)
+        self._pgcode = pgcode
+
+    @property
+    def pgcode(self):
+        return self._pgcode
+
+class _FakeCursor(object):
+    """
+    stands in for a psycopg2 cursor: executes PREPARE and EXECUTE against
+    its connection's session
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self.rowcount = 1
+
+    def execute(self, query, args=None):
+        self._connection.queries.append(query)
+        words = query.split()
+        if words[0] == "prepare":
+            self._connection.session_statements.add(words[1])
+        elif words[0] == "execute" and \
+             words[1] not in self._connection.session_statements:
+            raise _ProgrammingError(_invalid_sql_statement_name)
+
+    def fetchone(self):
+        return (42, )
+
+    def fetchall(self):
+        return [(42, )]
+
+    def close(self):
+        pass
+
+class _FakeConnection(object):
+    """
+    stands in for a psycopg2 connection: records the queries run on it,
+    and the statements prepared in the server session
+    """
+    def __init__(self):
+        self.queries = list()
+        self.session_statements = set()
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+class TestDatabaseConnection(unittest.TestCase):
+    """test prepared statements"""
+
+    def setUp(self):
+        # don't run __init__: it connects to the database
+        self._connection = DatabaseConnection.__new__(DatabaseConnection)
+        self._connection._connection = _FakeConnection()
+        self._connection._in_transaction = False
+        self._connection._prepared_statement_names = set()
+
+    def _queries(self):
+        return [query.split()[0] \
+                for query in self._connection._connection.queries]
+
+    def test_first_use_prepares(self):
+        """the first run of a statement prepares it"""
+        result = self._connection.fetch_one_row_prepared(_statement, [1, ])
+        self.assertEqual(result, (42, ))
+        self.assertEqual(self._queries(), ["prepare", "execute", ])
+        self.assertEqual(self._connection._connection.queries[0],
+                         "prepare {0} as {1}".format(_statement.name,
+                                                     _statement.query))
+
+    def test_reuse_does_not_prepare(self):
+        """later runs of a statement execute it by name"""
+        self._connection.fetch_one_row_prepared(_statement, [1, ])
+        self._connection.fetch_all_rows_prepared(_statement, [2, ])
+        self._connection.execute_prepared(_statement, [3, ])
+        self.assertEqual(self._queries(),
+                         ["prepare", "execute", "execute", "execute", ])
+
+    def test_lost_statement_is_prepared_again(self):
+        """outside a transaction, a new server session is retried"""
+        self._connection.fetch_one_row_prepared(_statement, [1, ])
+        # the server session behind the connection is a new one
+        self._connection._connection.session_statements.clear()
+        result = self._connection.fetch_one_row_prepared(_statement, [2, ])
+        self.assertEqual(result, (42, ))
+        self.assertEqual(self._queries(),
+                         ["prepare", "execute", "execute", "prepare",
+                          "execute", ])
+
+    def test_lost_statement_in_transaction_raises(self):
+        """inside a transaction, the error is the caller's to handle"""
+        self._connection.fetch_one_row_prepared(_statement, [1, ])
+        self._connection._connection.session_statements.clear()
+        self._connection._in_transaction = True
+        with self.assertRaises(psycopg2.ProgrammingError) as context:
+            self._connection.fetch_one_row_prepared(_statement, [2, ])
+        self.assertEqual(context.exception.pgcode,
+                         _invalid_sql_statement_name)
+        self.assertEqual(self._queries(), ["prepare", "execute", "execute", ])
+
+if __name__ == "__main__":
+    unittest.main()
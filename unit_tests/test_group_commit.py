@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+test_group_commit.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from tools.data_definitions import segment_sequence_template, \
+        meta_row_template, \
+        segment_status_active
+from data_writer.group_commit import GroupCommit
+
+class _FakeConnection(object):
+    """
+    stands in for the database connection: records the statements
+    """
+    def __init__(self):
+        self.statements = list()
+        self._next_id = 1
+
+    def fetch_all_rows_prepared(self, _prepared_statement, args):
+        (count, ) = args
+        rows = [(segment_id, ) \
+                for segment_id in range(self._next_id, self._next_id + count)]
+        self._next_id += count
+        return rows
+
+    def execute(self, query, args):
+        self.statements.append((" ".join(query.split()), args, ))
+
+def _add_archive(group_commit):
+    segment_id = group_commit.next_segment_id()
+    group_commit.add_segment_row({
+        "id"                    : segment_id,
+        "collection_id"         : 1,
+        "key"                   : "key-{0}".format(segment_id),
+        "status"                : segment_status_active,
+        "unified_id"            : segment_id,
+        "timestamp"             : "2012-01-01 00:00:00",
+        "conjoined_part"        : 0,
+        "segment_num"           : 1,
+        "source_node_id"        : 1,
+        "handoff_node_id"       : None,
+    })
+    group_commit.add_segment_sequence_row(segment_sequence_template(
+        collection_id=1,
+        segment_id=segment_id,
+        zfec_padding_size=0,
+        value_file_id=1,
+        sequence_num=0,
+        value_file_offset=0,
+        size=10,
+        hash=b"hash",
+        adler32=42,
+    ))
+    group_commit.add_segment_final_row(segment_id, 10, 42, b"hash")
+    group_commit.add_meta_row(meta_row_template(
+        collection_id=1,
+        segment_id=segment_id,
+        meta_key="a",
+        meta_value="b",
+        timestamp="2012-01-01 00:00:00",
+    ))
+    return segment_id
+
+class TestGroupCommit(unittest.TestCase):
+    """test group committed data writer rows"""
+
+    def test_segment_ids(self):
+        """segment ids come from one query per block"""
+        connection = _FakeConnection()
+        group_commit = GroupCommit(connection)
+        segment_ids = [group_commit.next_segment_id() for _ in range(150)]
+        self.assertEqual(segment_ids, list(range(1, 151)))
+        self.assertEqual(connection._next_id, 201)
+
+    def test_flush(self):
+        """one statement per table, in dependency order"""
+        connection = _FakeConnection()
+        group_commit = GroupCommit(connection)
+        segment_ids = [_add_archive(group_commit) for _ in range(3)]
+        self.assertEqual(group_commit.pending_row_count, 12)
+
+        group_commit.flush()
+        self.assertEqual(group_commit.pending_row_count, 0)
+        self.assertEqual(len(connection.statements), 4)
+        queries = [query for query, _ in connection.statements]
+        self.assertTrue(queries[0].startswith(
+            "insert into nimbusio_node.segment ("))
+        self.assertTrue(queries[1].startswith(
+            "insert into nimbusio_node.segment_sequence ("))
+        self.assertTrue(queries[2].startswith(
+            "update nimbusio_node.segment"))
+        self.assertTrue(queries[3].startswith(
+            "insert into nimbusio_node.meta ("))
+        for query, args in connection.statements:
+            self.assertEqual(query.count("%s"), len(args))
+        _, segment_args = connection.statements[0]
+        self.assertEqual(segment_args[::10], segment_ids)
+
+        group_commit.flush()
+        self.assertEqual(len(connection.statements), 4)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+test_internal_reader_application.py
+
+test the web internal reader's retrieve and decode pipeline
+"""
+import os
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+
+os.environ.setdefault("NIMBUSIO_NODE_NAME", "node-01")
+os.environ.setdefault("NIMBUSIO_NODE_NAME_SEQ", "node-01 node-02")
+os.environ.setdefault("NIMBUSIO_WEB_INTERNAL_READER_HOST", "localhost")
+os.environ.setdefault("NIMBUSIO_WEB_INTERNAL_READER_PORT", "8082")
+
+from web_internal_reader.application import Application
+from web_internal_reader.exceptions import RetrieveFailedError
+
+_sequence_count = 3
+_blocks_per_sequence = 2
+_timeout = 5.0
+
+class _FakeSegmenter(object):
+    """
+    stands in for tools.zfec_segmenter.ZfecSegmenter: a sequence 'decodes'
+    to the blocks of its first segment
+    """
+    def can_join(self, segment_numbers):
+        return True
+
+    def decode(self, encoded_segments, segment_numbers, zfec_padding_size):
+        return encoded_segments[0]
+
+def _segments(sequence):
+    blocks = ["sequence-{0}-block-{1}".format(sequence, n) \
+              for n in range(_blocks_per_sequence)]
+    return {1 : (blocks, 0, )}
+
+class TestInternalReaderApplication(unittest.TestCase):
+    """test that sequences are sent while the next one is retrieved"""
+
+    def setUp(self):
+        # don't run __init__: it wants the databases and the data readers
+        self._application = Application.__new__(Application)
+        self._application._zfec_process_pool = None
+        self._yielded = list()
+        # sequence -> the blocks yielded when we were asked for it
+        self._yielded_at_request = dict()
+
+    def _retrieve(self, failed_sequence=None):
+        """
+        stands in for Retriever.retrieve, after the first sequence
+        """
+        for sequence in range(2, _sequence_count+1):
+            self._yielded_at_request[sequence] = list(self._yielded)
+            if sequence == failed_sequence:
+                raise RetrieveFailedError("sequence {0}".format(sequence))
+            yield _segments(sequence)
+
+    def _decoded_sequences(self, retrieved):
+        return self._application._decoded_sequences(_FakeSegmenter(),
+                                                    _segments(1),
+                                                    retrieved)
+
+    def test_first_block_sent_before_next_sequence(self):
+        """the first block goes out before sequence 2 is asked for"""
+        with gevent.Timeout(_timeout):
+            for decoded in self._decoded_sequences(self._retrieve()):
+                for data in decoded:
+                    self._yielded.append(data)
+
+        self.assertEqual(len(self._yielded),
+                         _sequence_count * _blocks_per_sequence)
+        self.assertEqual(self._yielded[0], "sequence-1-block-0")
+        self.assertTrue(len(self._yielded_at_request[2]) > 0)
+
+    def test_retrieve_failure_is_raised(self):
+        """a failed retrieve reaches the app iterator after what was sent"""
+        def _iterate():
+            for decoded in self._decoded_sequences(self._retrieve(3)):
+                for data in decoded:
+                    self._yielded.append(data)
+
+        with gevent.Timeout(_timeout):
+            self.assertRaises(RetrieveFailedError, _iterate)
+        self.assertEqual(len(self._yielded), 2 * _blocks_per_sequence)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+test_io_scheduler.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import time
+
+from tools.data_definitions import encoded_block_slice_size
+from retrieve_source.io_scheduler import compute_read_range, \
+        create_scheduler, \
+        DeadlineScheduler
+
+_sequence_size = 4 * encoded_block_slice_size
+
+def _work(value_file_id, offset, left_offset=0, right_offset=0):
+    message = {"message-id" : "{0}-{1}".format(value_file_id, offset)}
+    control = {"left-offset"    : left_offset,
+               "right-offset"   : right_offset}
+    sequence_row = {"space_id"          : 1,
+                    "value_file_id"     : value_file_id,
+                    "value_file_offset" : offset,
+                    "size"              : _sequence_size}
+    return message, control, sequence_row
+
+def _ids(batch):
+    return [message["message-id"] for message, _, _ in batch]
+
+class TestIOScheduler(unittest.TestCase):
+    """test the order of reads handed to io workers"""
+
+    def test_read_range(self):
+        """left and right offsets trim whole blocks from the read"""
+        _, control, sequence_row = _work(1, 100, left_offset=1,
+                                         right_offset=1)
+        self.assertEqual(compute_read_range(control, sequence_row),
+                         (100 + encoded_block_slice_size,
+                          2 * encoded_block_slice_size, ))
+
+    def test_fifo(self):
+        """the fifo scheduler keeps arrival order"""
+        scheduler = create_scheduler("fifo")
+        for value_file_id in [3, 1, 2]:
+            scheduler.append(_work(value_file_id, 0))
+        batches = [_ids(scheduler.next_batch()) for _ in range(3)]
+        self.assertEqual(batches, [["3-0"], ["1-0"], ["2-0"]])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_elevator_order(self):
+        """reads are sorted by value file and offset, wrapping around"""
+        scheduler = DeadlineScheduler(max_wait=60.0)
+        scheduler.append(_work(2, 0))
+        scheduler.append(_work(1, 0))
+        self.assertEqual(_ids(scheduler.next_batch()), ["1-0"])
+        self.assertEqual(_ids(scheduler.next_batch()), ["2-0"])
+        scheduler.append(_work(1, 10 * _sequence_size))
+        scheduler.append(_work(3, 0))
+        self.assertEqual(_ids(scheduler.next_batch()), ["3-0"])
+        self.assertEqual(_ids(scheduler.next_batch()),
+                         ["1-{0}".format(10 * _sequence_size)])
+
+    def test_coalesce(self):
+        """adjacent reads of one value file go out as one batch"""
+        scheduler = DeadlineScheduler(max_wait=60.0,
+                                      max_read_size=2 * _sequence_size)
+        for offset in [2 * _sequence_size, 0, _sequence_size]:
+            scheduler.append(_work(1, offset))
+        self.assertEqual(_ids(scheduler.next_batch()),
+                         ["1-0", "1-{0}".format(_sequence_size)])
+        self.assertEqual(_ids(scheduler.next_batch()),
+                         ["1-{0}".format(2 * _sequence_size)])
+
+    def test_deadline(self):
+        """a read that has waited too long goes next"""
+        scheduler = DeadlineScheduler(max_wait=0.01)
+        scheduler.append(_work(5, 0))
+        time.sleep(0.02)
+        scheduler.append(_work(1, 0))
+        self.assertEqual(_ids(scheduler.next_batch()), ["5-0"])
+        self.assertEqual(_ids(scheduler.next_batch()), ["1-0"])
+
+    def test_cancel(self):
+        """cancel drops the queued reads of one retrieve"""
+        for scheduler in [create_scheduler("fifo"),
+                          create_scheduler("deadline")]:
+            for value_file_id in [1, 2, 3]:
+                work = _work(value_file_id, 0)
+                work[0]["retrieve-id"] = "retrieve-{0}".format(
+                    value_file_id % 2)
+                scheduler.append(work)
+            self.assertEqual(scheduler.cancel("retrieve-1"), 2)
+            self.assertEqual(len(scheduler), 1)
+            self.assertEqual(_ids(scheduler.next_batch()), ["2-0"])
+
+if __name__ == "__main__":
+    unittest.main()
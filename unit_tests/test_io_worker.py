@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+test_io_worker.py
+
+test the io worker's choice of digests for a read
+"""
+import hashlib
+import os
+import tempfile
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import zlib
+
+os.environ.setdefault("NIMBUSIO_NODE_NAME", "node-01")
+os.environ.setdefault("NIMBUSIO_REPOSITORY_PATH", tempfile.gettempdir())
+os.environ.setdefault("NIMBUSIO_SOCKET_DIR", tempfile.gettempdir())
+
+from tools.data_definitions import encoded_block_generator, \
+        encoded_block_slice_size
+import retrieve_source.io_worker
+from retrieve_source.io_worker import _sequence_digests
+
+_data = b"a" * encoded_block_slice_size + b"b" * 100
+_stored_adler32 = 42
+
+def _adler32(data):
+    # the io worker starts its running adler32 at 0
+    return zlib.adler32(data, 0)
+
+def _sequence_row(data):
+    return {"adler32"   : _stored_adler32,
+            "hash"      : hashlib.md5(data).digest(), }
+
+def _control(left_offset=0, right_offset=0):
+    return {"left-offset"   : left_offset,
+            "right-offset"  : right_offset, }
+
+def _digests(data, sequence_row, control):
+    encoded_block_list = list(encoded_block_generator(data))
+    return _sequence_digests(control,
+                             sequence_row,
+                             encoded_block_list,
+                             len(data))
+
+class TestIOWorkerDigests(unittest.TestCase):
+    """test stored digests and sampled verification"""
+
+    def setUp(self):
+        self._verify_sample_rate = \
+            retrieve_source.io_worker._verify_sample_rate
+
+    def tearDown(self):
+        retrieve_source.io_worker._verify_sample_rate = \
+            self._verify_sample_rate
+
+    def test_stored_digests_unverified(self):
+        """with sample rate 0 a whole sequence read is never hashed"""
+        retrieve_source.io_worker._verify_sample_rate = 0.0
+        sequence_row = _sequence_row(_data)
+        self.assertEqual(_digests(_data, sequence_row, _control()),
+                         (len(_data),
+                          _stored_adler32,
+                          sequence_row["hash"],
+                          False, ))
+
+        # a corrupted sequence goes out with the stored digests: the
+        # client's md5 check catches it
+        corrupted_row = _sequence_row(b"other")
+        self.assertEqual(_digests(_data, corrupted_row, _control()),
+                         (len(_data),
+                          _stored_adler32,
+                          corrupted_row["hash"],
+                          False, ))
+
+    def test_sampled_verification(self):
+        """with sample rate 1 every whole sequence read is hashed"""
+        retrieve_source.io_worker._verify_sample_rate = 1.0
+        sequence_row = _sequence_row(_data)
+        self.assertEqual(_digests(_data, sequence_row, _control()),
+                         (len(_data),
+                          _adler32(_data),
+                          sequence_row["hash"],
+                          False, ))
+
+        corrupted_row = _sequence_row(b"other")
+        _, _, md5_digest, mismatch = \
+            _digests(_data, corrupted_row, _control())
+        self.assertEqual(md5_digest, hashlib.md5(_data).digest())
+        self.assertTrue(mismatch)
+
+    def test_partial_read_is_hashed(self):
+        """a read at an offset into the sequence is always hashed"""
+        retrieve_source.io_worker._verify_sample_rate = 0.0
+        partial_data = _data[encoded_block_slice_size:]
+        # the row describes the whole sequence, not the part we read
+        sequence_row = _sequence_row(_data)
+        self.assertEqual(
+            _digests(partial_data,
+                     sequence_row,
+                     _control(left_offset=1)),
+            (len(partial_data),
+             _adler32(partial_data),
+             hashlib.md5(partial_data).digest(),
+             False, ))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+test_node_latency.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from web_internal_reader.node_latency import NodeLatency
+
+_node_name = "test-node"
+
+class TestNodeLatency(unittest.TestCase):
+    """test choosing when to hedge a retrieve request"""
+
+    def setUp(self):
+        self._node_latency = NodeLatency(hedge_percentile=90.0,
+                                         default_hedge_delay=2.0)
+
+    def test_default_delay(self):
+        """we use the default until the node has replied"""
+        self.assertEqual(self._node_latency.hedge_delay(_node_name), 2.0)
+        self._node_latency.record_ack(_node_name, 0.01)
+        self.assertEqual(self._node_latency.hedge_delay(_node_name), 2.0)
+
+    def test_moving_average_delay(self):
+        """until we have enough samples, the delay follows the average"""
+        for _ in range(4):
+            self._node_latency.record(_node_name, 0.1)
+        self.assertAlmostEqual(self._node_latency.hedge_delay(_node_name),
+                               0.1)
+        self._node_latency.record(_node_name, 0.5)
+        self.assertTrue(self._node_latency.hedge_delay(_node_name) > 0.5)
+
+    def test_percentile(self):
+        """the delay follows the node's recent reply times"""
+        for n in range(100):
+            self._node_latency.record(_node_name, (n + 1) / 100.0)
+        self.assertAlmostEqual(self._node_latency.hedge_delay(_node_name),
+                               0.91)
+        self.assertEqual(self._node_latency.hedge_delay("other-node"), 2.0)
+
+    def test_floor(self):
+        """a very fast node is not hedged at once"""
+        for _ in range(100):
+            self._node_latency.record(_node_name, 0.0)
+        self.assertTrue(self._node_latency.hedge_delay(_node_name) > 0.0)
+
+    def test_errors(self):
+        """failures raise the error rate, and successes decay it"""
+        self._node_latency.record_error(_node_name)
+        self._node_latency.record_ack(_node_name, None)
+        node_stats = self._node_latency.stats[_node_name]
+        self.assertEqual(node_stats["errors"], 2)
+        error_rate = node_stats["error-rate"]
+        self.assertTrue(error_rate > 0.0)
+        self.assertTrue(node_stats["ack-error-rate"] > 0.0)
+        self._node_latency.record(_node_name, 0.1)
+        self.assertTrue(node_stats["error-rate"] < error_rate)
+
+    def test_acks_do_not_hide_errors(self):
+        """acks decay the ack error rate, not the reply error rate"""
+        self._node_latency.record(_node_name, 0.1)
+        self._node_latency.record_error(_node_name)
+        node_stats = self._node_latency.stats[_node_name]
+        error_rate = node_stats["error-rate"]
+        score = self._node_latency.score(_node_name)
+        for _ in range(100):
+            self._node_latency.record_ack(_node_name, 0.001)
+        self.assertEqual(node_stats["error-rate"], error_rate)
+        self.assertEqual(self._node_latency.score(_node_name), score)
+
+    def test_ack_timeouts_count(self):
+        """a node whose acks time out scores worse"""
+        self._node_latency.record(_node_name, 0.1)
+        score = self._node_latency.score(_node_name)
+        self._node_latency.record_ack(_node_name, None)
+        self.assertTrue(self._node_latency.score(_node_name) > score)
+
+    def test_rank(self):
+        """slow and failing nodes go last, unknown nodes first"""
+        for _ in range(4):
+            self._node_latency.record("fast-node", 0.1)
+            self._node_latency.record("slow-node", 0.5)
+            self._node_latency.record("failing-node", 0.1)
+            self._node_latency.record_error("failing-node")
+            self._node_latency.record_error("failing-node")
+        self.assertEqual(
+            self._node_latency.rank(["slow-node",
+                                     "failing-node",
+                                     "fast-node",
+                                     "new-node"]),
+            ["new-node", "fast-node", "failing-node", "slow-node"])
+
+    def test_degraded(self):
+        """a node much slower than the rest is degraded"""
+        for n in range(9):
+            self._node_latency.record("node-{0}".format(n), 0.1)
+        self._node_latency.record("slow-node", 1.0)
+        self.assertTrue(self._node_latency.is_degraded("slow-node"))
+        self.assertFalse(self._node_latency.is_degraded("node-0"))
+        self.assertFalse(self._node_latency.is_degraded("new-node"))
+
+if __name__ == "__main__":
+    unittest.main()
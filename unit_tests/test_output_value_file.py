@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+test_output_value_file.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import os
+import os.path
+import shutil
+import tempfile
+
+from tools.data_definitions import compute_value_file_path
+import data_writer.output_value_file
+from data_writer.output_value_file import OutputValueFile
+
+_space_id = 1
+_value_file_id = 42
+
+class _FakeConnection(object):
+    """
+    stands in for the database connection
+    """
+    def __init__(self):
+        self.value_file_rows = list()
+
+    def execute_and_return_id(self, _query, _args):
+        return _value_file_id
+
+    def execute(self, _query, args):
+        self.value_file_rows.append(args)
+
+class TestOutputValueFile(unittest.TestCase):
+    """test writing a value file"""
+
+    def setUp(self):
+        self._repository_path = tempfile.mkdtemp()
+        self._value_file_path = compute_value_file_path(self._repository_path,
+                                                        _space_id,
+                                                        _value_file_id)
+
+    def tearDown(self):
+        shutil.rmtree(self._repository_path)
+
+    def _write_value_file(self, preallocate, fallocated=True):
+        connection = _FakeConnection()
+        value_file = OutputValueFile(connection,
+                                     _space_id,
+                                     self._repository_path,
+                                     preallocate=preallocate)
+        sequences = [os.urandom(n * 1000) for n in range(1, 20)]
+        for sequence in sequences:
+            value_file.write_data_for_one_sequence(1, 1, sequence)
+        value_file.sync()
+        if preallocate and fallocated:
+            self.assertTrue(os.path.getsize(self._value_file_path) > \
+                            value_file.size)
+        value_file.close()
+
+        self.assertEqual(len(connection.value_file_rows), 1)
+        with open(self._value_file_path, "rb") as input_file:
+            self.assertEqual(input_file.read(), b"".join(sequences))
+
+    def test_plain_writes(self):
+        """the default mode writes each sequence as it comes"""
+        self._write_value_file(preallocate=False)
+
+    def test_preallocated_writes(self):
+        """a preallocated file has the same contents, truncated at close"""
+        self._write_value_file(preallocate=True)
+
+    def test_without_writev(self):
+        """before python 3.3 we write buffers one at a time, unallocated"""
+        module = data_writer.output_value_file
+        saved = (module._have_writev, module._have_posix_fallocate, )
+        module._have_writev = False
+        module._have_posix_fallocate = False
+        try:
+            self._write_value_file(preallocate=True, fallocated=False)
+        finally:
+            module._have_writev, module._have_posix_fallocate = saved
+
+if __name__ == "__main__":
+    unittest.main()
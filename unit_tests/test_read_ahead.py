@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+test_read_ahead.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import time
+
+from retrieve_source.read_ahead import ReadAhead
+
+_retrieve_id = "test-retrieve"
+_sequence_size = 1024
+
+def _reply(message_id, completed=False):
+    return {"message-type"  : "retrieve-key-reply",
+            "message-id"    : message_id,
+            "completed"     : completed,
+            "result"        : "success",
+            "error-message" : ""}
+
+class TestReadAhead(unittest.TestCase):
+    """test holding sequences read ahead of the client"""
+
+    def setUp(self):
+        self._read_ahead = ReadAhead(max_credit=2,
+                                     max_bytes=4 * _sequence_size,
+                                     max_age=60.0)
+
+    def test_credit(self):
+        """the client's credit is capped, and defaults to none"""
+        self.assertEqual(self._read_ahead.credit({}), 0)
+        self.assertEqual(self._read_ahead.credit({"read-ahead-credit" : 1}),
+                         1)
+        self.assertEqual(self._read_ahead.credit({"read-ahead-credit" : 10}),
+                         2)
+
+    def test_reply_before_request(self):
+        """a reply that arrives first is held until the client asks"""
+        message_id = self._read_ahead.issue(_retrieve_id, 1, _sequence_size)
+        self.assertEqual(self._read_ahead.arrived(_reply(message_id),
+                                                  [b"x" * 10]),
+                         None)
+        self.assertEqual(self._read_ahead.stats["buffered-bytes"], 10)
+        self.assertTrue(self._read_ahead.has_entry(_retrieve_id, 1))
+
+        reply, data = self._read_ahead.request(_retrieve_id, 1, {})
+        self.assertEqual(reply["message-id"], message_id)
+        self.assertEqual(data, [b"x" * 10])
+        self.assertFalse(self._read_ahead.has_entry(_retrieve_id, 1))
+        self.assertEqual(self._read_ahead.stats["buffered-bytes"], 0)
+        self.assertEqual(self._read_ahead.stats["hits"], 1)
+
+    def test_request_before_reply(self):
+        """a client that asks first gets the reply when it arrives"""
+        message_id = self._read_ahead.issue(_retrieve_id, 1, _sequence_size)
+        request = {"message-id" : "client-message"}
+        self.assertEqual(self._read_ahead.request(_retrieve_id, 1, request),
+                         None)
+        result = self._read_ahead.arrived(_reply(message_id), [b"x"])
+        self.assertEqual(result[0], request)
+        self.assertEqual(result[2], [b"x"])
+        self.assertEqual(self._read_ahead.stats["waits"], 1)
+        self.assertEqual(self._read_ahead.stats["entries"], 0)
+
+    def test_byte_budget(self):
+        """reads in flight count against the budget"""
+        for sequence_index in range(4):
+            self.assertTrue(self._read_ahead.has_room(_sequence_size))
+            self._read_ahead.issue(_retrieve_id,
+                                   sequence_index,
+                                   _sequence_size)
+        self.assertFalse(self._read_ahead.has_room(_sequence_size))
+
+    def test_expire(self):
+        """abandoned entries are dropped, and late replies discarded"""
+        message_id = self._read_ahead.issue(_retrieve_id, 1, _sequence_size)
+        self._read_ahead.expire(time.time() + 61.0)
+        self.assertFalse(self._read_ahead.has_entry(_retrieve_id, 1))
+        self.assertEqual(self._read_ahead.arrived(_reply(message_id), [b"x"]),
+                         None)
+        self.assertEqual(self._read_ahead.stats["discarded"], 2)
+        self.assertEqual(self._read_ahead.stats["buffered-bytes"], 0)
+
+    def test_cancel(self):
+        """a cancelled retrieve's entries are dropped"""
+        self._read_ahead.issue(_retrieve_id, 1, _sequence_size)
+        self._read_ahead.issue("other-retrieve", 1, _sequence_size)
+        self._read_ahead.cancel(_retrieve_id)
+        self.assertFalse(self._read_ahead.has_entry(_retrieve_id, 1))
+        self.assertTrue(self._read_ahead.has_entry("other-retrieve", 1))
+        self.assertEqual(self._read_ahead.stats["buffered-bytes"],
+                         _sequence_size)
+
+    def test_dropped_requests(self):
+        """a client waiting on a dropped entry is handed back for a reply"""
+        self._read_ahead.issue(_retrieve_id, 1, _sequence_size)
+        self._read_ahead.issue(_retrieve_id, 2, _sequence_size)
+        request = {"message-id" : "client-message"}
+        self._read_ahead.request(_retrieve_id, 1, request)
+        self.assertEqual(self._read_ahead.cancel(_retrieve_id), [request])
+
+        self._read_ahead.issue(_retrieve_id, 3, _sequence_size)
+        self._read_ahead.request(_retrieve_id, 3, request)
+        self.assertEqual(self._read_ahead.expire(time.time()), [])
+        self.assertEqual(self._read_ahead.expire(time.time() + 61.0),
+                         [request])
+        self.assertEqual(self._read_ahead.stats["entries"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
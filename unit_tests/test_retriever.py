@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+test_retriever.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+
+from tools.data_definitions import encoded_block_slice_size
+from web_internal_reader.node_latency import NodeLatency
+from web_internal_reader.retriever import Retriever
+
+_num_segments = 10
+_segments_needed = 8
+_block_offset = 5
+_block_count = 10
+_sequence_blocks = 3
+_timeout = 5.0
+
+class _FakeDataReader(object):
+    """
+    stands in for web_internal_reader.data_reader.DataReader: records the
+    requests made to it, and replies to each sequence as told
+    """
+    connected = True
+
+    def __init__(self, node_name, sequence_count):
+        self.node_name = node_name
+        self.sequence_count = sequence_count
+        self.requests = list()
+        self.cancels = list()
+        # sequence -> seconds to wait before replying
+        self.delays = dict()
+        # sequences we fail
+        self.failures = set()
+
+    def _reply(self, method_name, sequence, segment_number, block_offset,
+               block_count):
+        self.requests.append((method_name, sequence, block_offset,
+                              block_count, ))
+        gevent.sleep(self.delays.get(sequence, 0.0))
+        if sequence in self.failures:
+            return None
+        data_segment = [b"x" * encoded_block_slice_size] * _sequence_blocks
+        return data_segment, 0, sequence == self.sequence_count
+
+    def retrieve_key_start(self, retrieve_id, sequence, collection_id, key,
+                           unified_id, conjoined_part, segment_number,
+                           block_offset, block_count, user_request_id):
+        return self._reply("retrieve_key_start", sequence, segment_number,
+                           block_offset, block_count)
+
+    def retrieve_key_next(self, retrieve_id, sequence, collection_id, key,
+                          unified_id, conjoined_part, segment_number,
+                          block_offset, block_count, user_request_id):
+        return self._reply("retrieve_key_next", sequence, segment_number,
+                           block_offset, block_count)
+
+    def retrieve_key_cancel(self, retrieve_id, unified_id, segment_number,
+                            user_request_id):
+        self.cancels.append(segment_number)
+
+class TestRetriever(unittest.TestCase):
+    """test hedged retrieves"""
+
+    def _retrieve(self, sequence_count):
+        self._data_readers = [
+            _FakeDataReader("node-{0}".format(i+1), sequence_count) \
+            for i in range(_num_segments)
+        ]
+        self._node_latency = NodeLatency(default_hedge_delay=0.05)
+
+    def _run(self):
+        retriever = Retriever(None,
+                              self._data_readers,
+                              1,
+                              "test-key",
+                              1,
+                              0,
+                              _block_offset,
+                              _block_count,
+                              _segments_needed,
+                              "test-request",
+                              node_latency=self._node_latency)
+        with gevent.Timeout(_timeout):
+            return list(retriever.retrieve(_timeout))
+
+    def test_systematic_read(self):
+        """only the data segments are asked, when they are healthy"""
+        self._retrieve(2)
+        result_dicts = self._run()
+        self.assertEqual(len(result_dicts), 2)
+        for result_dict in result_dicts:
+            self.assertEqual(sorted(result_dict.keys()),
+                             list(range(1, _segments_needed+1)))
+        for data_reader in self._data_readers[_segments_needed:]:
+            self.assertEqual(data_reader.requests, [])
+
+    def test_late_node_is_hedged(self):
+        """a node later than its hedge delay gets a spare in its place"""
+        self._retrieve(1)
+        late_reader = self._data_readers[2]
+        late_reader.delays[1] = _timeout
+        result_dicts = self._run()
+
+        self.assertEqual(len(result_dicts), 1)
+        self.assertEqual(len(result_dicts[0]), _segments_needed)
+        self.assertFalse(3 in result_dicts[0])
+        hedged = [n+1 for n, data_reader in enumerate(self._data_readers) \
+                  if n >= _segments_needed and len(data_reader.requests) > 0]
+        self.assertEqual(len(hedged), 1)
+        self.assertTrue(hedged[0] in result_dicts[0])
+        # we stop waiting for the late node, and tell it to drop the work
+        self.assertEqual(late_reader.cancels, [3])
+
+    def test_late_node_answers_after_hedge(self):
+        """a hedged node that answers anyway is not kept as an extra"""
+        self._retrieve(2)
+        self._node_latency = NodeLatency(default_hedge_delay=_timeout)
+        late_reader = self._data_readers[2]
+        # the late node is hedged well before the others would be
+        for _ in range(4):
+            self._node_latency.record(late_reader.node_name, 0.01)
+        late_reader.delays[1] = 0.15
+        for data_reader in self._data_readers[:_segments_needed]:
+            if data_reader is not late_reader:
+                data_reader.delays[1] = 0.2
+        result_dicts = self._run()
+
+        self.assertEqual(len(result_dicts), 2)
+        spares = [data_reader \
+                  for data_reader in self._data_readers[_segments_needed:] \
+                  if len(data_reader.requests) > 0]
+        self.assertEqual(len(spares), 1)
+        # the spare answered sequence 1, but the data segments are enough
+        # for sequence 2
+        self.assertEqual(sorted(result_dicts[1].keys()),
+                         list(range(1, _segments_needed+1)))
+        second_requests = [request \
+                           for data_reader in self._data_readers \
+                           for request in data_reader.requests \
+                           if request[1] == 2]
+        self.assertEqual(len(second_requests), _segments_needed)
+        self.assertEqual(len(spares[0].cancels), 1)
+
+    def test_killed_task_keeps_latency(self):
+        """a node we stop waiting for does not look faster for it"""
+        self._retrieve(1)
+        late_reader = self._data_readers[2]
+        late_reader.delays[1] = _timeout
+        # a hedge delay well below the node's average reply time
+        for _ in range(20):
+            self._node_latency.record(late_reader.node_name, 0.05)
+        self._node_latency.record(late_reader.node_name, 2.0)
+        latency = self._node_latency.latency(late_reader.node_name)
+        self._run()
+        self.assertTrue(
+            self._node_latency.latency(late_reader.node_name) >= latency)
+
+    def test_failed_node_is_replaced(self):
+        """a node whose read fails is replaced, and cancelled"""
+        self._retrieve(2)
+        failed_reader = self._data_readers[1]
+        failed_reader.failures.add(1)
+        result_dicts = self._run()
+
+        self.assertEqual(len(result_dicts), 2)
+        for result_dict in result_dicts:
+            self.assertEqual(len(result_dict), _segments_needed)
+            self.assertFalse(2 in result_dict)
+        self.assertEqual(failed_reader.cancels, [2])
+        # it is not asked for the rest of the retrieve
+        self.assertEqual([sequence for _, sequence, _, _ \
+                          in failed_reader.requests], [1])
+
+    def test_spare_joins_part_way(self):
+        """a spare that joins at sequence 2 starts where the others are"""
+        self._retrieve(2)
+        self._data_readers[0].failures.add(2)
+        result_dicts = self._run()
+
+        self.assertEqual(len(result_dicts), 2)
+        self.assertFalse(1 in result_dicts[1])
+        spares = [data_reader \
+                  for data_reader in self._data_readers[_segments_needed:] \
+                  if len(data_reader.requests) > 0]
+        self.assertEqual(len(spares), 1)
+        self.assertEqual(spares[0].requests,
+                         [("retrieve_key_start",
+                           2,
+                           _block_offset + _sequence_blocks,
+                           _block_count - _sequence_blocks, )])
+        # the nodes that were there from the start go on with next
+        self.assertEqual(self._data_readers[1].requests,
+                         [("retrieve_key_start", 1, _block_offset,
+                           _block_count, ),
+                          ("retrieve_key_next", 2, _block_offset,
+                           _block_count, )])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+test_segment_verifier.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from base64 import b64encode
+import hashlib
+import os
+
+from data_writer.segment_verifier import SegmentVerifier, verify_message
+
+def _archive_message(segment_data, message_type="archive-key-entire"):
+    return {
+        "message-type"          : message_type,
+        "segment-size"          : len(segment_data),
+        "segment-md5-digest"    : b64encode(
+            hashlib.md5(segment_data).digest()).decode("utf-8"),
+    }
+
+class TestSegmentVerifier(unittest.TestCase):
+    """test verifying incoming segment data"""
+
+    def setUp(self):
+        self._segment_verifier = SegmentVerifier(2)
+
+    def tearDown(self):
+        self._segment_verifier.close()
+
+    def test_good_segment(self):
+        """verified data is joined from the blocks"""
+        blocks = [os.urandom(1024), os.urandom(100)]
+        message = _archive_message(b"".join(blocks))
+        message, future = self._segment_verifier.prepare((message, blocks, ))
+        verification = verify_message(message, future)
+        self.assertEqual(verification.result, "success")
+        self.assertEqual(verification.segment_data, b"".join(blocks))
+
+    def test_bad_segments(self):
+        """size and md5 are checked"""
+        segment_data = os.urandom(1024)
+        message = _archive_message(segment_data)
+        verification = verify_message(message, segment_data[:-1])
+        self.assertEqual(verification.result, "size-mismatch")
+        verification = verify_message(message, os.urandom(1024))
+        self.assertEqual(verification.result, "md5-mismatch")
+
+    def test_batch(self):
+        """a batch gets a verification for each archive"""
+        segments = [os.urandom(10), os.urandom(20)]
+        message = {
+            "message-type"  : "archive-key-entire-batch",
+            "archives"      : [_archive_message(segments[0]),
+                               _archive_message(os.urandom(20))],
+        }
+        message, future = self._segment_verifier.prepare(
+            (message, segments, ))
+        batch_verification = verify_message(message, future)
+        self.assertEqual(batch_verification.result, "success")
+        self.assertEqual(
+            [v.result for v in batch_verification.archive_verifications],
+            ["success", "md5-mismatch"])
+
+    def test_passthrough(self):
+        """other messages are not touched"""
+        item = ({"message-type" : "destroy-key"}, None, )
+        self.assertEqual(self._segment_verifier.prepare(item), item)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+test_sequence_row_cache.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from tools.sequence_row_invalidation import invalidate_value_files, \
+        invalidate_all, \
+        parse_invalidation
+from retrieve_source.sequence_row_cache import SequenceRowCache, \
+        sequence_row_cache_key
+
+_row_size = 1024
+
+class _FakeConnection(object):
+    """records the notifications sent"""
+    def __init__(self):
+        self.payloads = list()
+
+    def execute(self, query, args):
+        self.payloads.append(args[1])
+
+def _message(segment_num):
+    return {"collection-id"             : 1,
+            "segment-unified-id"        : 2,
+            "segment-conjoined-part"    : 0,
+            "segment-num"               : segment_num,
+            "handoff-node-id"           : None}
+
+def _rows(*value_file_ids):
+    return [{"value_file_id" : value_file_id} \
+            for value_file_id in value_file_ids]
+
+class TestSequenceRowCache(unittest.TestCase):
+    """test caching sequence rows in the database pool controller"""
+
+    def test_hit_and_miss(self):
+        """a stored entry is found, and counted"""
+        cache = SequenceRowCache(max_bytes=10 * _row_size)
+        key = sequence_row_cache_key(_message(1))
+        self.assertEqual(cache.get(key), None)
+        cache.put(key, _rows(1), cache.generation)
+        self.assertEqual(cache.get(key), _rows(1))
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test_byte_bound(self):
+        """the least recently used entries go first"""
+        cache = SequenceRowCache(max_bytes=2 * _row_size)
+        keys = [sequence_row_cache_key(_message(n)) for n in range(3)]
+        cache.put(keys[0], _rows(1), cache.generation)
+        cache.put(keys[1], _rows(1), cache.generation)
+        cache.get(keys[0])
+        cache.put(keys[2], _rows(1), cache.generation)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(keys[1]), None)
+        self.assertNotEqual(cache.get(keys[0]), None)
+        self.assertEqual(cache.size, 2 * _row_size)
+
+    def test_invalidate_value_files(self):
+        """only entries that refer to the named value files are dropped"""
+        cache = SequenceRowCache(max_bytes=10 * _row_size)
+        key_1 = sequence_row_cache_key(_message(1))
+        key_2 = sequence_row_cache_key(_message(2))
+        cache.put(key_1, _rows(1, 2), cache.generation)
+        cache.put(key_2, _rows(3), cache.generation)
+        cache.invalidate(set([2]))
+        self.assertEqual(cache.get(key_1), None)
+        self.assertEqual(cache.get(key_2), _rows(3))
+        cache.invalidate(None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_stale_query(self):
+        """rows from a query started before an invalidation are not kept"""
+        cache = SequenceRowCache(max_bytes=10 * _row_size)
+        key = sequence_row_cache_key(_message(1))
+        generation = cache.generation
+        cache.invalidate(set([1]))
+        cache.put(key, _rows(1), generation)
+        self.assertEqual(len(cache), 0)
+
+    def test_notification_payloads(self):
+        """invalidations round trip through the notification payload"""
+        connection = _FakeConnection()
+        invalidate_value_files(connection, range(1001))
+        invalidate_all(connection)
+        self.assertEqual(len(connection.payloads), 4)
+        value_file_ids = set()
+        for payload in connection.payloads[:-1]:
+            value_file_ids.update(parse_invalidation(payload))
+        self.assertEqual(value_file_ids, set(range(1001)))
+        self.assertEqual(parse_invalidation(connection.payloads[-1]), None)
+
+if __name__ == "__main__":
+    unittest.main()
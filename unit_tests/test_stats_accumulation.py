@@ -160,6 +160,42 @@ class TestStatsAccumulator(unittest.TestCase):
                                                  queue_entry.collection_id)
         self.assertEqual(int(hash_value), expected_value)
 
+    def test_final_flush(self):
+        """
+        test that counts still waiting for a flush are stored at shutdown
+        """
+        halt_event = Event()
+        redis_queue = gevent.queue.Queue()
+        redis_sink = OperationalStatsRedisSink(halt_event, 
+                                               redis_queue,
+                                               _node_name,
+                                               flush_interval=3600.0)
+        redis_sink.link_exception(_unhandled_greenlet_exception)
+        redis_sink.start()
+
+        partial_key = "get_request"
+        queue_entry = redis_queue_entry_tuple(timestamp=datetime.utcnow(),
+                                              collection_id=43,
+                                              value=3)
+        redis_queue.put((partial_key, queue_entry), )
+        redis_queue.put((partial_key, queue_entry), )
+
+        # give the greenlet some time to aggregate, then stop it
+        halt_event.wait(1)
+        expected_key = compute_key(_node_name,
+                                   queue_entry.timestamp,
+                                   partial_key)
+        self.assertEqual(
+            self._redis_connection.hget(expected_key, 
+                                        queue_entry.collection_id), 
+            None)
+        halt_event.set()
+        redis_sink.join()
+
+        hash_value = self._redis_connection.hget(expected_key,
+                                                 queue_entry.collection_id)
+        self.assertEqual(int(hash_value), 2 * queue_entry.value)
+
 if __name__ == "__main__":
     _initialize_logging_to_stderr()
     unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+test_sync_policy.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import time
+
+from data_writer.sync_policy import SyncPolicy
+from data_writer.write_path_stats import WritePathStats
+
+_max_sync_delay = 0.05
+
+class TestSyncPolicy(unittest.TestCase):
+    """test deciding when the data writer syncs"""
+
+    def setUp(self):
+        self._sync_policy = SyncPolicy(max_sync_delay=_max_sync_delay)
+
+    def test_idle(self):
+        """with nothing to sync, we wait the full queue timeout"""
+        self.assertFalse(self._sync_policy.sync_due(0, False, True))
+        self.assertEqual(self._sync_policy.queue_timeout(1.0), 1.0)
+
+    def test_sync_when_drained(self):
+        """completions are synced as soon as the queue is empty"""
+        self.assertFalse(self._sync_policy.sync_due(1, True, False))
+        self.assertTrue(self._sync_policy.sync_due(2, True, True))
+
+    def test_max_delay_under_load(self):
+        """a busy queue does not hold completions past the max delay"""
+        self.assertFalse(self._sync_policy.sync_due(1, True, False))
+        self.assertTrue(self._sync_policy.queue_timeout(1.0) <= \
+                        _max_sync_delay)
+        time.sleep(_max_sync_delay)
+        self.assertTrue(self._sync_policy.sync_due(1, True, False))
+
+    def test_unsynced_data_waits(self):
+        """data with no completion waiting is synced at the max delay"""
+        self.assertFalse(self._sync_policy.sync_due(0, True, True))
+        time.sleep(_max_sync_delay)
+        self.assertTrue(self._sync_policy.sync_due(0, True, True))
+
+    def test_sync_delay(self):
+        """a sync records how long its work waited in the write path stats"""
+        write_path_stats = WritePathStats(0)
+        sync_policy = SyncPolicy(max_sync_delay=_max_sync_delay,
+                                 write_path_stats=write_path_stats)
+        sync_policy.sync_due(3, True, False)
+        sync_policy.synced()
+        latency = write_path_stats.snapshot()["latency"]
+        self.assertEqual(latency["sync.delay"]["count"], 1)
+        self.assertEqual(sync_policy.queue_timeout(1.0), 1.0)
+
+if __name__ == "__main__":
+    unittest.main()
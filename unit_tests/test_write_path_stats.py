@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+test_write_path_stats.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import json
+
+from data_writer.write_path_stats import WritePathStats
+
+class TestWritePathStats(unittest.TestCase):
+    """test timing the data writer write path"""
+
+    def test_stages(self):
+        """stages are recorded against the current message type"""
+        write_path_stats = WritePathStats(0)
+        write_path_stats.start_message("archive-key-entire", 0.001, 3)
+        write_path_stats.record_stage("verify", 0.0002)
+        write_path_stats.record_stage("write", 0.0004)
+        write_path_stats.start_message("destroy-key", 0.5, 0)
+        write_path_stats.record_sync(0.01, 0.002, 1)
+
+        snapshot = write_path_stats.snapshot()
+        self.assertEqual(sorted(snapshot["latency"].keys()),
+                         ["archive-key-entire.queue",
+                          "archive-key-entire.verify",
+                          "archive-key-entire.write",
+                          "destroy-key.queue",
+                          "sync.commit",
+                          "sync.fsync", ])
+        self.assertEqual(snapshot["queue-depth"]["count"], 2)
+        self.assertEqual(snapshot["queue-depth"]["max"], 3)
+        self.assertEqual(snapshot["sync-batch-size"]["count"], 1)
+
+        # the snapshot goes out as JSON
+        json.dumps(snapshot)
+
+if __name__ == "__main__":
+    unittest.main()
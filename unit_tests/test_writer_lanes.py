@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+test_writer_lanes.py
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from data_writer.writer_lanes import WriterLanes
+
+_lane_count = 4
+
+def _segment_message(message_type, unified_id, segment_num):
+    return {"message-type"      : message_type,
+            "unified-id"        : unified_id,
+            "conjoined-part"    : 0,
+            "segment-num"       : segment_num}
+
+def _lane_contents(writer_lanes):
+    contents = list()
+    for lane_queue in writer_lanes.queues:
+        items = list()
+        while not lane_queue.empty():
+            items.append(lane_queue.get_nowait())
+        contents.append(items)
+    return contents
+
+class TestWriterLanes(unittest.TestCase):
+    """test spreading data writer messages across writer lanes"""
+
+    def test_segment_stays_in_one_lane(self):
+        """all the messages for a segment go to the same lane, in order"""
+        writer_lanes = WriterLanes(_lane_count)
+        message_types = ["archive-key-start",
+                         "archive-key-next",
+                         "archive-key-final", ]
+        for unified_id in range(100):
+            for message_type in message_types:
+                writer_lanes.append(
+                    (_segment_message(message_type, unified_id, 1), None, ))
+
+        used_lanes = 0
+        for items in _lane_contents(writer_lanes):
+            if len(items) > 0:
+                used_lanes += 1
+            for i in range(0, len(items), len(message_types)):
+                segment_items = items[i:i+len(message_types)]
+                self.assertEqual(
+                    [message["message-type"] for message, _, _ in segment_items],
+                    message_types)
+                self.assertEqual(
+                    len(set([message["unified-id"] \
+                             for message, _, _ in segment_items])), 1)
+        self.assertEqual(used_lanes, _lane_count)
+
+    def test_broadcast(self):
+        """web-writer-start goes to every lane"""
+        writer_lanes = WriterLanes(_lane_count)
+        writer_lanes.append(({"message-type" : "web-writer-start"}, None, ))
+        self.assertEqual([len(items) \
+                          for items in _lane_contents(writer_lanes)],
+                         [1] * _lane_count)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+test_writer_thread_batch.py
+
+test the WriterThread handler for archive-key-entire-batch messages
+"""
+from base64 import b64encode
+import hashlib
+import os
+import tempfile
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+os.environ.setdefault("NIMBUSIO_REPOSITORY_PATH", tempfile.gettempdir())
+
+from data_writer.writer_thread import WriterThread
+
+_node_id_dict = {"node-01" : 1, "node-02" : 2, }
+
+class _FakePusher(object):
+    """
+    stands in for the reply push client: records the replies sent
+    """
+    def __init__(self):
+        self.messages = list()
+
+    def send(self, message, data=None):
+        self.messages.append(message)
+
+class _FakeWriter(object):
+    """
+    stands in for the Writer: records the segments stored
+    """
+    def __init__(self):
+        self.segments = list()
+        self.sequences = list()
+
+    def start_new_segment(self, collection_id, key, unified_id,
+                          timestamp_repr, conjoined_part, segment_num,
+                          source_node_id, handoff_node_id, user_request_id):
+        self.segments.append((unified_id, source_node_id, handoff_node_id, ))
+
+    def store_sequence(self, collection_id, key, unified_id, timestamp_repr,
+                       conjoined_part, segment_num, segment_size,
+                       zfec_padding_size, segment_md5_digest, segment_adler32,
+                       sequence_num, data, user_request_id):
+        self.sequences.append((unified_id, sequence_num, data, ))
+
+class _FakeWritePathStats(object):
+    def record_stage(self, stage, seconds):
+        pass
+
+def _archive(n, data, handoff_node_name=None):
+    return {"user-request-id"       : "request-{0}".format(n),
+            "collection-id"         : 1,
+            "key"                   : "key-{0}".format(n),
+            "unified-id"            : n,
+            "timestamp-repr"        : "2012-01-01 00:00:00",
+            "conjoined-part"        : 0,
+            "segment-num"           : 1,
+            "segment-size"          : len(data),
+            "zfec-padding-size"     : 0,
+            "segment-md5-digest"    : b64encode(
+                hashlib.md5(data).digest()).decode("utf-8"),
+            "segment-adler32"       : 42,
+            "source-node-name"      : "node-01",
+            "handoff-node-name"     : handoff_node_name, }
+
+def _batch_message(archives):
+    return {"message-type"      : "archive-key-entire-batch",
+            "client-tag"        : "client-tag",
+            "client-address"    : "client-address",
+            "user-request-id"   : "batch-request",
+            "message-id"        : "message-id",
+            "archives"          : archives, }
+
+class TestWriterThreadBatch(unittest.TestCase):
+    """test storing a batch of small archives"""
+
+    def setUp(self):
+        # don't run __init__: it connects to the node local database
+        self._writer_thread = WriterThread.__new__(WriterThread)
+        self._writer_thread._node_id_dict = _node_id_dict
+        self._writer_thread._active_segments = dict()
+        self._writer_thread._completions = list()
+        self._writer_thread._writer = _FakeWriter()
+        self._writer_thread._reply_pusher = _FakePusher()
+        self._writer_thread._write_path_stats = _FakeWritePathStats()
+
+    def _complete(self):
+        for completion in self._writer_thread._completions:
+            completion.post_commit_process()
+
+    def test_all_archives_stored(self):
+        """each archive is stored, the reply waits for the sync"""
+        data_list = [b"a" * 10, b"b" * 20, b"c" * 5, ]
+        message = _batch_message(
+            [_archive(n, data, handoff_node_name="node-02") \
+             for n, data in enumerate(data_list)])
+        self._writer_thread._handle_archive_key_entire_batch(message,
+                                                             data_list)
+
+        writer = self._writer_thread._writer
+        self.assertEqual(writer.segments, [(n, 1, 2, ) for n in range(3)])
+        self.assertEqual(writer.sequences,
+                         [(n, 0, data, ) \
+                          for n, data in enumerate(data_list)])
+
+        pusher = self._writer_thread._reply_pusher
+        self.assertEqual(pusher.messages, [])
+        self.assertEqual(len(self._writer_thread._completions), 1)
+        self._complete()
+
+        self.assertEqual(len(pusher.messages), 1)
+        reply = pusher.messages[0]
+        self.assertEqual(reply["message-type"],
+                         "archive-key-entire-batch-reply")
+        self.assertEqual(reply["result"], "success")
+        self.assertEqual([r["user-request-id"] for r in reply["results"]],
+                         ["request-{0}".format(n) for n in range(3)])
+        self.assertEqual([r["result"] for r in reply["results"]],
+                         ["success"] * 3)
+
+    def test_mixed_results(self):
+        """an archive with bad data fails, the others are stored"""
+        data_list = [b"a" * 10, b"b" * 20, b"c" * 5, ]
+        archives = [_archive(n, data) for n, data in enumerate(data_list)]
+        archives[1]["segment-md5-digest"] = \
+            b64encode(hashlib.md5(b"other").digest()).decode("utf-8")
+        self._writer_thread._handle_archive_key_entire_batch(
+            _batch_message(archives), data_list)
+
+        writer = self._writer_thread._writer
+        self.assertEqual([s[0] for s in writer.segments], [0, 2])
+        self.assertEqual(writer.sequences,
+                         [(0, 0, data_list[0], ), (2, 0, data_list[2], )])
+        self._complete()
+
+        pusher = self._writer_thread._reply_pusher
+        self.assertEqual(len(pusher.messages), 1)
+        reply = pusher.messages[0]
+        self.assertEqual(reply["result"], "success")
+        self.assertEqual([r["result"] for r in reply["results"]],
+                         ["success", "md5-mismatch", "success"])
+        self.assertEqual(reply["results"][1]["user-request-id"], "request-1")
+        self.assertIsNotNone(reply["results"][1]["error-message"])
+
+    def test_all_archives_fail(self):
+        """with no valid archive the reply is sent at once"""
+        data_list = [b"a" * 10, b"b" * 20, ]
+        archives = [_archive(n, data) for n, data in enumerate(data_list)]
+        for archive in archives:
+            archive["segment-md5-digest"] = \
+                b64encode(hashlib.md5(b"other").digest()).decode("utf-8")
+        self._writer_thread._handle_archive_key_entire_batch(
+            _batch_message(archives), data_list)
+
+        self.assertEqual(self._writer_thread._writer.segments, [])
+        self.assertEqual(self._writer_thread._completions, [])
+        pusher = self._writer_thread._reply_pusher
+        self.assertEqual(len(pusher.messages), 1)
+        self.assertEqual([r["result"] for r in pusher.messages[0]["results"]],
+                         ["md5-mismatch", "md5-mismatch"])
+
+    def test_batch_size_mismatch(self):
+        """if the batch data is the wrong size the whole batch fails"""
+        data_list = [b"a" * 10, b"b" * 20, ]
+        archives = [_archive(n, data) for n, data in enumerate(data_list)]
+        self._writer_thread._handle_archive_key_entire_batch(
+            _batch_message(archives), data_list[:1])
+
+        self.assertEqual(self._writer_thread._writer.segments, [])
+        pusher = self._writer_thread._reply_pusher
+        self.assertEqual(len(pusher.messages), 1)
+        self.assertEqual(pusher.messages[0]["result"], "size-mismatch")
+        self.assertEqual(pusher.messages[0]["results"], [])
+
+if __name__ == "__main__":
+    unittest.main()
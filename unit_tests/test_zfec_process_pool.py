@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+test_zfec_process_pool.py
+"""
+import os
+import random
+import signal
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import gevent
+
+import tools.zfec_process_pool
+from tools.data_definitions import block_generator, incoming_slice_size
+from tools.zfec_segmenter import ZfecSegmenter
+from tools.zfec_process_pool import ZfecProcessPool, ZfecProcessPoolError
+
+_min_segments = 8
+_num_segments = 10
+_worker_count = 2
+
+class TestZfecProcessPool(unittest.TestCase):
+    """test the zfec process pool"""
+
+    def setUp(self):
+        self._pool = ZfecProcessPool(_min_segments,
+                                     _num_segments,
+                                     _worker_count,
+                                     incoming_slice_size)
+
+    def tearDown(self):
+        self._pool.close()
+
+    def test_encode_matches_segmenter(self):
+        """the pool must produce the same shares as ZfecSegmenter"""
+        segmenter = ZfecSegmenter(_min_segments, _num_segments)
+        for data_size in [1,
+                          _min_segments - 1,
+                          incoming_slice_size - 1,
+                          incoming_slice_size, ]:
+            test_data = os.urandom(data_size)
+            expected_segments = segmenter.encode(block_generator(test_data))
+            encoded_segments = self._pool.encode(test_data)
+            self.assertEqual(len(encoded_segments), len(expected_segments))
+            for encoded_segment, expected_segment in zip(encoded_segments,
+                                                         expected_segments):
+                self.assertEqual([bytes(share) for share in encoded_segment],
+                                 [bytes(share) for share in expected_segment],
+                                 data_size)
+
+    def test_concurrent_encodes(self):
+        """more concurrent requests than workers must queue, not fail"""
+        test_data = os.urandom(incoming_slice_size // 4)
+        greenlets = [gevent.spawn(self._pool.encode, test_data) \
+                     for _ in range(_worker_count * 3)]
+        gevent.joinall(greenlets)
+        for greenlet in greenlets:
+            self.assertTrue(greenlet.successful())
+        self.assertEqual(self._pool.stats["busy-workers"], 0)
+        self.assertEqual(self._pool.stats["encodes"], len(greenlets))
+
+    def test_killed_greenlets(self):
+        """killing callers while their workers run must not lose workers"""
+        test_data = os.urandom(incoming_slice_size)
+        for _ in range(_worker_count * 2):
+            greenlet = gevent.spawn(self._pool.encode, test_data)
+            gevent.sleep(0.01)
+            greenlet.kill()
+        self.assertEqual(self._pool.stats["busy-workers"], 0)
+        self.assertEqual(len(self._pool.encode(test_data)), _num_segments)
+
+    def test_failed_worker(self):
+        """a worker whose process dies is replaced"""
+        test_data = os.urandom(incoming_slice_size // 4)
+        for worker in self._pool._workers:
+            worker.process.terminate()
+            worker.process.join()
+        for _ in range(_worker_count):
+            self.assertRaises(ZfecProcessPoolError,
+                              self._pool.encode,
+                              test_data)
+        self.assertEqual(self._pool.stats["replaced-workers"], _worker_count)
+        self.assertEqual(len(self._pool.encode(test_data)), _num_segments)
+
+    def test_wedged_worker(self):
+        """a worker that never replies is timed out and replaced"""
+        test_data = os.urandom(incoming_slice_size // 4)
+        for worker in self._pool._workers:
+            os.kill(worker.process.pid, signal.SIGSTOP)
+        saved = (tools.zfec_process_pool._reply_timeout,
+                 tools.zfec_process_pool._join_timeout, )
+        tools.zfec_process_pool._reply_timeout = 0.1
+        tools.zfec_process_pool._join_timeout = 0.1
+        try:
+            for _ in range(_worker_count):
+                self.assertRaises(ZfecProcessPoolError,
+                                  self._pool.encode,
+                                  test_data)
+        finally:
+            (tools.zfec_process_pool._reply_timeout,
+             tools.zfec_process_pool._join_timeout, ) = saved
+        self.assertEqual(self._pool.stats["replaced-workers"], _worker_count)
+        self.assertEqual(self._pool.stats["busy-workers"], 0)
+        self.assertEqual(len(self._pool.encode(test_data)), _num_segments)
+
+    def test_decode_matches_segmenter(self):
+        """the pool must decode the same data as ZfecSegmenter"""
+        segmenter = ZfecSegmenter(_min_segments, _num_segments)
+        for data_size in [1,
+                          _min_segments - 1,
+                          incoming_slice_size - 1,
+                          incoming_slice_size, ]:
+            test_data = os.urandom(data_size)
+            padding_size = segmenter.padding_size(test_data)
+            encoded_segments = segmenter.encode(block_generator(test_data))
+            segment_numbers = random.sample(range(1, _num_segments+1),
+                                            _min_segments)
+            segments = [encoded_segments[n-1] for n in segment_numbers]
+            data_list = self._pool.decode(segments,
+                                          segment_numbers,
+                                          padding_size)
+            self.assertEqual(data_list,
+                             segmenter.decode(segments,
+                                              segment_numbers,
+                                              padding_size),
+                             data_size)
+            self.assertEqual(b"".join(data_list), test_data, data_size)
+
+    def test_concurrent_decodes(self):
+        """concurrent decodes each get their own data back"""
+        segmenter = ZfecSegmenter(_min_segments, _num_segments)
+        segment_numbers = list(range(3, _num_segments+1))
+        test_data_list = [os.urandom(incoming_slice_size // 4) \
+                          for _ in range(_worker_count * 3)]
+        greenlets = list()
+        for test_data in test_data_list:
+            encoded_segments = segmenter.encode(block_generator(test_data))
+            segments = [encoded_segments[n-1] for n in segment_numbers]
+            greenlets.append(gevent.spawn(self._pool.decode,
+                                          segments,
+                                          segment_numbers,
+                                          0))
+        gevent.joinall(greenlets)
+        for greenlet, test_data in zip(greenlets, test_data_list):
+            self.assertEqual(b"".join(greenlet.get()), test_data)
+        self.assertEqual(self._pool.stats["busy-workers"], 0)
+        self.assertEqual(self._pool.stats["decodes"], len(greenlets))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -66,6 +66,36 @@ class TestZfecSegmenter(unittest.TestCase):
         decoded_data = "".join(decoded_segments)
         self.assertTrue(decoded_data == test_data, len(decoded_data))
 
+    def test_primary_shares(self):
+        """test joining the primary shares without the decoder"""
+        segmenter = ZfecSegmenter(_min_segments, _num_segments)
+        for segment_size in [1, incoming_slice_size - 1, incoming_slice_size]:
+            test_data = os.urandom(segment_size)
+            padding_size = segmenter.padding_size(test_data)
+            encoded_segments = segmenter.encode(block_generator(test_data))
+
+            test_segment_numbers = list(range(1, _min_segments+1))
+            random.shuffle(test_segment_numbers)
+            test_segments = [encoded_segments[n-1] \
+                             for n in test_segment_numbers]
+
+            decoded_segments = segmenter.decode(
+                test_segments, test_segment_numbers, padding_size
+            )
+
+            decoded_data = b"".join(decoded_segments)
+            self.assertTrue(decoded_data == test_data, len(decoded_data))
+
+    def test_can_join(self):
+        """only a full set of primary shares can be joined"""
+        segmenter = ZfecSegmenter(_min_segments, _num_segments)
+        segment_numbers = list(range(1, _min_segments+1))
+        random.shuffle(segment_numbers)
+        self.assertTrue(segmenter.can_join(segment_numbers))
+        self.assertTrue(segmenter.can_join(segment_numbers + [_num_segments]))
+        segment_numbers[0] = _num_segments
+        self.assertFalse(segmenter.can_join(segment_numbers))
+
 if __name__ == "__main__":
     unittest.main()
 
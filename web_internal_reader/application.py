@@ -20,6 +20,8 @@ import re
 import time
 import uuid
 
+import gevent
+import gevent.queue
 from webob.dec import wsgify
 from webob import exc
 from webob import Response
@@ -28,6 +30,7 @@ from tools.data_definitions import create_timestamp, \
         block_size
 
 from tools.zfec_segmenter import ZfecSegmenter
+from tools.zfec_process_pool import ZfecProcessPoolError
 from tools.iter_exception_logger import iter_exception_logger
 
 from web_public_reader.retriever import memcached_key_template
@@ -99,7 +102,10 @@ class Application(object):
         data_readers,
         accounting_client,
         event_push_client,
-        stats
+        stats,
+        node_latency,
+        zfec_process_pool=None,
+        block_cache=None
     ):
         self._log = logging.getLogger("Application")
         self._memcached_client = memcached_client
@@ -110,7 +116,9 @@ class Application(object):
         self.accounting_client = accounting_client
         self._event_push_client = event_push_client
         self._stats = stats
-
+        self._node_latency = node_latency
+        self._zfec_process_pool = zfec_process_pool
+        self._block_cache = block_cache
 
         self._dispatch_table = {
             action_respond_to_ping      : self._respond_to_ping,
@@ -158,6 +166,101 @@ class Application(object):
                 user_request_id, req.url))
             raise
 
+    def _decode_segments(self, segmenter, segments):
+        """
+        decode one sequence. Joining the primary shares is cheap, so we
+        only send a sequence to the zfec process pool (if we have one)
+        when it needs the parity shares.
+        """
+        segment_numbers = segments.keys()
+        encoded_segments = list()
+        zfec_padding_size = None
+
+        for segment_number in segment_numbers:
+            encoded_segment, zfec_padding_size = segments[segment_number]
+            encoded_segments.append(encoded_segment)
+
+        if self._zfec_process_pool is None or \
+           segmenter.can_join(segment_numbers):
+            return segmenter.decode(encoded_segments,
+                                    segment_numbers,
+                                    zfec_padding_size)
+
+        return self._zfec_process_pool.decode(encoded_segments,
+                                              segment_numbers,
+                                              zfec_padding_size)
+
+    def _produce_sequences(self,
+                           segmenter,
+                           first_segments,
+                           retrieved,
+                           sequence_queue):
+        """
+        retrieve and decode each sequence, and queue its blocks. We end
+        with None, or with the exception that stopped us.
+        """
+        try:
+            for segments in chain([first_segments], retrieved):
+                sequence_queue.put(self._decode_segments(segmenter, segments))
+                # let the app iterator start sending this sequence before
+                # we ask for the next one
+                gevent.sleep(0)
+        except Exception, instance:
+            sequence_queue.put(instance)
+            return
+        sequence_queue.put(None)
+
+    def _decoded_sequences(self, segmenter, first_segments, retrieved):
+        """
+        generate the decoded blocks of each sequence. A producer greenlet
+        keeps one sequence ahead of us, so the next sequence is retrieved
+        and decoded while this one is sent.
+        """
+        sequence_queue = gevent.queue.Queue(maxsize=1)
+        producer = gevent.spawn(self._produce_sequences,
+                                segmenter,
+                                first_segments,
+                                retrieved,
+                                sequence_queue)
+        try:
+            while True:
+                decoded = sequence_queue.get()
+                if decoded is None:
+                    return
+                if isinstance(decoded, Exception):
+                    raise decoded
+                yield decoded
+        finally:
+            producer.kill()
+
+    def _retrieve_response(self,
+                           req,
+                           lower_bound,
+                           upper_bound,
+                           slice_size,
+                           total_file_size,
+                           app_iter):
+        response_headers = dict()
+        if "range" in req.headers:
+            status_int = httplib.PARTIAL_CONTENT
+            response_headers["Content-Range"] = \
+                _content_range_header(lower_bound,
+                                      upper_bound,
+                                      total_file_size)
+            response_headers["Content-Length"] = slice_size
+        else:
+            status_int = httplib.OK
+
+        response = Response(headers=response_headers)
+        
+        # Ticket #31 Guess Content-Type and Content-Encoding
+        response.content_type = "application/octet-stream"
+
+        response.status_int = status_int
+        if app_iter is not None:
+            response.app_iter = app_iter
+        return response
+
     def _respond_to_ping(self, _req, _match_object, _user_request_id):
         self._log.debug("_respond_to_ping")
         response = Response(status=httplib.OK, content_type="text/plain")
@@ -211,14 +314,6 @@ class Application(object):
             assert slice_size % block_size == 0, slice_size
             block_count = slice_size / block_size
 
-        connected_data_readers = _connected_clients(self.data_readers)
-
-        if len(connected_data_readers) < _min_connected_clients:
-            self._log.error("request {0} too few connected readers {1}".format(
-                            user_request_id, len(connected_data_readers)))
-            raise exc.HTTPServiceUnavailable("Too few connected readers {0}".format(
-                len(connected_data_readers)))
-
         result = self._get_params_from_memcache(unified_id, conjoined_part)
         if result is None:
             self._log.warn("request {0} cache miss unified-id {1} {2}".format(
@@ -243,6 +338,35 @@ class Application(object):
         )
         self._log.info(description)
 
+        cached_blocks = None
+        if self._block_cache is not None:
+            cached_blocks = self._block_cache.get_blocks(unified_id,
+                                                         conjoined_part,
+                                                         block_offset,
+                                                         block_count)
+        if cached_blocks is not None:
+            self._log.info("request {0} retrieved from block cache".format(
+                           user_request_id))
+            self.accounting_client.retrieved(
+                collection_id,
+                create_timestamp(),
+                sum([len(data) for data in cached_blocks])
+            )
+            return self._retrieve_response(req,
+                                           lower_bound,
+                                           upper_bound,
+                                           slice_size,
+                                           total_file_size,
+                                           cached_blocks)
+
+        connected_data_readers = _connected_clients(self.data_readers)
+
+        if len(connected_data_readers) < _min_connected_clients:
+            self._log.error("request {0} too few connected readers {1}".format(
+                            user_request_id, len(connected_data_readers)))
+            raise exc.HTTPServiceUnavailable("Too few connected readers {0}".format(
+                len(connected_data_readers)))
+
         start_time = time.time()
         self._stats["retrieves"] += 1
 
@@ -256,7 +380,8 @@ class Application(object):
             block_offset,
             block_count,
             _min_segments,
-            user_request_id
+            user_request_id,
+            node_latency=self._node_latency
         )
 
         retrieved = retriever.retrieve(_reply_timeout)
@@ -273,28 +398,22 @@ class Application(object):
         def app_iterator(response):
             segmenter = ZfecSegmenter( _min_segments, _max_segments)
             sent = 0
+            block_index = 0
             try:
-                for segments in chain([first_segments], retrieved):
-                    segment_numbers = segments.keys()
-                    encoded_segments = list()
-                    zfec_padding_size = None
-
-                    for segment_number in segment_numbers:
-                        encoded_segment, zfec_padding_size = \
-                                segments[segment_number]
-                        encoded_segments.append(encoded_segment)
-
-                    data_list = segmenter.decode(
-                        encoded_segments,
-                        segment_numbers,
-                        zfec_padding_size
-                    )
-
-                    for data in data_list:
+                for decoded in self._decoded_sequences(segmenter,
+                                                       first_segments,
+                                                       retrieved):
+                    for data in decoded:
+                        if self._block_cache is not None:
+                            self._block_cache.put(unified_id,
+                                                  conjoined_part,
+                                                  block_offset + block_index,
+                                                  data)
+                        block_index += 1
                         yield data
                         sent += len(data)
 
-            except RetrieveFailedError, instance:
+            except (RetrieveFailedError, ZfecProcessPoolError), instance:
                 self._log.error('retrieve failed: {0} {1}'.format(
                     description, instance
                 ))
@@ -305,6 +424,11 @@ class Application(object):
             end_time = time.time()
             self._stats["retrieves"] -= 1
 
+            if self._block_cache is not None and block_count is None:
+                self._block_cache.set_block_count(unified_id,
+                                                  conjoined_part,
+                                                  block_offset + block_index)
+
             self.accounting_client.retrieved(
                 collection_id,
                 create_timestamp(),
@@ -313,23 +437,12 @@ class Application(object):
 
         self._log.info("request {0} successful retrieve".format(user_request_id))
 
-        response_headers = dict()
-        if "range" in req.headers:
-            status_int = httplib.PARTIAL_CONTENT
-            response_headers["Content-Range"] = \
-                _content_range_header(lower_bound,
-                                      upper_bound,
-                                      total_file_size)
-            response_headers["Content-Length"] = slice_size
-        else:
-            status_int = httplib.OK
-
-        response = Response(headers=response_headers)
-        
-        # Ticket #31 Guess Content-Type and Content-Encoding
-        response.content_type = "application/octet-stream"
-
-        response.status_int = status_int
+        response = self._retrieve_response(req,
+                                           lower_bound,
+                                           upper_bound,
+                                           slice_size,
+                                           total_file_size,
+                                           None)
 
         # the exception blocks below will only catch exceptions before the
         # first yield of the generator, at which point we hand the
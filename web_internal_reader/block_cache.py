@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+block_cache.py
+
+class BlockCache
+
+A cache of decoded data blocks, keyed by
+(unified_id, conjoined_part, block index), so the internal reader can
+answer repeated reads of hot objects, and range requests into them,
+without going to the data readers.
+
+Entries are kept in a segmented LRU: a new entry goes into the probation
+segment, and moves to the protected segment when it is read again. When
+we need room, the least recently used probation entry goes first.
+
+A new entry is only admitted in place of that victim if it has been used
+more often (TinyLFU): a count-min sketch of recent block accesses, halved
+from time to time so that it forgets, keeps a long scan of cold blocks
+from flushing out the hot ones.
+
+The blocks are kept in memory, or, if a cache_path is given, in fixed
+size slots in a file on local disk, with only the index in memory. The
+file is recreated at startup. File reads and writes run in the gevent
+threadpool, one at a time, so a slow disk does not stall the hub; a slot
+being read is not reused until the read is done, and a block is not in
+the index until it has been written.
+
+We also remember the number of blocks in each conjoined part we have read
+to the end, so a read that does not give a block count can be answered
+from the cache.
+"""
+from collections import OrderedDict
+import logging
+import os
+
+import gevent
+import gevent.lock
+
+from tools.data_definitions import block_size
+
+_sketch_depth = 4
+_max_frequency = 15
+_protected_fraction = 0.8
+_max_block_counts = 64 * 1024
+# larger reads are not answered from the cache: we would have to hold all
+# of their blocks at once
+_max_read_size = int(
+    os.environ.get("NIMBUSIO_WEB_INTERNAL_READER_BLOCK_CACHE_MAX_READ",
+                   str(64 * 1024 * 1024)))
+
+class _FrequencySketch(object):
+    """
+    count-min sketch of how often each key has been used recently
+    """
+    def __init__(self, entry_count):
+        width = 16
+        while width < entry_count * 4:
+            width *= 2
+        self._mask = width - 1
+        self._tables = [[0] * width for _ in range(_sketch_depth)]
+        self._sample_size = width * 10
+        self._additions = 0
+
+    def _indexes(self, key):
+        return [hash((seed, key, )) & self._mask \
+                for seed in range(_sketch_depth)]
+
+    def increment(self, key):
+        for table, index in zip(self._tables, self._indexes(key)):
+            if table[index] < _max_frequency:
+                table[index] += 1
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._age()
+
+    def frequency(self, key):
+        return min([table[index] \
+                    for table, index in zip(self._tables,
+                                            self._indexes(key))])
+
+    def _age(self):
+        for table in self._tables:
+            for index in range(len(table)):
+                table[index] //= 2
+        self._additions //= 2
+
+class BlockCache(object):
+    """
+    max_bytes
+        the most block data we hold
+
+    cache_path
+        optional: the path of a file to hold the blocks, instead of memory
+    """
+    def __init__(self, max_bytes, cache_path=None):
+        self._log = logging.getLogger("BlockCache")
+        self._max_bytes = max_bytes
+        self._max_read_blocks = _max_read_size // block_size
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._protected_size = 0
+        self._block_counts = OrderedDict()
+        self._sketch = _FrequencySketch(max_bytes // block_size)
+
+        self._cache_file = None
+        self._free_slots = None
+        # slot -> the number of reads in progress
+        self._pinned_slots = dict()
+        # pinned slots whose entries have been evicted
+        self._released_pinned_slots = set()
+        self._io_lock = gevent.lock.Semaphore()
+        if cache_path is not None:
+            self._log.info("caching blocks in {0}".format(cache_path))
+            self._cache_file = open(cache_path, "w+b")
+            self._free_slots = list(range(max_bytes // block_size))
+
+        self.stats = {
+            "hits"          : 0,
+            "misses"        : 0,
+            "admitted"      : 0,
+            "rejected"      : 0,
+            "evictions"     : 0,
+            "entries"       : 0,
+            "bytes"         : 0,
+        }
+
+    def __len__(self):
+        return len(self._probation) + len(self._protected)
+
+    def block_count(self, unified_id, conjoined_part):
+        """
+        the number of blocks in a conjoined part, or None if we don't know
+        """
+        return self._block_counts.get((unified_id, conjoined_part, ))
+
+    def set_block_count(self, unified_id, conjoined_part, block_count):
+        key = (unified_id, conjoined_part, )
+        self._block_counts.pop(key, None)
+        self._block_counts[key] = block_count
+        if len(self._block_counts) > _max_block_counts:
+            self._block_counts.popitem(last=False)
+
+    def get_blocks(self, unified_id, conjoined_part, block_offset, block_count):
+        """
+        return the list of data blocks for the read, if we hold all of them,
+        otherwise None
+        """
+        if block_count is None:
+            total_block_count = self.block_count(unified_id, conjoined_part)
+            if total_block_count is None:
+                self.stats["misses"] += 1
+                return None
+            block_count = total_block_count - block_offset
+
+        if block_count > self._max_read_blocks:
+            self.stats["misses"] += 1
+            return None
+
+        keys = [(unified_id, conjoined_part, block_index, ) \
+                for block_index in range(block_offset,
+                                         block_offset + block_count)]
+        for key in keys:
+            if key not in self._probation and key not in self._protected:
+                self.stats["misses"] += 1
+                return None
+
+        values = list()
+        for key in keys:
+            self._sketch.increment(key)
+            values.append(self._touch(key))
+        self.stats["hits"] += 1
+        return self._load(values)
+
+    def put(self, unified_id, conjoined_part, block_index, data):
+        """
+        offer a block just read from the data readers
+        """
+        key = (unified_id, conjoined_part, block_index, )
+        self._sketch.increment(key)
+        if key in self._probation or key in self._protected:
+            return
+
+        size = self._entry_size(data)
+        if size > self._max_bytes:
+            self.stats["rejected"] += 1
+            return
+
+        while not self._has_room(size):
+            if len(self) == 0:
+                # the only free slots are still being read
+                self.stats["rejected"] += 1
+                return
+            victim_key = self._victim()
+            if self._sketch.frequency(key) <= \
+               self._sketch.frequency(victim_key):
+                self.stats["rejected"] += 1
+                return
+            self._evict(victim_key)
+
+        self.stats["bytes"] += size
+        try:
+            value = self._store(data)
+        except Exception:
+            self._log.exception("unable to store block {0}".format(key))
+            self.stats["bytes"] -= size
+            self.stats["rejected"] += 1
+            return
+        if key in self._probation or key in self._protected:
+            # another greenlet stored the block while we were writing it
+            self._release(value)
+            self.stats["bytes"] -= size
+            return
+
+        self._probation[key] = (value, size, )
+        self.stats["entries"] = len(self)
+        self.stats["admitted"] += 1
+
+    def close(self):
+        if self._cache_file is not None:
+            with self._io_lock:
+                self._cache_file.close()
+                self._cache_file = None
+
+    def _entry_size(self, data):
+        # a block in the cache file takes up a whole slot
+        if self._cache_file is not None:
+            return block_size
+        return len(data)
+
+    def _has_room(self, size):
+        if self._cache_file is not None and len(self._free_slots) == 0:
+            return False
+        return self.stats["bytes"] + size <= self._max_bytes
+
+    def _victim(self):
+        if len(self._probation) > 0:
+            return next(iter(self._probation))
+        return next(iter(self._protected))
+
+    def _evict(self, key):
+        if key in self._probation:
+            value, size = self._probation.pop(key)
+        else:
+            value, size = self._protected.pop(key)
+            self._protected_size -= size
+        self._release(value)
+        self.stats["bytes"] -= size
+        self.stats["entries"] = len(self)
+        self.stats["evictions"] += 1
+
+    def _touch(self, key):
+        """
+        mark an entry as just used, return its stored value
+        """
+        if key in self._protected:
+            entry = self._protected.pop(key)
+            self._protected[key] = entry
+            return entry[0]
+
+        # a second use promotes an entry from probation; the protected
+        # segment's least recently used entries go back to probation
+        entry = self._probation.pop(key)
+        self._protected[key] = entry
+        self._protected_size += entry[1]
+        while self._protected_size > self._max_bytes * _protected_fraction:
+            demoted_key, demoted_entry = self._protected.popitem(last=False)
+            self._protected_size -= demoted_entry[1]
+            self._probation[demoted_key] = demoted_entry
+        return entry[0]
+
+    def _store(self, data):
+        if self._cache_file is None:
+            return data
+        slot = self._free_slots.pop()
+        try:
+            with self._io_lock:
+                gevent.get_hub().threadpool.apply(self._write_slot,
+                                                  (slot, data, ))
+        except Exception:
+            self._free_slots.append(slot)
+            raise
+        return (slot, len(data), )
+
+    def _load(self, values):
+        """
+        return the data for a list of stored values
+        """
+        if self._cache_file is None:
+            return values
+        slots = [slot for slot, _ in values]
+        for slot in slots:
+            self._pinned_slots[slot] = self._pinned_slots.get(slot, 0) + 1
+        try:
+            with self._io_lock:
+                return gevent.get_hub().threadpool.apply(self._read_slots,
+                                                         (values, ))
+        finally:
+            for slot in slots:
+                self._unpin(slot)
+
+    def _write_slot(self, slot, data):
+        # runs in the threadpool
+        self._cache_file.seek(slot * block_size)
+        self._cache_file.write(data)
+
+    def _read_slots(self, values):
+        # runs in the threadpool
+        data_list = list()
+        for slot, data_size in values:
+            self._cache_file.seek(slot * block_size)
+            data_list.append(self._cache_file.read(data_size))
+        return data_list
+
+    def _unpin(self, slot):
+        self._pinned_slots[slot] -= 1
+        if self._pinned_slots[slot] > 0:
+            return
+        del self._pinned_slots[slot]
+        if slot in self._released_pinned_slots:
+            self._released_pinned_slots.remove(slot)
+            self._free_slots.append(slot)
+
+    def _release(self, value):
+        if self._cache_file is not None:
+            slot, _ = value
+            if slot in self._pinned_slots:
+                self._released_pinned_slots.add(slot)
+            else:
+                self._free_slots.append(slot)
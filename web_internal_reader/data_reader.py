@@ -7,9 +7,15 @@ A class that represents a data reader in the system.
 from base64 import b64decode
 import hashlib
 import logging
+import os
 
 from tools.greenlet_resilient_client import ResilientClientError
 
+# the number of sequences we allow the data reader to read ahead of our
+# retrieve-key-next requests; 0 means one read per request
+_read_ahead_credit = int(
+    os.environ.get("NIMBUSIO_RETRIEVE_READ_AHEAD_CREDIT", "2"))
+
 class DataReader(object):
 
     def __init__(self, node_name, resilient_client):
@@ -49,6 +55,7 @@ class DataReader(object):
             "handoff-node-id"           : None,
             "block-offset"              : block_offset,
             "block-count"               : block_count,
+            "read-ahead-credit"         : _read_ahead_credit,
         }
         try:
             delivery_channel = \
@@ -161,3 +168,25 @@ class DataReader(object):
             return None
 
         return data, reply["zfec-padding-size"], reply["completed"]
+
+    def retrieve_key_cancel(self, 
+                            retrieve_id,
+                            segment_unified_id, 
+                            segment_num,
+                            user_request_id):
+        """
+        tell the data reader we no longer want anything from this retrieve
+        we don't expect a reply
+        """
+        message = {
+            "message-type"              : "retrieve-key-cancel",
+            "user-request-id"           : user_request_id,
+            "retrieve-id"               : retrieve_id,
+            "segment-unified-id"        : segment_unified_id,
+            "segment-num"               : segment_num,
+        }
+        self._resilient_client.queue_message_for_broadcast(message)
+
+        self._log.debug("request: {user-request-id} " \
+                        "{message-type}: {segment-unified-id} {segment-num}".format(
+                        **message))
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+node_latency.py
+
+class NodeLatency
+
+Recent retrieve reply times and errors for each data reader node. The
+Retriever uses them to decide which nodes to ask first, and when a reply
+is late enough that it should send a hedged request to another node.
+
+For each node we keep exponentially weighted moving averages of:
+
+latency
+    the retrieve reply time, with its mean deviation
+error-rate
+    the fraction of retrieve replies that fail
+ack-latency
+    the time the node's resilient server takes to ack a message
+ack-error-rate
+    the fraction of resilient client acks that time out
+
+and a window of recent reply times, for the hedge delay percentile.
+
+The ack averages are kept apart from the reply averages: a node that acks
+every message promptly may still fail its reads. A node is scored by the
+worse of its two error rates.
+"""
+from collections import defaultdict, deque
+import os
+
+_window_size = 256
+_min_samples = 16
+_hedge_percentile = float(
+    os.environ.get("NIMBUSIO_RETRIEVE_HEDGE_PERCENTILE", "95.0"))
+_default_hedge_delay = float(
+    os.environ.get("NIMBUSIO_RETRIEVE_HEDGE_DELAY", "1.0"))
+_min_hedge_delay = 0.05
+_latency_alpha = float(
+    os.environ.get("NIMBUSIO_RETRIEVE_LATENCY_EWMA_ALPHA", "0.125"))
+_deviation_beta = 0.25
+_error_alpha = float(
+    os.environ.get("NIMBUSIO_RETRIEVE_ERROR_EWMA_ALPHA", "0.1"))
+# a node is degraded when its score is this many times the median
+_degraded_factor = float(
+    os.environ.get("NIMBUSIO_RETRIEVE_DEGRADED_FACTOR", "4.0"))
+
+def _ewma(average, sample, alpha):
+    if average is None:
+        return sample
+    return average + alpha * (sample - average)
+
+def _median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+class NodeLatency(object):
+    """
+    hedge_percentile
+        a reply is late when it takes longer than this percentile of the
+        node's recent replies
+
+    default_hedge_delay
+        seconds we wait before hedging a node we know nothing about
+    """
+    def __init__(self,
+                 hedge_percentile=_hedge_percentile,
+                 default_hedge_delay=_default_hedge_delay):
+        self._hedge_percentile = hedge_percentile
+        self._default_hedge_delay = default_hedge_delay
+        self._samples = defaultdict(lambda: deque(maxlen=_window_size))
+        self.stats = dict()
+
+    def _node_stats(self, node_name):
+        try:
+            return self.stats[node_name]
+        except KeyError:
+            node_stats = {
+                "latency"           : None,
+                "latency-deviation" : 0.0,
+                "error-rate"        : 0.0,
+                "ack-latency"       : None,
+                "ack-error-rate"    : 0.0,
+                "replies"           : 0,
+                "errors"            : 0,
+            }
+            self.stats[node_name] = node_stats
+            return node_stats
+
+    def record(self, node_name, seconds):
+        """
+        record the time a node took to reply to a retrieve request
+        """
+        self._samples[node_name].append(seconds)
+        node_stats = self._node_stats(node_name)
+        if node_stats["latency"] is not None:
+            node_stats["latency-deviation"] = \
+                _ewma(node_stats["latency-deviation"],
+                      abs(seconds - node_stats["latency"]),
+                      _deviation_beta)
+        node_stats["latency"] = \
+            _ewma(node_stats["latency"], seconds, _latency_alpha)
+        node_stats["error-rate"] = \
+            _ewma(node_stats["error-rate"], 0.0, _error_alpha)
+        node_stats["replies"] += 1
+
+    def latency(self, node_name):
+        """
+        the moving average of the node's reply time, or None if we have
+        no replies from it
+        """
+        node_stats = self.stats.get(node_name)
+        if node_stats is None:
+            return None
+        return node_stats["latency"]
+
+    def record_error(self, node_name):
+        """
+        record a failed retrieve request
+        """
+        node_stats = self._node_stats(node_name)
+        node_stats["error-rate"] = \
+            _ewma(node_stats["error-rate"], 1.0, _error_alpha)
+        node_stats["errors"] += 1
+
+    def record_ack(self, node_name, seconds):
+        """
+        the ack callback for a node's GreenletResilientClient:
+        seconds is None for an ack timeout
+        """
+        node_stats = self._node_stats(node_name)
+        if seconds is None:
+            node_stats["ack-error-rate"] = \
+                _ewma(node_stats["ack-error-rate"], 1.0, _error_alpha)
+            node_stats["errors"] += 1
+            return
+        node_stats["ack-latency"] = \
+            _ewma(node_stats["ack-latency"], seconds, _latency_alpha)
+        node_stats["ack-error-rate"] = \
+            _ewma(node_stats["ack-error-rate"], 0.0, _error_alpha)
+
+    def hedge_delay(self, node_name):
+        """
+        return the seconds after which a reply from node_name is late
+        """
+        samples = self._samples.get(node_name)
+        if samples is None:
+            return self._default_hedge_delay
+
+        if len(samples) < _min_samples:
+            # too few replies for a percentile: use the moving average,
+            # as TCP does for its retransmission timeout
+            node_stats = self.stats[node_name]
+            return max(node_stats["latency"] + \
+                        4.0 * node_stats["latency-deviation"],
+                       _min_hedge_delay)
+
+        ordered = sorted(samples)
+        index = int(len(ordered) * self._hedge_percentile / 100.0)
+        index = min(index, len(ordered) - 1)
+        return max(ordered[index], _min_hedge_delay)
+
+    def score(self, node_name):
+        """
+        the expected cost in seconds of asking node_name: its reply time,
+        plus the hedge delay we lose when its reply fails. A node we know
+        nothing about scores 0, so it gets tried.
+        """
+        node_stats = self.stats.get(node_name)
+        if node_stats is None or node_stats["latency"] is None:
+            return 0.0
+        error_rate = max(node_stats["error-rate"], 
+                         node_stats["ack-error-rate"])
+        return node_stats["latency"] + \
+               error_rate * self.hedge_delay(node_name)
+
+    def rank(self, node_names):
+        """
+        return node_names, best first
+        """
+        return sorted(node_names, key=self.score)
+
+    def is_degraded(self, node_name):
+        """
+        True if node_name is much slower, or fails much more often,
+        than the typical node
+        """
+        scores = [self.score(name) for name, node_stats in self.stats.items() \
+                  if node_stats["latency"] is not None]
+        if len(scores) < 2:
+            return False
+        return self.score(node_name) > _degraded_factor * _median(scores)
@@ -3,8 +3,19 @@
 retriever.py
 
 A class that retrieves data from data readers.
+
+In the default "systematic" read mode we ask only segments_needed nodes,
+preferring the data segments (1-8), whose shares zfec can join without
+decoding, unless NodeLatency says a node is degraded; other nodes are
+ranked by their reply times and error rates. A node whose reply is later
+than its hedge delay (a percentile of its recent reply times), or whose
+reply fails, gets a hedged request sent to a spare node (the parity
+segments, or a data segment we skipped). A spare that joins part way
+through a retrieve starts at the block where the others are. Read mode
+"all" asks every node, as we used to.
 """
 import logging
+import os
 import time
 import uuid
 
@@ -12,11 +23,15 @@ import gevent
 import gevent.pool
 import gevent.queue
 
+from tools.data_definitions import encoded_block_slice_size
+
 from web_internal_reader.exceptions import RetrieveFailedError
+from web_internal_reader.node_latency import NodeLatency
 
 # 2012-06-13 dougfort - we don't want to block too long here
 # because if a node is down, we will block a lot
 _task_timeout = 1.0
+_read_mode = os.environ.get("NIMBUSIO_RETRIEVE_READ_MODE", "systematic")
 
 class Retriever(object):
     """Retrieves data from data readers."""
@@ -31,7 +46,8 @@ class Retriever(object):
         block_offset,
         block_count,
         segments_needed,
-        user_request_id
+        user_request_id,
+        node_latency=None
     ):
         self._log = logging.getLogger("Retriever")
         self._log.info("request {0} {1}, {2}, {3}, {4}, {5} {6}".format(
@@ -56,6 +72,16 @@ class Retriever(object):
         self._pending = gevent.pool.Group()
         self._finished_tasks = gevent.queue.Queue()
         self._sequence = 0
+        self._retrieve_id = None
+        # segment numbers of the nodes we have told to cancel this retrieve
+        self._cancelled_segment_numbers = set()
+        self._node_latency = \
+            (NodeLatency() if node_latency is None else node_latency)
+        # segment numbers of the nodes we ask for each sequence
+        self._active_segment_numbers = set()
+        # segment numbers of the nodes we have sent retrieve-key-start
+        self._started_segment_numbers = set()
+        self._blocks_retrieved = 0
 
     def _unhandled_greenlet_exception(self, greenlet_object):
         self._log.error("request {0}: " \
@@ -66,6 +92,8 @@ class Retriever(object):
                         str(greenlet_object.exception)))
                 
     def _done_link(self, task):
+        task.finish_time = time.time()
+        self._record_task(task)
         if task.sequence != self._sequence:
             self._log.debug("request {0} _done_link ignore task {1} seq {2} expect {3}".format(
                 self._user_request_id,
@@ -76,12 +104,237 @@ class Retriever(object):
         else:
             self._finished_tasks.put(task, block=True)
 
+    def _record_task(self, task):
+        """
+        feed every reply, including the ones we no longer wait for, to the
+        node latency averages
+        """
+        node_name = task.data_reader.node_name
+        seconds = task.finish_time - task.dispatch_time
+        if isinstance(task.value, gevent.GreenletExit):
+            # we gave up on this node: the time it had taken so far is a
+            # lower bound on its reply time, so it must not pull the
+            # average down
+            latency = self._node_latency.latency(node_name)
+            if latency is not None:
+                seconds = max(seconds, latency)
+            self._node_latency.record(node_name, seconds)
+        elif not task.successful() or task.value is None:
+            self._node_latency.record_error(node_name)
+        else:
+            self._node_latency.record(node_name, seconds)
+
+    def _rank_segment_numbers(self, segment_numbers):
+        """
+        return segment_numbers, the fastest and most reliable nodes first
+        """
+        return sorted(segment_numbers,
+                      key=lambda n: self._node_latency.score(
+                        self._data_readers[n-1].node_name))
+
+    def _cancel_unfinished_tasks(self):
+        """
+        we have enough replies for this sequence: tell the nodes we are
+        still waiting for to drop the work they have queued for the retrieve,
+        and don't ask them for the rest of it
+        """
+        for task in self._pending:
+            if task.ready():
+                continue
+            self._log.debug("request {0} cancel {1}".format(
+                self._user_request_id, task.data_reader.node_name,
+            ))
+            task.data_reader.retrieve_key_cancel(self._retrieve_id,
+                                                 self._unified_id,
+                                                 task.segment_number,
+                                                 self._user_request_id)
+            self._cancelled_segment_numbers.add(task.segment_number)
+            self._active_segment_numbers.discard(task.segment_number)
+
+    def _usable_segment_numbers(self):
+        """
+        the segment numbers of the connected nodes we have not cancelled,
+        in order
+        """
+        segment_numbers = list()
+        for i, data_reader in enumerate(self._data_readers):
+            if not data_reader.connected:
+                continue
+
+            segment_number = i + 1
+            if segment_number in self._cancelled_segment_numbers:
+                continue
+
+            segment_numbers.append(segment_number)
+
+        return segment_numbers
+
+    def _select_segment_numbers(self):
+        """
+        choose the nodes to ask for the next sequence
+        """
+        for data_reader in self._data_readers:
+            if not data_reader.connected:
+                self._log.warn("request {0} ignoring disconnected reader {1}".format(
+                    self._user_request_id, str(data_reader),
+                ))
+
+        usable = self._usable_segment_numbers()
+        if _read_mode == "all":
+            self._active_segment_numbers = set(usable)
+            return
+
+        # the data segments come first, so zfec can join them without
+        # decoding, unless a node is degraded
+        preferred = list()
+        others = list()
+        for segment_number in usable:
+            node_name = self._data_readers[segment_number-1].node_name
+            if segment_number <= self._segments_needed and \
+               not self._node_latency.is_degraded(node_name):
+                preferred.append(segment_number)
+            else:
+                others.append(segment_number)
+
+        ordered = preferred + self._rank_segment_numbers(others)
+        self._active_segment_numbers.intersection_update(usable)
+        for segment_number in ordered:
+            if len(self._active_segment_numbers) >= self._segments_needed:
+                break
+            self._active_segment_numbers.add(segment_number)
+
+        # a late node that answered after we hedged it leaves us with more
+        # nodes than we need: keep the best, and cancel the rest
+        active = [segment_number for segment_number in ordered \
+                  if segment_number in self._active_segment_numbers]
+        for segment_number in active[self._segments_needed:]:
+            self._log.debug("request {0} dropping segment {1}".format(
+                self._user_request_id, segment_number,
+            ))
+            self._drop_segment_number(segment_number)
+
+    def _spare_segment_numbers(self):
+        return self._rank_segment_numbers(
+            [segment_number \
+             for segment_number in self._usable_segment_numbers() \
+             if segment_number not in self._active_segment_numbers])
+
+    def _spawn_request(self, segment_number):
+        """
+        ask one node for the current sequence: retrieve-key-start if we
+        have not asked it before, otherwise retrieve-key-next
+        """
+        data_reader = self._data_readers[segment_number-1]
+        if segment_number in self._started_segment_numbers:
+            task = self._pending.spawn(
+                data_reader.retrieve_key_next,
+                self._retrieve_id,
+                self._sequence,
+                self._collection_id,
+                self._key,
+                self._unified_id,
+                self._conjoined_part,
+                segment_number,
+                self._block_offset,
+                self._block_count,
+                self._user_request_id
+            )
+        else:
+            # a node joining part way through starts where the others are
+            if self._block_count is None:
+                block_count = None
+            else:
+                block_count = self._block_count - self._blocks_retrieved
+            task = self._pending.spawn(
+                data_reader.retrieve_key_start,
+                self._retrieve_id,
+                self._sequence,
+                self._collection_id,
+                self._key,
+                self._unified_id,
+                self._conjoined_part,
+                segment_number,
+                self._block_offset + self._blocks_retrieved,
+                block_count,
+                self._user_request_id,
+            )
+            self._started_segment_numbers.add(segment_number)
+        task.link(self._done_link)
+        task.link_exception(self._unhandled_greenlet_exception)
+        task.segment_number = segment_number
+        task.data_reader = data_reader
+        task.sequence = self._sequence
+        task.dispatch_time = time.time()
+        task.finish_time = None
+        task.hedged = False
+
+    def _spawn_hedge(self, task, reason):
+        """
+        ask a spare node for the current sequence in place of task
+
+        return the number of requests sent
+        """
+        spares = self._spare_segment_numbers()
+        if len(spares) == 0:
+            return 0
+
+        segment_number = spares[0]
+        self._log.info("request {0} hedging {1} ({2}) with segment {3}".format(
+            self._user_request_id,
+            task.data_reader.node_name,
+            reason,
+            segment_number,
+        ))
+        self._active_segment_numbers.add(segment_number)
+        self._spawn_request(segment_number)
+        return 1
+
+    def _hedge_late_tasks(self):
+        """
+        send a hedged request for each node that is later than its
+        hedge delay
+
+        return the number of requests sent
+        """
+        hedge_count = 0
+        current_time = time.time()
+        for task in list(self._pending):
+            if task.ready() or task.hedged or task.sequence != self._sequence:
+                continue
+            hedge_delay = \
+                self._node_latency.hedge_delay(task.data_reader.node_name)
+            if current_time - task.dispatch_time < hedge_delay:
+                continue
+            sent_count = self._spawn_hedge(task, "late")
+            if sent_count == 0:
+                break
+            task.hedged = True
+            hedge_count += sent_count
+        return hedge_count
+
+    def _next_wait(self):
+        """
+        how long to wait for a reply before we look for late nodes
+        """
+        if len(self._spare_segment_numbers()) == 0:
+            return _task_timeout
+
+        wait = _task_timeout
+        current_time = time.time()
+        for task in self._pending:
+            if task.ready() or task.hedged or task.sequence != self._sequence:
+                continue
+            deadline = task.dispatch_time + \
+                self._node_latency.hedge_delay(task.data_reader.node_name)
+            wait = min(wait, max(0.0, deadline - current_time))
+        return wait
+
     def retrieve(self, timeout):
         retrieve_id = uuid.uuid1().hex
+        self._retrieve_id = retrieve_id
 
         # spawn retrieve_key start, then spawn retrieve key next
         # until we are done
-        start = True
         while True:
             self._sequence += 1
             self._log.debug("request {0} retrieve: {1} {2} {3} {4}".format(
@@ -91,72 +344,40 @@ class Retriever(object):
                 self._conjoined_part,
                 retrieve_id
             ))
-            # send a request to all node
-            for i, data_reader in enumerate(self._data_readers):
-                if not data_reader.connected:
-                    self._log.warn("request {0} ignoring disconnected reader {1}".format(
-                        self._user_request_id, str(data_reader),
-                    ))
-                    continue
-
-                segment_number = i + 1
-                if start:
-                    task = self._pending.spawn(
-                        data_reader.retrieve_key_start,
-                        retrieve_id,
-                        self._sequence,
-                        self._collection_id,
-                        self._key,
-                        self._unified_id,
-                        self._conjoined_part,
-                        segment_number,
-                        self._block_offset,
-                        self._block_count,
-                        self._user_request_id,
-                    )
-                else:
-                    task = self._pending.spawn(
-                        data_reader.retrieve_key_next,
-                        retrieve_id,
-                        self._sequence,
-                        self._collection_id,
-                        self._key,
-                        self._unified_id,
-                        self._conjoined_part,
-                        segment_number,
-                        self._block_offset,
-                        self._block_count,
-                        self._user_request_id
-                    )
-                task.link(self._done_link)
-                task.link_exception(self._unhandled_greenlet_exception)
-                task.segment_number = segment_number
-                task.data_reader = data_reader
-                task.sequence = self._sequence
+            self._select_segment_numbers()
+            request_count = 0
+            for segment_number in sorted(self._active_segment_numbers):
+                request_count += 1
+                self._spawn_request(segment_number)
 
             # wait for, and process, replies from the nodes
-            result_dict, completed = self._process_node_replies(timeout)
+            result_dict, completed = self._process_node_replies(request_count,
+                                                                timeout)
             self._log.debug("request {0} retrieve: completed sequence {1}".format(
                 self._user_request_id, self._sequence,
             ))
 
+            data_segment, _ = next(iter(result_dict.values()))
+            segment_size = sum([len(block) for block in data_segment])
+            self._blocks_retrieved += \
+                (segment_size + encoded_block_slice_size - 1) // \
+                encoded_block_slice_size
+
             yield result_dict
             if completed:
                 break
 
-            start = False
-
-    def _process_node_replies(self, timeout):
+    def _process_node_replies(self, request_count, timeout):
         finished_task_count = 0
         result_dict = dict()
         completed_list = list()
         start_time = time.time()
 
         # block on the finished_tasks queue until done
-        while finished_task_count < len(self._data_readers):
+        while finished_task_count < request_count:
             try:
                 task = self._finished_tasks.get(block=True, 
-                                                timeout=_task_timeout)
+                                                timeout=self._next_wait())
             except gevent.queue.Empty:
                 elapsed_time = time.time() - start_time
                 if elapsed_time > timeout:
@@ -169,6 +390,7 @@ class Retriever(object):
                                                             error_message))
                     raise RetrieveFailedError(error_message)
 
+                request_count += self._hedge_late_tasks()
                 continue
 
             # if we previously only waited for 8/10 replies, we may still get
@@ -188,6 +410,10 @@ class Retriever(object):
             result = self._process_finished_task(task)
 
             if result is None:
+                sent_count = self._spawn_hedge(task, "failed")
+                request_count += sent_count
+                if sent_count > 0 and _read_mode != "all":
+                    self._drop_failed_node(task)
                 continue
 
             data_segment, zfec_padding_size, completion_status = result
@@ -204,6 +430,7 @@ class Retriever(object):
                     self._key,
                     len(result_dict),
                 ))
+                self._cancel_unfinished_tasks()
                 self._pending.kill()
                 break
 
@@ -245,6 +472,25 @@ class Retriever(object):
         ))
         return result_dict, False
         
+    def _drop_failed_node(self, task):
+        """
+        a spare has taken over from a node whose read failed: tell the node
+        to drop the retrieve, and don't ask it for the rest of it
+        """
+        self._drop_segment_number(task.segment_number)
+
+    def _drop_segment_number(self, segment_number):
+        """
+        tell a node to drop the retrieve, and don't ask it for the rest of it
+        """
+        data_reader = self._data_readers[segment_number-1]
+        data_reader.retrieve_key_cancel(self._retrieve_id,
+                                        self._unified_id,
+                                        segment_number,
+                                        self._user_request_id)
+        self._cancelled_segment_numbers.add(segment_number)
+        self._active_segment_numbers.discard(segment_number)
+
     def _process_finished_task(self, task):
         if isinstance(task.value, gevent.GreenletExit):
             self._log.debug(
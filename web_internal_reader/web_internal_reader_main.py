@@ -37,10 +37,14 @@ from tools.greenlet_push_client import GreenletPUSHClient
 from tools.database_connection import get_central_connection, \
         get_node_local_connection
 from tools.event_push_client import EventPushClient
-from tools.data_definitions import create_timestamp
+from tools.data_definitions import create_timestamp, \
+        incoming_slice_size
+from tools.zfec_process_pool import ZfecProcessPool
 
 from web_internal_reader.application import Application
+from web_internal_reader.block_cache import BlockCache
 from web_internal_reader.data_reader import DataReader
+from web_internal_reader.node_latency import NodeLatency
 from web_public_reader.space_accounting_client import SpaceAccountingClient
 from web_internal_reader.watcher import Watcher
 from web_public_reader.central_database_util import get_cluster_row
@@ -70,6 +74,18 @@ _stats = {
 _memcached_host = os.environ.get("NIMBUSIO_MEMCACHED_HOST", "localhost")
 _memcached_port = int(os.environ.get("NIMBUSIO_MEMCACHED_PORT", "11211"))
 _memcached_nodes = ["{0}:{1}".format(_memcached_host, _memcached_port), ]
+# number of worker processes for zfec decoding, 0 means decode in the
+# request greenlet
+_decoder_worker_count = int(
+    os.environ.get("NIMBUSIO_WEB_INTERNAL_READER_DECODER_WORKERS", "2"))
+_min_segments = 8
+# bytes of decoded blocks to cache, 0 means no cache
+_block_cache_size = int(
+    os.environ.get("NIMBUSIO_WEB_INTERNAL_READER_BLOCK_CACHE_SIZE",
+                   str(256 * 1024 * 1024)))
+# if set, the cached blocks are kept in this file rather than in memory
+_block_cache_path = \
+    os.environ.get("NIMBUSIO_WEB_INTERNAL_READER_BLOCK_CACHE_PATH")
 
 def _signal_handler_closure(halt_event):
     def _signal_handler(*_args):
@@ -96,6 +112,9 @@ class WebInternalReader(object):
         )
         self._pull_server.link_exception(self._unhandled_greenlet_exception)
 
+        self._node_latency = NodeLatency()
+        _stats["nodes"] = self._node_latency.stats
+
         self._data_reader_clients = list()
         self._data_readers = list()
         for node_name, address in zip(_node_names, _data_reader_addresses):
@@ -106,7 +125,8 @@ class WebInternalReader(object):
                 _client_tag,
                 _web_internal_reader_pipeline_address,
                 self._deliverator,
-                connect_messages=[]
+                connect_messages=[],
+                ack_callback=self._node_latency.record_ack
             )
             resilient_client.link_exception(self._unhandled_greenlet_exception)
             self._data_reader_clients.append(resilient_client)
@@ -156,6 +176,24 @@ class WebInternalReader(object):
             self._event_push_client
         )
 
+        # the decoder processes are forked here: they never touch the
+        # zeromq sockets they inherit
+        self._zfec_process_pool = None
+        if _decoder_worker_count > 0:
+            self._zfec_process_pool = ZfecProcessPool(
+                _min_segments,
+                len(_node_names),
+                _decoder_worker_count,
+                incoming_slice_size,
+                self._event_push_client
+            )
+
+        self._block_cache = None
+        if _block_cache_size > 0:
+            self._block_cache = BlockCache(_block_cache_size,
+                                           _block_cache_path)
+            _stats["block-cache"] = self._block_cache.stats
+
         self.application = Application(
             memcached_client,
             self._central_connection,
@@ -164,7 +202,10 @@ class WebInternalReader(object):
             self._data_readers,
             self._accounting_client,
             self._event_push_client,
-            _stats
+            _stats,
+            self._node_latency,
+            zfec_process_pool=self._zfec_process_pool,
+            block_cache=self._block_cache
         )
         self.wsgi_server = WSGIServer(
             (_web_internal_reader_host, _web_internal_reader_port), 
@@ -196,6 +237,11 @@ class WebInternalReader(object):
         self._watcher.join()
         for client in self._data_reader_clients:
             client.join()
+        if self._zfec_process_pool is not None:
+            self._log.debug("stopping zfec process pool")
+            self._zfec_process_pool.close()
+        if self._block_cache is not None:
+            self._block_cache.close()
         self._log.debug("closing zmq")
         self._event_push_client.close()
         self._zeromq_context.term()
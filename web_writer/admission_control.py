@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+admission_control.py
+
+class AdmissionControl
+
+Limits the memory the web writer commits to archives in progress.
+
+Each archive reserves an estimate of the memory it will hold (raw slices
+queued for encoding and zfec shares in flight to the data writers) out of a
+global byte budget before it reads the request body. Archives that do not
+fit wait, first come first served, for up to a timeout; after that the
+caller should shed the request.
+
+In quorum mode an archive may keep the segments it has sent, for handing
+off slow data writers, after its response (and its reservation) are gone:
+the Archiver charges that history to the budget until it lets it go.
+
+The slice size itself is fixed (the anti-entropy tools expect
+file_size / incoming_slice_size sequences), so we adapt what we can: a small
+upload reserves only its content length, and when more than half of the
+budget is in use, new archives get a pipeline of one slice.
+"""
+from collections import deque
+import logging
+import time
+
+import gevent.event
+
+from tools.data_definitions import block_size
+
+_reporting_interval = 60.0
+
+def _round_up_to_block(size):
+    blocks = size // block_size
+    if size % block_size != 0:
+        blocks += 1
+    return max(blocks, 1) * block_size
+
+class AdmissionControl(object):
+    """
+    budget
+        the total bytes we allow archives to reserve
+
+    slice_size
+        the size of a slice (incoming_slice_size)
+
+    slice_window
+        the most slices an archive may have in flight
+
+    num_segments, min_segments
+        zfec parameters: shares take num_segments/min_segments the size of
+        the data they encode
+
+    event_push_client
+        optional: used to publish budget stats periodically
+    """
+    def __init__(self,
+                 budget,
+                 slice_size,
+                 slice_window,
+                 num_segments,
+                 min_segments,
+                 event_push_client=None):
+        self._log = logging.getLogger("AdmissionControl")
+        self._budget = budget
+        self._slice_size = slice_size
+        self._slice_window = slice_window
+        self._num_segments = num_segments
+        self._min_segments = min_segments
+        self._event_push_client = event_push_client
+
+        self._waiters = deque()
+        self.stats = {
+            "budget"            : budget,
+            "in-use"            : 0,
+            "max-in-use"        : 0,
+            "archives"          : 0,
+            "charged"           : 0,
+            "waiting"           : 0,
+            "admitted"          : 0,
+            "rejected"          : 0,
+            "reduced-window"    : 0,
+            "wait-seconds"      : 0.0,
+        }
+        self._last_report_time = time.time()
+
+    def plan_archive(self, content_length):
+        """
+        return (slice_window, reservation) for an archive of content_length
+        """
+        slice_window = self._slice_window
+        if self.stats["in-use"] > self._budget // 2 and slice_window > 1:
+            slice_window = 1
+            self.stats["reduced-window"] += 1
+
+        slice_size = _round_up_to_block(min(content_length, self._slice_size))
+
+        # the raw slices queued for (and being) encoded, plus the slices in
+        # flight; the primary zfec shares are views of a raw slice, so only
+        # the parity shares add to that
+        raw_slices = (2 * slice_window) + 1
+        parity_slices = float(slice_window * \
+                              (self._num_segments - self._min_segments)) / \
+                        self._min_segments
+        reservation = int(slice_size * (raw_slices + parity_slices))
+
+        # an archive bigger than the whole budget may still run on its own
+        return slice_window, min(reservation, self._budget)
+
+    def acquire(self, reservation, timeout):
+        """
+        wait up to timeout seconds for reservation bytes of the budget
+
+        return True if we got them, False if the caller should shed the
+        request
+        """
+        start_time = time.time()
+        try:
+            if len(self._waiters) == 0 and self._fits(reservation):
+                self._take(reservation)
+                return True
+
+            waiter = (reservation, gevent.event.Event(), )
+            self._waiters.append(waiter)
+            self.stats["waiting"] = len(self._waiters)
+            admitted = False
+            try:
+                waiter[1].wait(timeout)
+                # we may have given up just as a release handed us the
+                # budget
+                admitted = waiter[1].is_set()
+            finally:
+                # if we are killed while waiting, don't leave the waiter
+                # queued, or the budget a release handed it, behind us
+                if not admitted:
+                    self._abandon(waiter)
+
+            if not admitted:
+                self.stats["rejected"] += 1
+            return admitted
+        finally:
+            self.stats["wait-seconds"] += time.time() - start_time
+            self._report_stats()
+
+    def release(self, reservation):
+        """
+        give back bytes reserved by acquire
+        """
+        self.stats["in-use"] -= reservation
+        self.stats["archives"] -= 1
+        assert self.stats["in-use"] >= 0, self.stats
+        self._wake_waiters()
+
+    def charge(self, size):
+        """
+        count size bytes held outside of any archive's reservation (the
+        handoff history an archive keeps after its response) against the
+        budget. They are already held, so we don't wait for them.
+        """
+        self.stats["in-use"] += size
+        self.stats["charged"] += size
+        self.stats["max-in-use"] = max(self.stats["max-in-use"],
+                                       self.stats["in-use"])
+
+    def discharge(self, size):
+        """
+        give back bytes counted by charge
+        """
+        self.stats["in-use"] -= size
+        self.stats["charged"] -= size
+        assert self.stats["in-use"] >= 0, self.stats
+        self._wake_waiters()
+
+    def _abandon(self, waiter):
+        reservation, event = waiter
+        if event.is_set():
+            self.release(reservation)
+            return
+        self._waiters.remove(waiter)
+        self.stats["waiting"] = len(self._waiters)
+        # we may have been holding up smaller waiters behind us
+        self._wake_waiters()
+
+    def _fits(self, reservation):
+        return self.stats["in-use"] + reservation <= self._budget
+
+    def _take(self, reservation):
+        self.stats["in-use"] += reservation
+        self.stats["archives"] += 1
+        self.stats["admitted"] += 1
+        self.stats["max-in-use"] = max(self.stats["max-in-use"],
+                                       self.stats["in-use"])
+
+    def _wake_waiters(self):
+        while len(self._waiters) > 0 and self._fits(self._waiters[0][0]):
+            reservation, event = self._waiters.popleft()
+            self._take(reservation)
+            event.set()
+        self.stats["waiting"] = len(self._waiters)
+
+    def _report_stats(self):
+        current_time = time.time()
+        if current_time - self._last_report_time < _reporting_interval:
+            return
+        self._last_report_time = current_time
+
+        self._log.info("{in-use} of {budget} bytes in use, "
+                       "max {max-in-use}, {rejected} rejected".format(
+                       **self.stats))
+        if self._event_push_client is not None:
+            self._event_push_client.info("web-writer-admission-stats",
+                                         "web writer admission stats",
+                                         stats=dict(self.stats))
+        self.stats["max-in-use"] = self.stats["in-use"]
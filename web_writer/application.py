@@ -55,6 +55,7 @@ from web_writer.exceptions import ArchiveFailedError, \
 from web_writer.data_writer_handoff_client import DataWriterHandoffClient
 from web_writer.data_writer import DataWriter
 from web_writer.archiver import Archiver
+from web_writer.admission_control import AdmissionControl
 from web_writer.destroyer import Destroyer
 from web_writer.conjoined_manager import start_conjoined_archive, \
         abort_conjoined_archive, \
@@ -99,6 +100,30 @@ _archive_retry_interval = 120
 _content_type_json = "application/json"
 _max_sequence_upload_interval = int(os.environ.get("NIMBUSIO_REQUEST_TIMEOUT", 
                                                    "1800"))
+# the number of slices an archive may have in flight to the data writers
+# while we read and encode the next one
+_archive_slice_window = int(os.environ.get("NIMBUSIO_ARCHIVE_SLICE_WINDOW",
+                                           "2"))
+# the number of data writers that must acknowledge a slice before we move
+# on: the rest complete in the background, and are handed off if they fail.
+# The default waits for all of them; we never accept fewer than we need to
+# decode.
+_archive_write_quorum = max(
+    int(os.environ.get("NIMBUSIO_ARCHIVE_WRITE_QUORUM", str(_max_segments))),
+    _min_segments
+)
+# how long an archive may wait for room in the memory budget before we
+# shed it with 503, and how long we ask the client to wait before retrying
+_admission_timeout = float(os.environ.get("NIMBUSIO_ADMISSION_TIMEOUT",
+                                          "5.0"))
+_admission_retry_interval = int(
+    os.environ.get("NIMBUSIO_ADMISSION_RETRY_INTERVAL", "5"))
+# in quorum mode, how much segment data we hold for handoffs before we
+# fall back to waiting for all data writers
+_archive_max_handoff_history_size = int(
+    os.environ.get("NIMBUSIO_ARCHIVE_MAX_HANDOFF_HISTORY_SIZE",
+                   str(256 * 1024 * 1024))
+)
 
 def _fix_timestamp(timestamp):
     return (None if timestamp is None else http_timestamp_str(timestamp))
@@ -122,15 +147,53 @@ def _build_meta_dict(req_get):
 def _connected_clients(clients):
     return [client for client in clients if client.connected]
 
-def _create_data_writers(clients):
+def _create_handoff_data_writer(node_name, client, connected_clients):
+    backup_clients = random.sample(connected_clients, _handoff_count)
+    assert backup_clients[0] != backup_clients[1]
+    data_writer_handoff_client = DataWriterHandoffClient(
+        client.server_node_name,
+        backup_clients
+    )
+    return DataWriter(node_name, data_writer_handoff_client)
+
+def _handoff_data_writer_factory(clients):
+    """
+    return a function for the archiver to replace the DataWriter of a node
+    that fails during an archive with one that hands off to other nodes
+    """
+    def _factory(dest_node_name):
+        connected_clients = list()
+        dest_client = None
+        for node_name, client in zip(_node_names, clients):
+            if node_name == dest_node_name:
+                dest_client = client
+            elif client.connected:
+                connected_clients.append(client)
+        return _create_handoff_data_writer(dest_node_name,
+                                           dest_client,
+                                           connected_clients)
+    return _factory
+
+def _create_data_writers(clients, batch_clients=None):
+    """
+    batch_clients
+        optional: DataWriterBatchClient's wrapping clients; if given,
+        connected nodes are sent small archives in batches
+    """
     data_writers_dict = dict()
 
     connected_clients_by_node = list()
     disconnected_clients_by_node = list()
 
-    for node_name, client in zip(_node_names, clients):
+    if batch_clients is None:
+        batch_clients = clients
+
+    for node_name, client, batch_client in zip(_node_names, 
+                                               clients, 
+                                               batch_clients):
         if client.connected:
             connected_clients_by_node.append((node_name, client))
+            data_writers_dict[node_name] = DataWriter(node_name, batch_client)
         else:
             disconnected_clients_by_node.append((node_name, client))
 
@@ -139,22 +202,12 @@ def _create_data_writers(clients):
             len(connected_clients_by_node),
         ))
 
-    connected_clients = list()
-    for node_name, client in connected_clients_by_node:
-        connected_clients.append(client)
-        assert node_name not in data_writers_dict, connected_clients_by_node
-        data_writers_dict[node_name] = DataWriter(node_name, client)
+    connected_clients = [client for _, client in connected_clients_by_node]
     
     for node_name, client in disconnected_clients_by_node:
-        backup_clients = random.sample(connected_clients, _handoff_count)
-        assert backup_clients[0] != backup_clients[1]
-        data_writer_handoff_client = DataWriterHandoffClient(
-            client.server_node_name,
-            backup_clients
-        )
         assert node_name not in data_writers_dict, data_writers_dict
-        data_writers_dict[node_name] = DataWriter(
-            node_name, data_writer_handoff_client
+        data_writers_dict[node_name] = _create_handoff_data_writer(
+            node_name, client, connected_clients
         )
 
     # 2011-05-27 dougfort -- the data-writers list must be in 
@@ -187,7 +240,10 @@ class Application(object):
         authenticator, 
         accounting_client,
         event_push_client,
-        redis_queue
+        redis_queue,
+        zfec_process_pool=None,
+        data_writer_batch_clients=None,
+        memory_budget=0
     ):
         self._log = logging.getLogger("Application")
         self._cluster_row = cluster_row
@@ -198,11 +254,20 @@ class Application(object):
         self.accounting_client = accounting_client
         self._event_push_client = event_push_client
         self._redis_queue = redis_queue
-
+        self._zfec_process_pool = zfec_process_pool
+        self._data_writer_batch_clients = data_writer_batch_clients
+        self._admission_control = None
+        if memory_budget > 0:
+            self._admission_control = AdmissionControl(memory_budget,
+                                                       incoming_slice_size,
+                                                       _archive_slice_window,
+                                                       _max_segments,
+                                                       _min_segments,
+                                                       event_push_client)
 
         self._dispatch_table = {
             action_respond_to_ping      : self._respond_to_ping,
-            action_archive_key          : self._archive_key,
+            action_archive_key          : self._admit_archive_key,
             action_delete_key           : self._delete_key,
             action_start_conjoined      : self._start_conjoined,
             action_finish_conjoined     : self._finish_conjoined,
@@ -257,7 +322,45 @@ class Application(object):
         response.body_file.write("ok")
         return response
 
-    def _archive_key(self, req, match_object, user_request_id):
+    def _admit_archive_key(self, req, match_object, user_request_id):
+        """
+        reserve memory for the archive out of the budget, or shed the
+        request if there is no room for it
+        """
+        if self._admission_control is None or \
+           req.content_length is None:
+            return self._archive_key(req, match_object, user_request_id)
+
+        slice_window, reservation = \
+            self._admission_control.plan_archive(req.content_length)
+        if not self._admission_control.acquire(reservation, 
+                                               _admission_timeout):
+            self._log.warn("request {0}: no room for {1} bytes: " \
+                           "{2} of {3} in use".format(
+                           user_request_id,
+                           reservation,
+                           self._admission_control.stats["in-use"],
+                           self._admission_control.stats["budget"]))
+            response = Response(status=httplib.SERVICE_UNAVAILABLE, 
+                                content_type=None)
+            # 2012-09-06 dougfort Ticket #44 (temporary Connection: close)
+            response.headers["Connection"] = "close"
+            response.retry_after = _admission_retry_interval
+            return response
+
+        try:
+            return self._archive_key(req, 
+                                     match_object, 
+                                     user_request_id,
+                                     slice_window)
+        finally:
+            self._admission_control.release(reservation)
+
+    def _archive_key(self, 
+                     req, 
+                     match_object, 
+                     user_request_id, 
+                     slice_window=_archive_slice_window):
         collection_name = match_object.group("collection_name")
         key = match_object.group("key")
 
@@ -335,7 +438,8 @@ class Application(object):
             if len(value) > 0:
                 conjoined_part = int(value)
 
-        data_writers = _create_data_writers(self._data_writer_clients) 
+        data_writers = _create_data_writers(self._data_writer_clients,
+                                            self._data_writer_batch_clients) 
         timestamp = create_timestamp()
         archiver = Archiver(
             data_writers,
@@ -346,6 +450,12 @@ class Application(object):
             meta_dict,
             conjoined_part,
             user_request_id,
+            slice_window=slice_window,
+            write_quorum=_archive_write_quorum,
+            handoff_data_writer_factory=\
+                _handoff_data_writer_factory(self._data_writer_clients),
+            max_history_size=_archive_max_handoff_history_size,
+            admission_control=self._admission_control
         )
 
         if not conjoined_archive:
@@ -355,7 +465,9 @@ class Application(object):
                                         value=1)
             self._redis_queue.put(("archive_request", queue_entry, ))
 
-        data_queue = gevent.queue.Queue()
+        # bound the read-ahead, so the reader stays no more than one
+        # window of slices ahead of the archiver
+        data_queue = gevent.queue.Queue(maxsize=slice_window)
         reader = ReaderGreenlet(req.body_file, data_queue)
         reader.start()
 
@@ -377,7 +489,10 @@ class Application(object):
                 file_adler32 = zlib.adler32(slice_item, file_adler32)
                 file_md5.update(slice_item)
                 file_size += len(slice_item)
-                segments = segmenter.encode(block_generator(slice_item))
+                if self._zfec_process_pool is None:
+                    segments = segmenter.encode(block_generator(slice_item))
+                else:
+                    segments = self._zfec_process_pool.encode(slice_item)
                 zfec_padding_size = segmenter.padding_size(slice_item)
                 if actual_content_length == expected_content_length:
                     archiver.archive_final(
@@ -449,6 +564,11 @@ class Application(object):
             # 2012-09-06 dougfort Ticket #44 (temporary Connection: close)
             response.headers["Connection"] = "close"
             return response
+        finally:
+            # with a bounded data_queue the reader may be blocked putting
+            # a slice (or the final None): don't leave it holding the
+            # request body after a failed upload
+            reader.kill()
 
         assert reader.dead
         
@@ -3,7 +3,19 @@
 archiver.py
 
 A class that sends data segments to data writers.
+
+Slices are pipelined: up to slice_window slices may be in flight to the
+data writers at once, so the caller can read and encode the next slice
+while the previous one is still waiting for acks.
+
+With a write_quorum below the number of data writers, a slice is retired
+as soon as write_quorum segments are acknowledged (enough to decode). The
+remaining writes complete in the background. A data writer that fails is
+replaced by a handoff writer, and every message sent to it so far is
+replayed, so we keep the segments we have sent until the archive completes
+(up to max_history_size bytes, after which we wait for all data writers).
 """
+from collections import defaultdict, deque
 import logging
 import os
 import time
@@ -28,7 +40,12 @@ class Archiver(object):
         timestamp, 
         meta_dict, 
         conjoined_part,
-        user_request_id
+        user_request_id,
+        slice_window=1,
+        write_quorum=None,
+        handoff_data_writer_factory=None,
+        max_history_size=None,
+        admission_control=None
     ):
         self._log = logging.getLogger(
             'Archiver(collection_id=%d, key=%r)' % (collection_id, key))
@@ -40,10 +57,45 @@ class Archiver(object):
         self._meta_dict = meta_dict
         self._conjoined_part = conjoined_part
         self._user_request_id = user_request_id
+        self._slice_window = max(slice_window, 1)
         self._sequence_num = 0
         self._pending = gevent.pool.Group()
         self._finished_tasks = gevent.queue.Queue()
 
+        # sequence numbers of slices we have sent, but which do not yet
+        # have enough acknowledgements: oldest first
+        self._in_flight = deque()
+
+        # segment indices that have acknowledged (or that we have given up
+        # on) for each sequence number
+        self._acked = defaultdict(set)
+        self._lost = defaultdict(set)
+
+        # the data writer currently responsible for each segment: a
+        # handoff writer replaces a data writer that fails, None means
+        # the segment cannot be handed off
+        self._segment_writers = list(data_writers)
+
+        # in quorum mode, every (method_name, sequence_num, args) sent
+        # for each segment, so it can be replayed to a handoff writer
+        self._handoff_data_writer_factory = handoff_data_writer_factory
+        self._max_history_size = max_history_size
+        self._history_size = 0
+        # the history we keep after archive_final is charged to the
+        # web writer's memory budget
+        self._admission_control = admission_control
+        self._history_charge = 0
+        if write_quorum is not None and \
+           write_quorum < len(data_writers) and \
+           handoff_data_writer_factory is not None:
+            self._write_quorum = write_quorum
+            self._history = [list() for _ in data_writers]
+        else:
+            self._write_quorum = len(data_writers)
+            self._history = None
+
+        self._straggler_greenlet = None
+
     def _done_link(self, task):
         self._finished_tasks.put(task, block=True)
 
@@ -54,47 +106,74 @@ class Archiver(object):
                         str(greenlet_object),
                         greenlet_object.exception.__class__.__name__,
                         str(greenlet_object.exception)))
+
+    def _spawn_task(self, segment_index, sequence_num, method_name, args):
+        data_writer = self._segment_writers[segment_index]
+        task = self._pending.spawn(getattr(data_writer, method_name), *args)
+        task.node_name = data_writer.node_name
+        task.data_writer = data_writer
+        task.segment_index = segment_index
+        task.sequence_num = sequence_num
+        task.link(self._done_link)
+        task.link_exception(self._unhandled_greenlet_exception)
+
+    def _send_segment(self, segment_index, method_name, args, segment):
+        if self._history is not None:
+            self._history[segment_index].append(
+                (method_name, self._sequence_num, args, )
+            )
+            self._history_size += sum([len(block) for block in segment])
+
+        if self._segment_writers[segment_index] is None:
+            self._lost[self._sequence_num].add(segment_index)
+            return
+
+        self._spawn_task(segment_index, 
+                         self._sequence_num, 
+                         method_name, 
+                         args)
+
+    def _check_history_size(self):
+        if self._history is None or self._max_history_size is None:
+            return
+        if self._history_size <= self._max_history_size:
+            return
+        self._log.info("request {0}: " \
+                       "{1} bytes sent, waiting for all data writers".format(
+                       self._user_request_id, self._history_size))
+        self._history = None
+        self._write_quorum = len(self._data_writers)
  
     def archive_slice(self, segments, zfec_padding_size, timeout=None):
+        if self._sequence_num == 0:
+            method_name = "archive_key_start"
+        else:
+            method_name = "archive_key_next"
         for i, segment in enumerate(segments):
             segment_num = i + 1
-            data_writer = self._data_writers[i]
-            if self._sequence_num == 0:
-                task = self._pending.spawn(
-                    data_writer.archive_key_start,
-                    self._collection_id,
-                    self._key,
-                    self._unified_id,
-                    self._timestamp,
-                    self._conjoined_part,
-                    segment_num,
-                    zfec_padding_size,
-                    self._sequence_num,
-                    segment,
-                    _local_node_name,
-                    self._user_request_id
-                )
-            else:
-                task = self._pending.spawn(
-                    data_writer.archive_key_next,
-                    self._collection_id,
-                    self._key,
-                    self._unified_id,
-                    self._timestamp,
-                    self._conjoined_part,
-                    segment_num,
-                    zfec_padding_size,
-                    self._sequence_num,
-                    segment,
-                    _local_node_name,
-                    self._user_request_id
-                )
-            task.node_name = data_writer.node_name
-            task.link(self._done_link)
-            task.link_exception(self._unhandled_greenlet_exception)
+            args = (
+                self._collection_id,
+                self._key,
+                self._unified_id,
+                self._timestamp,
+                self._conjoined_part,
+                segment_num,
+                zfec_padding_size,
+                self._sequence_num,
+                segment,
+                _local_node_name,
+                self._user_request_id, 
+            )
+            self._send_segment(i, method_name, args, segment)
 
-        self._process_node_replies(timeout)
+        self._in_flight.append(self._sequence_num)
         self._sequence_num += 1
+        self._check_history_size()
+
+        # don't return to the caller until there is room in the window
+        # for another slice
+        while len(self._in_flight) >= self._slice_window:
+            self._process_node_replies(timeout)
 
     def archive_final(
         self, 
@@ -107,10 +186,9 @@ class Archiver(object):
     ):
         for i, segment in enumerate(segments):
             segment_num = i + 1
-            data_writer = self._data_writers[i]
             if self._sequence_num == 0:
-                task = self._pending.spawn(
-                    data_writer.archive_key_entire,
+                method_name = "archive_key_entire"
+                args = (
                     self._collection_id,
                     self._key,
                     self._unified_id,
@@ -124,11 +202,11 @@ class Archiver(object):
                     file_md5,
                     segment,
                     _local_node_name,
-                    self._user_request_id
+                    self._user_request_id, 
                 )
             else:
-                task = self._pending.spawn(
-                    data_writer.archive_key_final,
+                method_name = "archive_key_final"
+                args = (
                     self._collection_id,
                     self._key,
                     self._unified_id,
@@ -143,97 +221,276 @@ class Archiver(object):
                     file_md5,
                     segment,
                     _local_node_name,
-                    self._user_request_id
+                    self._user_request_id, 
                 )
-            task.node_name = data_writer.node_name
-            task.link(self._done_link)
-            task.link_exception(self._unhandled_greenlet_exception)
+            self._send_segment(i, method_name, args, segment)
 
-        self._process_node_replies(timeout)
+        self._in_flight.append(self._sequence_num)
 
-    def _process_node_replies(self, timeout):
-        finished_count = 0
-        error_count = 0
-        start_time = time.time()
+        # the final slice must wait for every slice still in flight
+        while len(self._in_flight) > 0:
+            self._process_node_replies(timeout)
 
-        # block on the finished_tasks queue until done
-        while finished_count < len(self._data_writers):
+        # in quorum mode, some data writers may still be working
+        if not self._all_settled():
+            if self._history is not None and \
+               self._admission_control is not None:
+                self._history_charge = self._history_size
+                self._admission_control.charge(self._history_charge)
+            self._straggler_greenlet = gevent.spawn(self._complete_stragglers,
+                                                    timeout)
+            self._straggler_greenlet.link(self._release_history)
+
+    def _release_history(self, _greenlet):
+        self._history = None
+        if self._history_charge > 0:
+            self._admission_control.discharge(self._history_charge)
+            self._history_charge = 0
+
+    def _settled(self, sequence_num):
+        settled = self._acked[sequence_num] | self._lost[sequence_num]
+        return len(settled) == len(self._data_writers)
+
+    def _all_settled(self):
+        return all([self._settled(sequence_num) \
+                    for sequence_num in range(self._sequence_num+1)])
+
+    def _quorum_lost(self):
+        max_lost = len(self._data_writers) - self._write_quorum
+        return any([len(lost) > max_lost for lost in self._lost.values()])
+
+    def _next_finished_task(self, start_time, timeout):
+        """
+        return the next finished task, or None if we have waited too long
+        """
+        while True:
             try:
-                task = self._finished_tasks.get(block=True, 
+                return self._finished_tasks.get(block=True, 
                                                 timeout=_task_timeout)
             except gevent.queue.Empty:
                 elapsed_time = time.time() - start_time
                 if elapsed_time > timeout:
-                    error_message = \
-                        "timed out _finished_tasks %s %s %s" % (
-                            self._collection_id,
-                            self._key,
-                            self._unified_id
-                        )
-                    self._log.error("request {0}: {1}".format(
-                                    self._user_request_id,
-                                    error_message))
-                    raise ArchiveFailedError(error_message)
+                    return None
 
                 self._log.warn("request {0}: " \
                                "timeout waiting for completed task".format(
                                 self._user_request_id))
-                continue
 
-            finished_count += 1
-            if isinstance(task.value, gevent.GreenletExit):
-                self._log.debug("request {0}: " \
-                                "({1}) {2} {3} {4} " \
-                                "task ends with GreenletExit".format(
+    def _process_node_replies(self, timeout):
+        """
+        wait until enough data writers have replied for the oldest slice
+        in flight. Replies for later slices are counted as they arrive.
+        """
+        sequence_num = self._in_flight[0]
+        start_time = time.time()
+
+        # block on the finished_tasks queue until done
+        while len(self._acked[sequence_num]) < self._write_quorum:
+            task = self._next_finished_task(start_time, timeout)
+            if task is None:
+                error_message = \
+                    "timed out _finished_tasks %s %s %s" % (
+                        self._collection_id,
+                        self._key,
+                        self._unified_id
+                    )
+                self._log.error("request {0}: {1}".format(
                                 self._user_request_id,
-                                self._collection_id,
-                                self._key,
-                                self._unified_id,
-                                task.node_name))
-                error_count += 1
-                continue
-
-            if not task.successful():
-                # 2011-10-07 dougfort -- I don't know how a task
-                # could be unsuccessful
-                self._log.error("request {0}: " \
-                                "({1}) {2} {3} {4} task unsuccessful".format(
+                                error_message))
+                self._pending.kill(block=False)
+                raise ArchiveFailedError(error_message)
+
+            self._task_finished(task)
+
+            if self._quorum_lost():
+                error_message = \
+                    "%s errors %s %s %s" % (
+                        sum([len(lost) for lost in self._lost.values()]),
+                        self._collection_id,
+                        self._key,
+                        self._unified_id
+                    )
+                self._log.error("request {0}: {1}".format(
                                 self._user_request_id,
-                                self._collection_id,
-                                self._key,
-                                self._unified_id,
-                                task.node_name))
-                error_count += 1
-                continue
-
-            if task.value["result"] != "success":
+                                error_message))
+                # don't leave later slices running after we have given up
+                self._pending.kill(block=False)
+                raise ArchiveFailedError(error_message)
+
+        self._in_flight.popleft()
+
+    def _complete_stragglers(self, timeout):
+        """
+        run in the background after archive_final: wait for the data
+        writers that were not needed for a quorum, handing off any that fail
+        """
+        start_time = time.time()
+        while not self._all_settled():
+            task = self._next_finished_task(start_time, timeout)
+            if task is None:
+                # the client has been told the archive succeeded: hand off
+                # the segments we are still waiting for, and give the
+                # handoff writers their own timeout
+                if self._hand_off_stragglers():
+                    start_time = time.time()
+                    continue
                 self._log.error("request {0}: " \
-                                "({1}) {2} {3} {4} task ends with {5}".format(
-                                self._user_request_id,
-                                self._collection_id,
-                                self._key,
-                                self._unified_id,
-                                task.node_name,
-                                task.value["error-message"]))
-                error_count += 1
-                continue
+                                "timed out waiting for stragglers".format(
+                                self._user_request_id))
+                self._pending.kill(block=False)
+                for sequence_num in range(self._sequence_num+1):
+                    self._lost[sequence_num].update(
+                        self._unsettled_segments(sequence_num))
+                break
+            self._task_finished(task)
+
+        lost_segments = set()
+        for lost in self._lost.values():
+            lost_segments.update([segment_index+1 for segment_index in lost])
+        if len(lost_segments) > 0:
+            self._log.error("request {0}: " \
+                            "({1}) {2} {3} segments {4} not archived".format(
+                            self._user_request_id,
+                            self._collection_id,
+                            self._key,
+                            self._unified_id,
+                            sorted(lost_segments)))
+        else:
+            self._log.debug("request {0}: stragglers complete".format(
+                            self._user_request_id))
+        self._history = None
+
+    def _unsettled_segments(self, sequence_num):
+        settled = self._acked[sequence_num] | self._lost[sequence_num]
+        return set(range(len(self._data_writers))) - settled
+
+    def _hand_off_stragglers(self):
+        """
+        hand off the segments of the data writers we have waited too long
+        for, as we do for data writers that fail
+
+        return False if there is nothing left we can hand off
+        """
+        if self._history is None:
+            return False
+
+        unsettled = set()
+        for sequence_num in range(self._sequence_num+1):
+            unsettled.update(self._unsettled_segments(sequence_num))
+        # a handoff writer that is slow too is not handed off again
+        stragglers = [segment_index for segment_index in sorted(unsettled) \
+                      if self._segment_writers[segment_index] is \
+                         self._data_writers[segment_index]]
+        if len(stragglers) == 0:
+            return False
+
+        for segment_index in stragglers:
+            # the killed tasks' replies are ignored, because they come
+            # from a data writer we have handed off
+            for task in list(self._pending):
+                if task.segment_index == segment_index:
+                    task.kill(block=False)
+            self._hand_off_segment(segment_index)
+        return True
 
+    def _task_finished(self, task):
+        segment_index = task.segment_index
+        if task.data_writer is not self._segment_writers[segment_index]:
+            # a late reply from a data writer we have already handed off
+            return
+
+        if self._task_successful(task):
+            self._acked[task.sequence_num].add(segment_index)
+            return
+
+        if self._history is not None and \
+           task.data_writer is self._data_writers[segment_index]:
+            self._hand_off_segment(segment_index)
+            return
+
+        self._lost[task.sequence_num].add(segment_index)
+
+    def _hand_off_segment(self, segment_index):
+        """
+        replace a failed data writer with a handoff writer, and replay
+        everything we have sent to it
+        """
+        node_name = self._data_writers[segment_index].node_name
+        self._log.warn("request {0}: " \
+                       "({1}) {2} {3} handing off segment {4} for {5}".format(
+                       self._user_request_id,
+                       self._collection_id,
+                       self._key,
+                       self._unified_id,
+                       segment_index+1,
+                       node_name))
+
+        # whatever the failed data writer acknowledged no longer counts,
+        # and it should drop what it has, so it does not commit a segment
+        # we have replayed elsewhere
+        for acked in self._acked.values():
+            acked.discard(segment_index)
+        self._data_writers[segment_index].archive_key_cancel(
+            self._unified_id,
+            self._conjoined_part,
+            segment_index+1,
+            self._user_request_id)
+
+        try:
+            handoff_writer = self._handoff_data_writer_factory(node_name)
+        except Exception:
+            self._log.exception("request {0}: " \
+                                "unable to hand off segment {1}".format(
+                                self._user_request_id, segment_index+1))
+            self._segment_writers[segment_index] = None
+            for sequence_num in range(self._sequence_num+1):
+                self._lost[sequence_num].add(segment_index)
+            return
+
+        self._segment_writers[segment_index] = handoff_writer
+        for method_name, sequence_num, args in self._history[segment_index]:
+            self._spawn_task(segment_index, sequence_num, method_name, args)
+
+    def _task_successful(self, task):
+        if isinstance(task.value, gevent.GreenletExit):
             self._log.debug("request {0}: " \
-                            " ({1}) {2} {3} {4} task successful".format(
+                            "({1}) {2} {3} {4} " \
+                            "task ends with GreenletExit".format(
                             self._user_request_id,
                             self._collection_id,
                             self._key,
                             self._unified_id,
                             task.node_name))
+            return False
 
-        if error_count > 0:
-            error_message = \
-                "%s errors %s %s %s" % (
-                    error_count,
-                    self._collection_id,
-                    self._key,
-                    self._unified_id
-                )
-            self._log.error("request {0}: {1}".format(self._user_request_id,
-                                                      error_message))
-            raise ArchiveFailedError(error_message)
+        if not task.successful():
+            # 2011-10-07 dougfort -- I don't know how a task
+            # could be unsuccessful
+            self._log.error("request {0}: " \
+                            "({1}) {2} {3} {4} task unsuccessful".format(
+                            self._user_request_id,
+                            self._collection_id,
+                            self._key,
+                            self._unified_id,
+                            task.node_name))
+            return False
+
+        if task.value["result"] != "success":
+            self._log.error("request {0}: " \
+                            "({1}) {2} {3} {4} task ends with {5}".format(
+                            self._user_request_id,
+                            self._collection_id,
+                            self._key,
+                            self._unified_id,
+                            task.node_name,
+                            task.value["error-message"]))
+            return False
+
+        self._log.debug("request {0}: " \
+                        " ({1}) {2} {3} {4} task successful".format(
+                        self._user_request_id,
+                        self._collection_id,
+                        self._key,
+                        self._unified_id,
+                        task.node_name))
+        return True
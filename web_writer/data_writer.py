@@ -237,6 +237,30 @@ class DataWriter(object):
         reply, _data = delivery_channel.get()
         return reply
 
+    def archive_key_cancel(
+        self,
+        unified_id,
+        conjoined_part,
+        segment_num,
+        user_request_id
+    ):
+        """
+        tell the data writer to drop what it has of the segment: we expect
+        no reply
+        """
+        message = {
+            "message-type"              : "archive-key-cancel",
+            "priority"                  : create_priority(),
+            "user-request-id"           : user_request_id,
+            "unified-id"                : unified_id,
+            "conjoined-part"            : conjoined_part,
+            "segment-num"               : segment_num,
+        }
+        self._log.debug("request {user-request-id}: {message-type}: " \
+                        "unified_id = {unified-id} " \
+                        "segment_num = {segment-num}".format(**message))
+        self._resilient_client.queue_message_for_broadcast(message)
+
     def destroy_key(
         self,
         collection_id,
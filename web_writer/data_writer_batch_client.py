@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+data_writer_batch_client.py
+
+class DataWriterBatchClient
+
+This class mimics a single GreenletResilientClient while gathering small
+archive-key-entire messages for the same node into a single
+archive-key-entire-batch message. The data writer stores the whole batch
+in one database transaction and replies with a result for each archive.
+
+All other messages are passed straight through to the wrapped client.
+"""
+import logging
+
+import gevent
+import gevent.pool
+from gevent.queue import Queue
+
+_close_timeout = 30.0
+
+class DataWriterBatchClient(object):
+    """
+    client
+        the GreenletResilientClient for the data writer
+
+    max_archive_size
+        archive-key-entire messages with a segment larger than this are
+        not batched
+
+    max_batch_count
+        the most archives we send in one batch
+
+    max_batch_size
+        send the batch when its segments add up to this many bytes
+
+    linger_interval
+        the longest (in seconds) we hold an archive while we wait for others
+        to join its batch
+    """
+    def __init__(self,
+                 client,
+                 max_archive_size,
+                 max_batch_count,
+                 max_batch_size,
+                 linger_interval):
+        self._log = logging.getLogger("BatchClient-%s" % (
+            client.server_node_name, ))
+        self._client = client
+        self._max_archive_size = max_archive_size
+        self._max_batch_count = max_batch_count
+        self._max_batch_size = max_batch_size
+        self._linger_interval = linger_interval
+        self._batch = list()
+        self._batch_size = 0
+        self._linger_greenlet = None
+        self._senders = gevent.pool.Group()
+
+    def __str__(self):
+        return "DataWriterBatchClient(%s)" % (self._client, )
+
+    @property
+    def connected(self):
+        return self._client.connected
+
+    @property
+    def server_node_name(self):
+        return self._client.server_node_name
+
+    def queue_message_for_send(self, message, data=None):
+        """
+        accept a message as if we were a single client. Small archives are
+        held for a batch, everything else is sent on.
+        """
+        if message["message-type"] != "archive-key-entire" or \
+           message["segment-size"] > self._max_archive_size:
+            return self._client.queue_message_for_send(message, data)
+
+        completion_channel = Queue(maxsize=1)
+
+        # we expect a list of blocks, but we may get a single string
+        if data is None:
+            data = []
+        elif type(data) != list:
+            data = [data, ]
+
+        self._batch.append((message, data, completion_channel, ))
+        self._batch_size += message["segment-size"]
+
+        if len(self._batch) >= self._max_batch_count or \
+           self._batch_size >= self._max_batch_size:
+            self._flush()
+        elif self._linger_greenlet is None:
+            self._linger_greenlet = gevent.spawn_later(self._linger_interval,
+                                                       self._flush)
+
+        return completion_channel
+
+    def queue_message_for_broadcast(self, message, data=None):
+        """
+        messages that expect no reply are never batched
+        """
+        self._client.queue_message_for_broadcast(message, data)
+
+    def _flush(self):
+        if self._linger_greenlet is not None:
+            if self._linger_greenlet is not gevent.getcurrent():
+                self._linger_greenlet.kill(block=False)
+            self._linger_greenlet = None
+
+        batch = self._batch
+        self._batch = list()
+        self._batch_size = 0
+
+        if len(batch) > 0:
+            self._senders.spawn(self._send_batch, batch)
+
+    def close(self, timeout=_close_timeout):
+        """
+        send any archives held for a batch, and wait for the replies to
+        the batches we have sent. Call this before stopping the client.
+        """
+        self._flush()
+        self._senders.join(timeout)
+        if len(self._senders) > 0:
+            self._log.warn("{0} batches unfinished at close".format(
+                           len(self._senders)))
+            self._senders.kill()
+
+    def _send_batch(self, batch):
+        archives = [message for message, _data, _channel in batch]
+        message = {
+            "message-type"      : "archive-key-entire-batch",
+            "priority"          : min([m["priority"] for m in archives]),
+            "user-request-id"   : ",".join([m["user-request-id"] \
+                                            for m in archives]),
+            "archives"          : archives,
+        }
+        data = list()
+        for _message, archive_data, _channel in batch:
+            data.extend(archive_data)
+
+        self._log.debug("request {0}: sending {1} archives".format(
+                        message["user-request-id"], len(archives)))
+
+        try:
+            delivery_channel = self._client.queue_message_for_send(
+                message, data=(data if len(data) > 0 else None)
+            )
+            reply, _data = delivery_channel.get()
+        except Exception as instance:
+            self._log.exception("request {0}".format(
+                                message["user-request-id"]))
+            reply = {
+                "message-type"  : "archive-key-entire-batch-reply",
+                "result"        : "exception",
+                "error-message" : str(instance),
+            }
+
+        # if the batch as a whole failed, every archive in it has failed
+        if reply["result"] != "success":
+            for _message, _data, completion_channel in batch:
+                completion_channel.put((reply, None, ))
+            return
+
+        assert len(reply["results"]) == len(batch), reply
+        for (_message, _data, completion_channel, ), archive_reply in \
+            zip(batch, reply["results"]):
+            completion_channel.put((archive_reply, None, ))
@@ -57,6 +57,13 @@ class DataWriterHandoffClient(object):
 
         return completion_channel
 
+    def queue_message_for_broadcast(self, message, data=None):
+        """
+        pass on a message that expects no reply to both backup clients
+        """
+        for client in self._backup_clients:
+            client.queue_message_for_broadcast(message.copy(), data)
+
     def _complete_handoff(self, message, data, completion_channel):
         # hand off the message, 
         if "handoff-node-name" in message:
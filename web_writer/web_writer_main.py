@@ -45,14 +45,17 @@ from tools.unified_id_factory import UnifiedIDFactory
 from tools.id_translator import InternalIDTranslator
 from tools.data_definitions import create_timestamp, \
         cluster_row_template, \
-        node_row_template
+        node_row_template, \
+        incoming_slice_size
 from tools.interaction_pool_authenticator import \
     InteractionPoolAuthenticator
 from tools.operational_stats_redis_sink import OperationalStatsRedisSink
+from tools.zfec_process_pool import ZfecProcessPool
 
 from web_public_reader.space_accounting_client import SpaceAccountingClient
 
 from web_writer.application import Application
+from web_writer.data_writer_batch_client import DataWriterBatchClient
 
 class WebWriterError(Exception):
     pass
@@ -81,6 +84,26 @@ _memcached_port = int(os.environ.get("NIMBUSIO_MEMCACHED_PORT", "11211"))
 _memcached_nodes = ["{0}:{1}".format(_memcached_host, _memcached_port), ]
 _database_pool_size = 3 
 _central_pool_name = "default"
+# number of worker processes for zfec encoding, 0 means encode in the
+# request greenlet
+_encoder_worker_count = int(
+    os.environ.get("NIMBUSIO_WEB_WRITER_ENCODER_WORKERS", "2"))
+_min_segments = 8
+# small archives for the same data writer are sent together in batches of up
+# to this many: 1 means send each archive on its own
+_archive_batch_max_count = int(
+    os.environ.get("NIMBUSIO_ARCHIVE_BATCH_MAX_COUNT", "32"))
+# the largest segment we hold for a batch (64k objects give 8k segments)
+_archive_batch_max_archive_size = int(
+    os.environ.get("NIMBUSIO_ARCHIVE_BATCH_MAX_ARCHIVE_SIZE", str(8 * 1024)))
+_archive_batch_max_size = int(
+    os.environ.get("NIMBUSIO_ARCHIVE_BATCH_MAX_SIZE", str(256 * 1024)))
+_archive_batch_linger_interval = float(
+    os.environ.get("NIMBUSIO_ARCHIVE_BATCH_LINGER_INTERVAL", "0.005"))
+# the memory all archives in progress may reserve, 0 means no limit
+_archive_memory_budget = int(
+    os.environ.get("NIMBUSIO_WEB_WRITER_MEMORY_BUDGET", 
+                   str(512 * 1024 * 1024)))
 
 def _signal_handler_closure(halt_event):
     def _signal_handler(*_args):
@@ -186,6 +209,17 @@ class WebWriter(object):
             resilient_client.link_exception(self._unhandled_greenlet_exception)
             self._data_writer_clients.append(resilient_client)
 
+        self._data_writer_batch_clients = None
+        if _archive_batch_max_count > 1:
+            self._data_writer_batch_clients = [
+                DataWriterBatchClient(client,
+                                      _archive_batch_max_archive_size,
+                                      _archive_batch_max_count,
+                                      _archive_batch_max_size,
+                                      _archive_batch_linger_interval) \
+                for client in self._data_writer_clients
+            ]
+
         self._space_accounting_dealer_client = GreenletDealerClient(
             self._zeromq_context, 
             _local_node_name, 
@@ -236,6 +270,18 @@ class WebWriter(object):
             id_translator_keys["hmac_size"]
         )
 
+        # the encoder processes are forked here: they never touch the
+        # zeromq sockets they inherit
+        self._zfec_process_pool = None
+        if _encoder_worker_count > 0:
+            self._zfec_process_pool = ZfecProcessPool(
+                _min_segments,
+                len(_node_names),
+                _encoder_worker_count,
+                incoming_slice_size,
+                self._event_push_client
+            )
+
         redis_queue = gevent.queue.Queue()
 
         self._redis_sink = OperationalStatsRedisSink(halt_event, 
@@ -251,7 +297,10 @@ class WebWriter(object):
             authenticator,
             self._accounting_client,
             self._event_push_client,
-            redis_queue
+            redis_queue,
+            self._zfec_process_pool,
+            self._data_writer_batch_clients,
+            _archive_memory_budget
         )
         self.wsgi_server = WSGIServer((_web_writer_host, _web_writer_port), 
                                       application=self.application,
@@ -270,6 +319,10 @@ class WebWriter(object):
         self._log.info("stopping wsgi web server")
         self.wsgi_server.stop()
         self._accounting_client.close()
+        if self._data_writer_batch_clients is not None:
+            self._log.debug("flushing data writer batches")
+            for batch_client in self._data_writer_batch_clients:
+                batch_client.close()
         self._log.debug("killing greenlets")
         self._space_accounting_dealer_client.kill()
         self._pull_server.kill()
@@ -282,6 +335,9 @@ class WebWriter(object):
         for client in self._data_writer_clients:
             client.join()
         self._redis_sink.kill()
+        if self._zfec_process_pool is not None:
+            self._log.debug("stopping zfec process pool")
+            self._zfec_process_pool.close()
         self._log.debug("closing zmq")
         self._event_push_client.close()
         self._zeromq_context.term()